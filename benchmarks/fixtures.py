@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Synthetic fixtures of the benchmarks. They are generated from a fixed
+seed, so the same scale always generates the same fixtures, and they are
+kept in the fixtures dir until the scale or FIXTURES_VERSION changes.
+"""
+import os
+import json
+import random
+import shutil
+import logging
+
+logger = logging.getLogger('appsdk')
+
+# Version 1 fixtures could be left changed by appsdk_change_symlinks
+FIXTURES_VERSION = 2
+
+# The sizes at scale 1.0
+ROOTFS_FILES = 100000
+DPKG_PACKAGES = 5000
+DNF_PACKAGES = 3000
+YAML_FILES = 200
+BUILDROOT_FILES = 5000
+
+FILES_PER_DIR = 100
+SDK_PREFIX = "/opt/windriver/appsdk"
+SDK_TARGET_SYS = "corei7-64-wrs-linux"
+
+TOP_DIRS = ["usr/bin", "usr/sbin", "usr/lib", "usr/lib64", "usr/libexec",
+            "usr/share", "usr/include", "etc", "var/lib", "lib/modules"]
+
+def _pkg_name(rnd, i):
+    return "%s%d%s" % (rnd.choice(["lib", "python3-", "perl-module-", "", "kernel-module-"]),
+                       i, rnd.choice(["", "-dev", "-dbg", "-doc", "-locale-en"]))
+
+class Fixtures(object):
+    """
+    The fixtures dir and the paths of each fixture in it
+    """
+    def __init__(self, fixtures_dir, scale=1.0):
+        self.fixtures_dir = os.path.abspath(fixtures_dir)
+        self.scale = scale
+        self.sdk_output = os.path.join(self.fixtures_dir, "sdk")
+        self.sdkpath = SDK_PREFIX
+        self.target_sys = SDK_TARGET_SYS
+        self.rootfs = os.path.join(self.sdk_output, SDK_PREFIX.lstrip("/"), "sysroots", SDK_TARGET_SYS)
+        self.buildroot = os.path.join(self.fixtures_dir, "buildroot")
+        self.dpkg_status = os.path.join(self.fixtures_dir, "dpkg", "status")
+        self.dnf_output = os.path.join(self.fixtures_dir, "dnf", "repoquery-installed.txt")
+        self.yaml_dir = os.path.join(self.fixtures_dir, "yamls")
+        self.stamp = os.path.join(self.fixtures_dir, "fixtures.json")
+
+    def _count(self, n):
+        return max(1, int(n * self.scale))
+
+    def _is_valid(self):
+        try:
+            with open(self.stamp) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return stamp == {"version": FIXTURES_VERSION, "scale": self.scale}
+
+    def generate(self, force=False):
+        if not force and self._is_valid():
+            logger.info("Reuse fixtures in %s", self.fixtures_dir)
+            return
+
+        logger.info("Generating fixtures in %s", self.fixtures_dir)
+        if os.path.exists(self.fixtures_dir):
+            shutil.rmtree(self.fixtures_dir)
+        os.makedirs(self.fixtures_dir)
+
+        rnd = random.Random(FIXTURES_VERSION)
+        self._gen_tree(rnd, self.rootfs, self._count(ROOTFS_FILES))
+        self._gen_tree(rnd, self.buildroot, self._count(BUILDROOT_FILES))
+        self._gen_dpkg_status(rnd, self.dpkg_status, self._count(DPKG_PACKAGES))
+        self._gen_dnf_output(rnd, self.dnf_output, self._count(DNF_PACKAGES))
+        self._gen_yamls(rnd, self.yaml_dir, self._count(YAML_FILES))
+
+        with open(self.stamp, "w") as f:
+            json.dump({"version": FIXTURES_VERSION, "scale": self.scale}, f)
+
+    def _gen_tree(self, rnd, rootdir, nfiles):
+        """
+        A rootfs like tree of nfiles entries, one in ten is a symlink,
+        absolute ones point into the SDK prefix, some of them are broken,
+        one in fifty is a hard link
+        """
+        files = []
+        for i in range(nfiles):
+            subdir = os.path.join(rootdir, TOP_DIRS[i % len(TOP_DIRS)],
+                                  "d%d" % (i // (FILES_PER_DIR * len(TOP_DIRS))))
+            os.makedirs(subdir, exist_ok=True)
+            path = os.path.join(subdir, "f%d" % i)
+
+            kind = rnd.random()
+            if files and kind < 0.05:
+                target = os.path.join(SDK_PREFIX, "sysroots", SDK_TARGET_SYS,
+                                      os.path.relpath(rnd.choice(files), rootdir))
+                os.symlink(target, path)
+            elif files and kind < 0.1:
+                os.symlink(os.path.relpath(rnd.choice(files), subdir), path)
+            elif files and kind < 0.101:
+                os.symlink("missing-%d" % i, path)
+            elif files and kind < 0.12:
+                os.link(rnd.choice(files), path)
+            else:
+                # Half random and half repeated, compressible like binaries
+                size = rnd.choice([0, 64, 512, 4096, 16384])
+                data = rnd.getrandbits(size * 4).to_bytes(size // 2, "little")
+                with open(path, "wb") as f:
+                    f.write(data + (b"f%d\n" % i * size)[:size - len(data)])
+                files.append(path)
+
+    def _gen_dpkg_status(self, rnd, status_file, npkgs):
+        os.makedirs(os.path.dirname(status_file))
+        names = [_pkg_name(rnd, i) for i in range(npkgs)]
+        with open(status_file, "w") as f:
+            for i, name in enumerate(names):
+                deps = rnd.sample(names, min(len(names), rnd.randint(0, 12)))
+                f.write("Package: %s\n" % name)
+                f.write("Status: install ok %s\n" % rnd.choice(["installed"] * 8 + ["unpacked", "not-installed"]))
+                f.write("Priority: optional\nSection: libs\nInstalled-Size: %d\n" % rnd.randint(1, 100000))
+                f.write("Maintainer: Wind River <info@windriver.com>\n")
+                f.write("Architecture: amd64\nVersion: %d.%d-r%d\n" % (i % 7, i % 13, i % 3))
+                if rnd.random() < 0.1:
+                    f.write("Provides: virtual-%d\n" % i)
+                if deps:
+                    f.write("Depends: %s\n" % ", ".join("%s (>= 1.0)" % d if rnd.random() < 0.3 else d for d in deps))
+                if rnd.random() < 0.2:
+                    f.write("Recommends: %s\n" % rnd.choice(names))
+                f.write("Description: synthetic package %d\n" % i)
+                f.write(" Long description of the synthetic package\n .\n line two\n")
+                f.write("PackageArch: corei7-64\n\n")
+
+    def _gen_dnf_output(self, rnd, output_file, npkgs):
+        """
+        The output of `dnf repoquery --installed' in the queryformat of
+        DnfRpm list_installed
+        """
+        os.makedirs(os.path.dirname(output_file))
+        names = [_pkg_name(rnd, i) for i in range(npkgs)]
+        with open(output_file, "w") as f:
+            for i, name in enumerate(names):
+                arch = rnd.choice(["corei7_64", "noarch", "intel_x86_64"])
+                ver = "%d.%d" % (i % 7, i % 13)
+                f.write("Package: %s %s %s %s-%s-r0.%s.rpm\n" % (name, arch, ver, name, ver, arch))
+                f.write("Dependencies:\n")
+                for dep in rnd.sample(names, min(len(names), rnd.randint(0, 40))):
+                    f.write("%s\n" % dep)
+                for lib in range(rnd.randint(0, 20)):
+                    f.write("lib%d.so.%d()(64bit)\n" % (lib, lib % 3))
+                f.write("Recommendations:\n")
+                if rnd.random() < 0.2:
+                    f.write("%s\n" % rnd.choice(names))
+                f.write("DependenciesEndHere:\n")
+
+    def _gen_yamls(self, rnd, yaml_dir, nfiles):
+        os.makedirs(yaml_dir)
+        for i in range(nfiles):
+            with open(os.path.join(yaml_dir, "fixture-%04d.yaml" % i), "w") as f:
+                f.write("packages:\n")
+                for j in range(rnd.randint(10, 200)):
+                    f.write("- %s\n" % _pkg_name(rnd, j))
+                f.write("environments:\n- NO_RECOMMENDATIONS%d=\"0\"\n" % i)
+                f.write("rootfs-post-scripts:\n- |-\n  echo fixture %d\n  true\n" % i)
+                f.write("features:\n  feature_%d: true\n" % i)
+                f.write("ostree:\n  ostree_osname: wrlinux\n  ostree_remote_url: 'https://example.org/%d'\n" % i)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Benchmarks of the hot paths of genimage and appsdk. They drive the
+installed genimage and appsdk modules against the synthetic fixtures of
+fixtures.py, and compare the results with a saved baseline.
+"""
+import os
+import sys
+import gc
+import json
+import glob
+import time
+import shutil
+import fnmatch
+import logging
+import argparse
+import tempfile
+import subprocess
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fixtures import Fixtures
+
+logger = logging.getLogger('appsdk')
+
+BASELINE_VERSION = 1
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_FIXTURES_DIR = os.path.join(tempfile.gettempdir(), "genimage-benchmarks")
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name):
+    """
+    Register a benchmark, the decorated function does the setup and
+    returns the callable to time
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+@benchmark("dpkg_status_list_installed")
+def bench_dpkg_status(fixtures, tmpdir):
+    from genimage.package_manager.deb import DpkgStatus
+    def run():
+        # A new index parses the status file again
+        return DpkgStatus(fixtures.dpkg_status).list_installed()
+    return run
+
+@benchmark("dpkg_status_get_depends")
+def bench_dpkg_depends(fixtures, tmpdir):
+    from genimage.package_manager.deb import DpkgStatus
+    def run():
+        return DpkgStatus(fixtures.dpkg_status).get_depends()
+    return run
+
+@benchmark("dpkg_mark_packages")
+def bench_mark_packages(fixtures, tmpdir):
+    from genimage.package_manager.deb import AptDeb
+    os.makedirs(os.path.join(tmpdir, "var/lib/dpkg"))
+    shutil.copy(fixtures.dpkg_status, os.path.join(tmpdir, "var/lib/dpkg/status"))
+    pm = AptDeb.__new__(AptDeb)
+    pm.target_rootfs = tmpdir
+    def run():
+        pm._mark_packages("unpacked")
+    return run
+
+@benchmark("dnf_list_installed")
+def bench_dnf_list_installed(fixtures, tmpdir):
+    from genimage.package_manager.rpm import DnfRpm
+    def replay(dnf_args):
+        # Replay the recorded output of dnf repoquery
+        with open(fixtures.dnf_output) as f:
+            for line in f:
+                yield line.rstrip("\n")
+    pm = DnfRpm.__new__(DnfRpm)
+    pm._iter_dnf = replay
+    def run():
+        pm.installed_cache = None
+        return pm.list_installed()
+    return run
+
+@benchmark("parse_yamls")
+def bench_parse_yamls(fixtures, tmpdir):
+    import genimage.utils as utils
+    yaml_files = sorted(glob.glob(os.path.join(fixtures.yaml_dir, "*.yaml")))
+    def run():
+        return utils.parse_yamls(yaml_files, quiet=True)
+    return run
+
+def _touch(src, dst):
+    open(dst, "w").close()
+
+@benchmark("appsdk_change_symlinks")
+def bench_change_symlinks(fixtures, tmpdir):
+    from appsdk.appsdk import AppSDK
+    sdk = AppSDK.__new__(AppSDK)
+    # Change the symlinks of a copy, the other benchmarks see the
+    # fixtures unchanged. Only the names and symlinks matter, the
+    # regular files are copied empty
+    rootfs = os.path.join(tmpdir, "rootfs")
+    shutil.copytree(fixtures.rootfs, rootfs, symlinks=True, copy_function=_touch)
+    # Each run moves the symlinks to the other prefix, the same amount
+    # of work in both directions
+    prefixes = [fixtures.sdkpath, "/opt/benchmark/appsdk"]
+    def run():
+        sdk._change_symlinks(rootfs, prefixes[0], prefixes[1])
+        prefixes.reverse()
+    return run
+
+@benchmark("appsdk_check_sdk_target_sysroots")
+def bench_check_sysroots(fixtures, tmpdir):
+    from appsdk.appsdk import AppSDK
+    sdk = AppSDK.__new__(AppSDK)
+    sdk.sdk_output = fixtures.sdk_output
+    sdk.sdkpath = fixtures.sdkpath
+    sdk.real_multimach_target_sys = fixtures.target_sys
+    return sdk.check_sdk_target_sysroots
+
+@benchmark("appsdk_parse_buildroot")
+def bench_parse_buildroot(fixtures, tmpdir):
+    from appsdk.appsdk import PackageConfig
+    config = PackageConfig.__new__(PackageConfig)
+    def run():
+        config.pkg_data = {"files": ["/*"], "dirs": []}
+        config.parse_buildroot(fixtures.buildroot)
+    return run
+
+@benchmark("cpio_write")
+def bench_cpio_write(fixtures, tmpdir):
+    from genimage.cpio import write_cpio
+    def run():
+        with open(os.devnull, "wb") as out:
+            write_cpio(fixtures.rootfs, out)
+    return run
+
+@benchmark("initramfs_create_cpio_gz")
+def bench_create_cpio(fixtures, tmpdir):
+    from genimage.cpio import create_cpio
+    from genimage.compress import get_compressor
+    compressor = get_compressor("gzip")
+    archive = os.path.join(tmpdir, "initramfs.cpio.gz")
+    def run():
+        create_cpio(fixtures.rootfs, archive, compressor.compress_cmd)
+    return run
+
+# The code of the startup benchmarks, run in a new python3
+STARTUP_CODES = collections.OrderedDict([
+    ("startup_import_genimage", "import genimage"),
+    ("startup_appsdk_exampleyamls_help", "import sys; sys.argv = ['appsdk', 'exampleyamls', '--help']; "
+                                         "import appsdk; appsdk.main()"),
+])
+
+# The modules which the startup code must not import, only the module of
+# the subcommand in the command line is imported
+STARTUP_UNEXPECTED_MODULES = ["genimage.genimage", "ruamel.yaml", "pykwalify"]
+
+def _python_cmd(code):
+    cmd = [sys.executable, "-c", code]
+    def run():
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    return run
+
+@benchmark("startup_import_genimage")
+def bench_import_genimage(fixtures, tmpdir):
+    return _python_cmd(STARTUP_CODES["startup_import_genimage"])
+
+@benchmark("startup_appsdk_exampleyamls_help")
+def bench_appsdk_help(fixtures, tmpdir):
+    return _python_cmd(STARTUP_CODES["startup_appsdk_exampleyamls_help"])
+
+def check_startup_imports(names):
+    """
+    Run the startup code of names in a new python3 and return the
+    errors of the unexpected modules it imported, which needs no baseline
+    """
+    errors = []
+    for name in names:
+        code = "import sys, json\ntry:\n    exec(%r)\nexcept SystemExit:\n    pass\n" \
+               "print('\\nMODULES: ' + json.dumps(sorted(sys.modules)))" % STARTUP_CODES[name]
+        try:
+            output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            errors.append("%s exited with %d" % (name, e.returncode))
+            continue
+        modules = json.loads(output.rsplit("\nMODULES: ", 1)[1])
+        imported = [m for m in modules
+                    if any(m == u or m.startswith(u + ".") for u in STARTUP_UNEXPECTED_MODULES)]
+        if imported:
+            errors.append("%s imported %s" % (name, " ".join(imported)))
+    return errors
+
+def run_benchmarks(names, fixtures, repeat):
+    """
+    Run each benchmark repeat times, return a dict of name -> the best
+    seconds
+    """
+    results = collections.OrderedDict()
+    for name in names:
+        tmpdir = tempfile.mkdtemp(prefix="bench-%s-" % name)
+        try:
+            func = BENCHMARKS[name](fixtures, tmpdir)
+            timings = []
+            for _ in range(repeat):
+                gc.collect()
+                start = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(tmpdir)
+        results[name] = min(timings)
+    return results
+
+def load_baseline(baseline_file, scale):
+    try:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+    if baseline.get("version") != BASELINE_VERSION or baseline.get("scale") != scale:
+        logger.warning("Baseline %s is not of version %d and scale %s, ignore it", baseline_file, BASELINE_VERSION, scale)
+        return None
+    return baseline["results"]
+
+def save_baseline(baseline_file, scale, results):
+    baseline = {"version": BASELINE_VERSION, "scale": scale, "results": results}
+    with open(baseline_file, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+    logger.info("Saved baseline to %s", baseline_file)
+
+def report(results, baseline, threshold):
+    """
+    Print the results against the baseline, return the names of the
+    regressions
+    """
+    regressions = []
+    print("%-36s %10s %10s %8s" % ("benchmark", "seconds", "baseline", "ratio"))
+    for name, seconds in results.items():
+        base = baseline.get(name) if baseline else None
+        if not base:
+            print("%-36s %10.3f %10s %8s" % (name, seconds, "-", "-"))
+            continue
+        ratio = seconds / base
+        status = ""
+        if ratio > 1 + threshold:
+            status = " REGRESSION"
+            regressions.append(name)
+        print("%-36s %10.3f %10.3f %7.2fx%s" % (name, seconds, base, ratio, status))
+    return regressions
+
+def set_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            description='Benchmark genimage and appsdk against synthetic fixtures',
+            epilog='Run it with the python3 of the native sysroot where genimage and appsdk are installed')
+    parser.add_argument('-k', '--filter',
+        default='*',
+        help='Only run the benchmarks whose names match this glob pattern, default is all')
+    parser.add_argument('--list',
+        action='store_true',
+        help='List the benchmarks and exit')
+    parser.add_argument('--fixtures-dir',
+        default=DEFAULT_FIXTURES_DIR,
+        help='The dir of generated fixtures, default is %s' % DEFAULT_FIXTURES_DIR)
+    parser.add_argument('--regenerate',
+        action='store_true',
+        help='Generate the fixtures again even if they exist')
+    parser.add_argument('--scale',
+        default=1.0, type=float,
+        help='Scale the sizes of fixtures, 1.0 generates a rootfs of 100k files and 5k dpkg packages')
+    parser.add_argument('-r', '--repeat',
+        default=3, type=int,
+        help='Run each benchmark this times and take the best, default is 3')
+    parser.add_argument('--baseline',
+        default=DEFAULT_BASELINE,
+        help='The baseline to compare with, default is %s' % DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline',
+        action='store_true',
+        help='Save the results as the new baseline')
+    parser.add_argument('--check-imports',
+        action='store_true',
+        help='Only check the startup benchmarks do not import %s, and exit' % ' '.join(STARTUP_UNEXPECTED_MODULES))
+    parser.add_argument('--threshold',
+        default=0.2, type=float,
+        help='Report a regression if a benchmark is slower than the baseline by this ratio, default is 0.2')
+    parser.add_argument('-d', '--debug',
+        action='store_true',
+        help='Print the logs of genimage and appsdk')
+    return parser
+
+def main():
+    args = set_parser().parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    names = [name for name in BENCHMARKS if fnmatch.fnmatch(name, args.filter)]
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        sys.exit(0)
+    if not names:
+        logger.error("No benchmark matches %s", args.filter)
+        sys.exit(1)
+
+    try:
+        import genimage.constant
+    except ImportError as e:
+        logger.error("%s\nRun it with the python3 of the native sysroot where genimage and appsdk are installed", e)
+        sys.exit(1)
+
+    # The startup imports are checked on every run, they do not depend
+    # on the timing
+    import_errors = check_startup_imports([name for name in names if name in STARTUP_CODES])
+    for error in import_errors:
+        logger.error("Startup import check: %s", error)
+    if args.check_imports:
+        sys.exit(1 if import_errors else 0)
+
+    fixtures = Fixtures(args.fixtures_dir, args.scale)
+    fixtures.generate(args.regenerate)
+
+    # Keep the output of benchmarks from the logs of code under test
+    if not args.debug:
+        logger.setLevel(logging.ERROR)
+    results = run_benchmarks(names, fixtures, args.repeat)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    baseline = load_baseline(args.baseline, args.scale)
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        # Keep the baseline of the benchmarks not run this time
+        save_baseline(args.baseline, args.scale, dict(baseline or {}, **results))
+    elif regressions:
+        logger.error("Regressions: %s", " ".join(regressions))
+        sys.exit(1)
+    if import_errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
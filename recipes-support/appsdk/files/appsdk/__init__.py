@@ -40,9 +40,6 @@ import argparse
 import argcomplete
 import re
 import logging
-from appsdk.appsdk import AppSDK
-from genimage.utils import set_logger
-import genimage.utils as utils
 import genimage
 
 logger = logging.getLogger('appsdk')
@@ -102,23 +99,10 @@ def main():
 
     set_subparser(subparsers)
 
-    # Add genimage to appsdk
-    genimage.set_subparser(subparsers)
-
-    # Add geninitramfs to appsdk
-    genimage.set_subparser_geninitramfs(subparsers)
-
-    # Add gencontainer to appsdk
-    genimage.set_subparser_gencontainer(subparsers)
-
-    # Add genyaml to appsdk
-    genimage.set_subparser_genyaml(subparsers)
-
-    # Add exampleyamls to appsdk
-    genimage.set_subparser_exampleyamls(subparsers)
-
-    # Add genfitimage to appsdk
-    genimage.set_subparser_genfitimage(subparsers)
+    # Add genimage, geninitramfs, gencontainer, genyaml, exampleyamls,
+    # genfitimage and benchinitramfs to appsdk, only the subcommand in
+    # the command line imports its module
+    genimage.set_subparsers(subparsers)
 
     argcomplete.autocomplete(parser)
 
@@ -127,23 +111,29 @@ def main():
         parser.exit(1)
 
     args = parser.parse_args()
+    from genimage.utils import set_logger
     set_logger(logger, level=args.loglevel, log_path=args.logdir)
     args.func(args)
 
+def _new_appsdk():
+    # appsdk.appsdk imports rootfs and the package managers
+    from appsdk.appsdk import AppSDK
+    return AppSDK()
+
 def gensdk(args):
-    appsdk = AppSDK()
+    appsdk = _new_appsdk()
     appsdk.generate_sdk(args.file, args.output)
 
 def checksdk(args):
-    appsdk = AppSDK()
+    appsdk = _new_appsdk()
     appsdk.check_sdk()
 
 def buildrpm(args):
-    appsdk = AppSDK()
+    appsdk = _new_appsdk()
     appsdk.buildrpm(args.file, args.installdir, rpmdir=args.outputdir, pkgarch=args.pkgarch)
 
 def publishrpm(args):
-    appsdk = AppSDK()
+    appsdk = _new_appsdk()
     appsdk.publishrpm(args.repo, args.rpms)
     
 if __name__ == "__main__":
@@ -39,32 +39,88 @@ def add_path():
 
 add_path()
 
-from genimage.genimage import set_subparser
-from genimage.genyaml import set_subparser_genyaml
-from genimage.exampleyamls import set_subparser_exampleyamls
-from genimage.geninitramfs import set_subparser_geninitramfs
-from genimage.gencontainer import set_subparser_gencontainer
-from genimage.genfitimage import set_subparser_genfitimage
+import importlib
+import collections
 
-from genimage.genimage import main
-from genimage.genyaml import main_genyaml
-from genimage.exampleyamls import main_exampleyamls
-from genimage.geninitramfs import main_geninitramfs
-from genimage.gencontainer import main_gencontainer
-from genimage.genfitimage import main_genfitimage
+class Subcommand(object):
+    """
+    A subcommand which is declared without importing its module, the
+    module is only imported when the subcommand runs or its options are
+    parsed
+    """
+    def __init__(self, name, module, help, main_name, set_subparser_name):
+        self.name = name
+        self.module = module
+        self.help = help
+        self.main_name = main_name
+        self.set_subparser_name = set_subparser_name
 
-__all__ = [
-    "set_subparser",
-    "set_subparser_exampleyamls",
-    "set_subparser_genyaml",
-    "set_subparser_geninitramfs",
-    "set_subparser_gencontainer",
-    "main",
-    "main_exampleyamls",
-    "main_genyaml",
-    "main_geninitramfs",
-    "main_gencontainer",
-    "main_genfitimage",
-]
+    def load(self, func_name):
+        return getattr(importlib.import_module(self.module), func_name)
 
+    def set_subparser(self, subparsers, lazy=False):
+        """
+        Add the subparser, if lazy, only the name and help are added
+        """
+        if lazy:
+            subparsers.add_parser(self.name, help=self.help)
+        else:
+            self.load(self.set_subparser_name)(subparsers)
 
+SUBCOMMANDS = collections.OrderedDict((s.name, s) for s in [
+    Subcommand('genimage', 'genimage.genimage',
+               'Generate images from package feeds for specified machines',
+               'main', 'set_subparser'),
+    Subcommand('geninitramfs', 'genimage.geninitramfs',
+               'Generate Initramfs from package feeds for specified machines',
+               'main_geninitramfs', 'set_subparser_geninitramfs'),
+    Subcommand('gencontainer', 'genimage.gencontainer',
+               'Generate Container Image from package feeds for specified machines',
+               'main_gencontainer', 'set_subparser_gencontainer'),
+    Subcommand('genyaml', 'genimage.genyaml',
+               'Generate Yaml file from Input Yamls',
+               'main_genyaml', 'set_subparser_genyaml'),
+    Subcommand('exampleyamls', 'genimage.exampleyamls',
+               'Deploy Example Yaml files',
+               'main_exampleyamls', 'set_subparser_exampleyamls'),
+    Subcommand('genfitimage', 'genimage.genfitimage',
+               'Generate FIT Image from package feeds for specified machines',
+               'main_genfitimage', 'set_subparser_genfitimage'),
+    Subcommand('benchinitramfs', 'genimage.compress',
+               'Benchmark compression of initramfs',
+               'main_benchinitramfs', 'set_subparser_benchinitramfs'),
+])
+
+def get_command_words(argv=None):
+    """
+    Return the words of the command line, which is being completed if it
+    is run by argcomplete
+    """
+    if '_ARGCOMPLETE' in os.environ and 'COMP_LINE' in os.environ:
+        comp_line = os.environ['COMP_LINE'][:int(os.environ.get('COMP_POINT', len(os.environ['COMP_LINE'])))]
+        return comp_line.split()[1:]
+    return sys.argv[1:] if argv is None else argv
+
+def set_subparsers(subparsers, argv=None):
+    """
+    Add the subparsers of SUBCOMMANDS, only the one in the command line
+    is complete, the others are lazy
+    """
+    words = get_command_words(argv)
+    selected = next((w for w in words if w in SUBCOMMANDS), None)
+    for name, subcommand in SUBCOMMANDS.items():
+        subcommand.set_subparser(subparsers, lazy=(name != selected))
+
+def _lazy_func(subcommand, func_name):
+    def func(*args, **kwargs):
+        return subcommand.load(func_name)(*args, **kwargs)
+    func.__name__ = func_name
+    return func
+
+# The entry points of console_scripts and the set_subparser* of appsdk,
+# each imports its module on the first call
+__all__ = ["SUBCOMMANDS", "set_subparsers"]
+for _subcommand in SUBCOMMANDS.values():
+    for _func_name in (_subcommand.main_name, _subcommand.set_subparser_name):
+        globals()[_func_name] = _lazy_func(_subcommand, _func_name)
+        __all__.append(_func_name)
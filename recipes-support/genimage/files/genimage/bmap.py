@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import logging
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger('appsdk')
+
+BMAP_COPY_SIZE = 4 * 1024 * 1024
+
+class Bmap(object):
+    """
+    Block map of an image created by `bmaptool create', version 1.x or 2.x
+    """
+    def __init__(self, bmap_file):
+        root = ET.parse(bmap_file).getroot()
+        self.image_size = int(root.findtext("ImageSize").strip())
+        self.block_size = int(root.findtext("BlockSize").strip())
+        self.ranges = []
+        for r in root.find("BlockMap").findall("Range"):
+            text = r.text.strip()
+            if '-' in text:
+                first, last = text.split('-')
+            else:
+                first = last = text
+            self.ranges.append((int(first), int(last)))
+
+    def mapped_ranges(self):
+        """
+        Yield (offset, length) in bytes of the mapped ranges
+        """
+        for first, last in self.ranges:
+            offset = first * self.block_size
+            length = min((last + 1) * self.block_size, self.image_size) - offset
+            yield offset, length
+
+    @property
+    def mapped_size(self):
+        return sum(length for offset, length in self.mapped_ranges())
+
+def get_allocated_size(path):
+    return os.stat(path).st_blocks * 512
+
+def sparse_copy(bmap, src, dst):
+    """
+    Copy the mapped ranges of src to dst, the unmapped ranges are left as
+    holes. Only the mapped ranges of src are read.
+    """
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for offset, length in bmap.mapped_ranges():
+            fin.seek(offset)
+            fout.seek(offset)
+            while length > 0:
+                data = fin.read(min(length, BMAP_COPY_SIZE))
+                if not data:
+                    raise Exception("%s is shorter than its bmap" % src)
+                fout.write(data)
+                length -= len(data)
+        fout.truncate(bmap.image_size)
+    logger.debug("Copied %d bytes of %s to %s", bmap.mapped_size, src, dst)
@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import os.path
+import mmap
+import json
+import hashlib
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger('appsdk')
+
+CHECKSUM_CACHE_VERSION = 1
+SHA256SUMS_SUFFIX = ".SHA256SUMS"
+OSTREE_REPO = "ostree_repo"
+
+# Files smaller than this are read, the larger ones are mapped
+MMAP_MIN_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+def file_digest(path, algorithm="sha256"):
+    """
+    Return the hex digest of the content of path, hashlib releases the GIL
+    while hashing, so it could run in parallel threads
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_MIN_SIZE:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                h.update(chunk)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+    return h.hexdigest()
+
+class ChecksumCache(object):
+    """
+    Digests of files keyed by (dev, inode, size, mtime), so a file which
+    is not changed or is only renamed or linked is not hashed again.
+
+    Only the entries looked up since loaded are saved, the others are
+    dropped.
+    """
+    def __init__(self, cache_file, algorithm="sha256"):
+        self.cache_file = cache_file
+        self.algorithm = algorithm
+        self.entries = dict()
+        self.used = dict()
+        self.lock = threading.Lock()
+
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+                if cache.get("version") == CHECKSUM_CACHE_VERSION:
+                    self.entries = cache.get(algorithm, dict())
+            except ValueError:
+                logger.debug("Invalid checksum cache %s, ignore it" % cache_file)
+
+    @staticmethod
+    def _key(st):
+        return "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = self._key(st)
+        with self.lock:
+            digest = self.entries.get(key)
+        if digest is None:
+            digest = file_digest(path, self.algorithm)
+            # The file changed while hashing, do not cache it
+            if self._key(os.stat(path)) != key:
+                return digest
+        with self.lock:
+            self.used[key] = digest
+        return digest
+
+    def save(self):
+        if not self.cache_file:
+            return
+        tmp_file = "%s.tmp-%d" % (self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({"version": CHECKSUM_CACHE_VERSION, self.algorithm: self.used}, f, separators=(',', ':'))
+        os.replace(tmp_file, self.cache_file)
+
+def hash_files(paths, cache, jobs=None):
+    """
+    Hash paths in parallel threads, return a dict of path -> digest
+    """
+    digests = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(cache.digest, path): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            digests[futures[future]] = future.result()
+    return digests
+
+def snapshot_files(topdir, exclude_dirs=()):
+    """
+    Return a dict of the relative path -> (inode, size, mtime) of the files
+    and symlinks under topdir, the dirs in exclude_dirs are not walked
+    """
+    snapshot = dict()
+    for root, dirs, files in os.walk(topdir):
+        if root == topdir:
+            dirs[:] = [d for d in dirs if d not in exclude_dirs]
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[os.path.relpath(path, topdir)] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return snapshot
+
+def _read_sha256sums(sums):
+    names = []
+    if os.path.exists(sums):
+        with open(sums, 'r') as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if "  " in line:
+                    names.append(line.split("  ", 1)[1])
+    return names
+
+def write_sha256sums(deploydir, sums_name, snapshot=None, cache_file=None, jobs=None, exclude_dirs=(OSTREE_REPO,)):
+    """
+    Write sums_name in deploydir in the format of `sha256sum -c', it covers
+    the files and symlinks to files which are created or changed since the
+    snapshot of deploydir was taken, and the ones listed by the previous
+    sums_name which are still there.
+
+    The ostree repo is excluded, ostree verifies its objects by itself.
+    """
+    sums = os.path.join(deploydir, sums_name)
+    current = snapshot_files(deploydir, exclude_dirs)
+    names = set(_read_sha256sums(sums))
+    for name, key in current.items():
+        if snapshot is None or snapshot.get(name) != key:
+            names.add(name)
+
+    paths = dict()
+    for name in names:
+        path = os.path.join(deploydir, name)
+        if name in current and not name.endswith(SHA256SUMS_SUFFIX) and os.path.isfile(path):
+            paths[name] = path
+
+    cache = ChecksumCache(cache_file)
+    digests = hash_files(paths.values(), cache, jobs)
+    cache.save()
+
+    tmp_sums = "%s.tmp-%d" % (sums, os.getpid())
+    with open(tmp_sums, 'w') as f:
+        for name in sorted(paths):
+            f.write("%s  %s\n" % (digests[paths[name]], name))
+    os.replace(tmp_sums, sums)
+    logger.debug("Wrote checksums of %d files to %s", len(paths), sums)
+    return sums
@@ -0,0 +1,196 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import sys
+import time
+import shutil
+import argparse
+import argcomplete
+import logging
+import subprocess
+import tempfile
+from collections import OrderedDict
+from texttable import Texttable
+
+from genimage.utils import set_logger
+from genimage.cpio import create_cpio
+
+logger = logging.getLogger('appsdk')
+
+class Compressor(object):
+    """
+    A compression tool which reads stdin and writes stdout, the options
+    produce the same output for the same input, with multiple threads if
+    the tool supports it, and in a format the kernel initramfs unpacker
+    accepts.
+    """
+    def __init__(self, name, ext, magic, compress_cmd, decompress_cmd):
+        self.name = name
+        self.ext = ext
+        self.magic = magic
+        self.compress_cmd = compress_cmd
+        self.decompress_cmd = decompress_cmd
+
+    def available(self):
+        return shutil.which(self.compress_cmd[0]) is not None
+
+COMPRESSORS = OrderedDict((c.name, c) for c in [
+    Compressor("gzip", ".gz", b"\x1f\x8b",
+               ["pigz", "-f", "-9", "-n", "-c", "--rsyncable"],
+               ["pigz", "-d", "-c"]),
+    # No long distance matching, the kernel unpacker allocates the whole
+    # window, the 8M window of level 19 keeps small RAM targets booting
+    Compressor("zstd", ".zst", b"\x28\xb5\x2f\xfd",
+               ["zstd", "-q", "-19", "-T0", "-c"],
+               ["zstd", "-q", "-d", "-c"]),
+    # The kernel only verifies crc32, a fixed block size keeps the output
+    # the same regardless of the number of threads
+    Compressor("xz", ".xz", b"\xfd7zXZ\x00",
+               ["xz", "-q", "-9", "--check=crc32", "-T0", "--block-size=16MiB", "-c"],
+               ["xz", "-q", "-d", "-c"]),
+    # The kernel only accepts the legacy lz4 frame format
+    Compressor("lz4", ".lz4", b"\x02\x21\x4c\x18",
+               ["lz4", "-q", "-l", "-9", "-c"],
+               ["lz4", "-q", "-d", "-c"]),
+])
+
+DEFAULT_COMPRESSION = "gzip"
+
+def get_compressor(name=None):
+    name = name or DEFAULT_COMPRESSION
+    if name not in COMPRESSORS:
+        raise Exception("Compression %s is not supported, choose from %s" % (name, ' '.join(COMPRESSORS)))
+    return COMPRESSORS[name]
+
+def detect_compressor(path):
+    with open(path, "rb") as f:
+        head = f.read(8)
+    for compressor in COMPRESSORS.values():
+        if head.startswith(compressor.magic):
+            return compressor
+    return None
+
+def _run_timed(cmd, in_path, out_path):
+    start = time.monotonic()
+    with open(in_path, "rb") as fin, open(out_path, "wb") as fout:
+        res = subprocess.call(cmd, stdin=fin, stdout=fout)
+    if res:
+        raise Exception("Executing %s failed, exit code %d" % (' '.join(cmd), res))
+    return time.monotonic() - start
+
+def benchmark(path, names, workdir):
+    """
+    Compress the cpio archive of path (a rootfs dir, or an initramfs which
+    is compressed or not) with each compressor of names, return rows of
+    (name, size, compress seconds, decompress seconds)
+    """
+    cpio = os.path.join(workdir, "initramfs.cpio")
+    if os.path.isdir(path):
+        logger.info("Creating cpio archive of %s", path)
+        create_cpio(path, cpio, ["cat"])
+    else:
+        compressor = detect_compressor(path)
+        if compressor is None:
+            shutil.copyfile(path, cpio)
+        else:
+            _run_timed(compressor.decompress_cmd, path, cpio)
+
+    rows = [("none", os.path.getsize(cpio), 0.0, 0.0)]
+    for name in names:
+        compressor = get_compressor(name)
+        if not compressor.available():
+            logger.warning("%s is not found, skip %s", compressor.compress_cmd[0], name)
+            continue
+        logger.info("Benchmarking %s", name)
+        archive = cpio + compressor.ext
+        compress_time = _run_timed(compressor.compress_cmd, cpio, archive)
+        decompress_time = _run_timed(compressor.decompress_cmd, archive, os.devnull)
+        rows.append((name, os.path.getsize(archive), compress_time, decompress_time))
+        os.unlink(archive)
+    return rows
+
+def set_parser_benchinitramfs(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            description='Benchmark compression of initramfs',
+            epilog='Use %(prog)s --help to get help')
+        parser.add_argument('-d', '--debug',
+            help = "Enable debug output",
+            action='store_const', const=logging.DEBUG, dest='loglevel', default=logging.INFO)
+        parser.add_argument('-q', '--quiet',
+            help = 'Hide all output except error messages',
+            action='store_const', const=logging.ERROR, dest='loglevel')
+
+        parser.add_argument('--log-dir',
+            default=None,
+            dest='logdir',
+            help='Specify dir to save debug messages as log.appsdk regardless of the logging level',
+            action='store')
+
+    parser.add_argument('-c', '--compression',
+        choices=list(COMPRESSORS),
+        help='Specify compression to benchmark, default is all of them',
+        action='append')
+
+    parser.add_argument('-w', '--workdir',
+        default=os.getcwd(),
+        help='Specify work dir for temporary archives, default is current working directory',
+        action='store')
+
+    parser.add_argument('input',
+        help='An initramfs image or a rootfs dir')
+
+    return parser
+
+def _main_run(args):
+    if not os.path.exists(args.input):
+        logger.error("%s does not exist", args.input)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory(prefix="benchinitramfs-", dir=args.workdir) as workdir:
+        rows = benchmark(args.input, args.compression or list(COMPRESSORS), workdir)
+
+    table = Texttable()
+    table.set_cols_align(["l", "r", "r", "r", "r"])
+    table.set_cols_dtype(["t", "t", "t", "t", "t"])
+    table.add_row(["Compression", "Size", "Ratio", "Compress", "Decompress"])
+    base_size = rows[0][1] or 1
+    for name, size, compress_time, decompress_time in rows:
+        table.add_row([name,
+                       "%.1fM" % (size / 1024 / 1024),
+                       "%.1f%%" % (size * 100 / base_size),
+                       "%.2fs" % compress_time,
+                       "%.2fs" % decompress_time])
+    logger.info("Initramfs compression of %s\n%s", args.input, table.draw())
+
+def main_benchinitramfs():
+    parser = set_parser_benchinitramfs()
+    parser.set_defaults(func=_main_run)
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    set_logger(logger, level=args.loglevel, log_path=args.logdir)
+    args.func(args)
+
+def set_subparser_benchinitramfs(subparsers=None):
+    if subparsers is None:
+        sys.exit(1)
+    parser_benchinitramfs = subparsers.add_parser('benchinitramfs', help='Benchmark compression of initramfs')
+    parser_benchinitramfs = set_parser_benchinitramfs(parser_benchinitramfs)
+    parser_benchinitramfs.set_defaults(func=_main_run)
+
+if __name__ == "__main__":
+    main_benchinitramfs()
@@ -0,0 +1,203 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Streaming writer of newc cpio archives, which generates the same archive
+as `find . | sort | cpio --reproducible -o -H newc'.
+
+It does not import genimage, so it can run as a standalone script in a
+child process, where the file ownership is faked by pseudo:
+
+    python3 cpio.py <rootdir> [<name>...] > archive.cpio
+"""
+import os
+import sys
+import stat
+import locale
+import logging
+import subprocess
+
+logger = logging.getLogger('appsdk')
+
+CPIO_READ_SIZE = 1024 * 1024
+CPIO_BLOCK_SIZE = 512
+CPIO_TRAILER = "TRAILER!!!"
+
+def _sort_key(path):
+    # The same order as sort(1) in the current locale, ties are broken
+    # by bytes
+    try:
+        return (locale.strxfrm(path), os.fsencode(path))
+    except (ValueError, UnicodeError):
+        return (path, os.fsencode(path))
+
+def list_tree(rootdir, names=None):
+    """
+    Walk rootdir once, return the sorted paths as printed by `find .', or
+    by `find name...' if names of the top entries are set
+    """
+    if names:
+        paths = [name for name in names if os.path.lexists(os.path.join(rootdir, name))]
+        dirs = [name for name in paths if os.path.isdir(os.path.join(rootdir, name))
+                                           and not os.path.islink(os.path.join(rootdir, name))]
+    else:
+        paths = ["."]
+        dirs = ["."]
+    while dirs:
+        d = dirs.pop()
+        with os.scandir(os.path.join(rootdir, d)) as it:
+            for entry in it:
+                path = d + "/" + entry.name
+                paths.append(path)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(path)
+    paths.sort(key=_sort_key)
+    return paths
+
+class CpioWriter(object):
+    """
+    Write newc entries with renumbered inodes and without device numbers,
+    like `cpio --reproducible'. The data of hard linked files is written
+    with the last link, as cpio does.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.next_ino = 0
+        self.inodes = dict()
+        self.deferred = dict()
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def _pad(self, align):
+        if self.offset % align:
+            self._write(b"\0" * (align - self.offset % align))
+
+    def _write_header(self, name, ino, st, filesize):
+        name = os.fsencode(name) + b"\0"
+        if st is None:
+            mode = uid = gid = mtime = rdevmajor = rdevminor = 0
+            nlink = 1
+        else:
+            mode, uid, gid, nlink, mtime = st.st_mode, st.st_uid, st.st_gid, st.st_nlink, int(st.st_mtime)
+            rdevmajor, rdevminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+        header = "070701%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X" % \
+            (ino, mode, uid, gid, nlink, mtime, filesize, 0, 0, rdevmajor, rdevminor, len(name), 0)
+        self._write(header.encode() + name)
+        self._pad(4)
+
+    def _write_file(self, path):
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(CPIO_READ_SIZE)
+                if not data:
+                    break
+                self._write(data)
+        self._pad(4)
+
+    def _get_ino(self, st):
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key not in self.inodes:
+                self.inodes[key] = self.next_ino
+                self.next_ino += 1
+            return self.inodes[key]
+        ino = self.next_ino
+        self.next_ino += 1
+        return ino
+
+    def add(self, rootdir, path):
+        full_path = os.path.join(rootdir, path)
+        st = os.lstat(full_path)
+        # Strip leading `./' as cpio does
+        name = path
+        while name.startswith("./"):
+            name = name[2:].lstrip("/")
+
+        ino = self._get_ino(st)
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            links = self.deferred.setdefault(key, [])
+            if len(links) + 1 < st.st_nlink:
+                links.append((name, ino, st, full_path))
+                return
+            # The last link, write the others without data
+            for link_name, link_ino, link_st, _ in links:
+                self._write_header(link_name, link_ino, link_st, 0)
+            del self.deferred[key]
+
+        if stat.S_ISLNK(st.st_mode):
+            target = os.fsencode(os.readlink(full_path))
+            self._write_header(name, ino, st, len(target))
+            self._write(target)
+            self._pad(4)
+        elif stat.S_ISREG(st.st_mode):
+            self._write_header(name, ino, st, st.st_size)
+            self._write_file(full_path)
+        else:
+            self._write_header(name, ino, st, 0)
+
+    def finish(self):
+        # The hard links whose other links are not in the archive
+        for links in self.deferred.values():
+            for link_name, link_ino, link_st, _ in links[:-1]:
+                self._write_header(link_name, link_ino, link_st, 0)
+            link_name, link_ino, link_st, link_path = links[-1]
+            self._write_header(link_name, link_ino, link_st, link_st.st_size)
+            self._write_file(link_path)
+        self.deferred = dict()
+
+        self._write_header(CPIO_TRAILER, 0, None, 0)
+        self._pad(CPIO_BLOCK_SIZE)
+        self.out.flush()
+
+def write_cpio(rootdir, out, names=None):
+    """
+    Write the newc archive of rootdir to the binary file object out, only
+    the top entries in names are archived if it is set
+    """
+    writer = CpioWriter(out)
+    for path in list_tree(rootdir, names):
+        writer.add(rootdir, path)
+    writer.finish()
+
+def create_cpio(rootdir, archive, compress_cmd, names=None):
+    """
+    Create archive from rootdir, the newc stream is compressed by
+    compress_cmd (such as pigz) on the fly without an intermediate file.
+    The writer runs in a child process so pseudo works as it does for cpio.
+    """
+    logger.debug("Creating %s from %s" % (archive, rootdir))
+    with open(archive, "wb") as out:
+        writer = subprocess.Popen([sys.executable, os.path.abspath(__file__), rootdir] + (names or []),
+                                  stdout=subprocess.PIPE)
+        compressor = subprocess.Popen(compress_cmd, stdin=writer.stdout, stdout=out)
+        writer.stdout.close()
+        compressor_rc = compressor.wait()
+        writer_rc = writer.wait()
+
+    if writer_rc or compressor_rc:
+        raise Exception("Create %s failed, cpio writer exit code %d, %s exit code %d"
+                        % (archive, writer_rc, compress_cmd[0], compressor_rc))
+
+if __name__ == "__main__":
+    try:
+        locale.setlocale(locale.LC_COLLATE, "")
+    except locale.Error:
+        pass
+    write_cpio(sys.argv[1], sys.stdout.buffer, sys.argv[2:])
@@ -32,6 +32,12 @@ update_boot_scr() {
     fi
     tail -c+73 $rootfs/boot/boot.scr > $rootfs/boot/boot.scr.raw
 
+    # Remove the KERNEL_PARAMS appended by a previous run, so running it
+    # again on its own output makes no difference
+    if [ -n "${KERNEL_PARAMS}" ] ; then
+        perl -p -i -e 's#\Q $ENV{KERNEL_PARAMS}\E##g if /^setenv bootargs/' $rootfs/boot/boot.scr.raw
+    fi
+
     sed -i -e "/^setenv bootargs/s/console=[^ ^\"]*//g" \
            -e "s/^\(setenv bootargs .*\)\"$/\1 ${OSTREE_CONSOLE} ${KERNEL_PARAMS}\"/g" \
         $rootfs/boot/boot.scr.raw
@@ -40,6 +46,9 @@ update_boot_scr() {
         -e "s/^\(setenv instdef .*\)\"$/\1 ${OSTREE_CONSOLE}\"/g" \
         $rootfs/boot/boot.scr.raw
 
+    # Squeeze the spaces left by the removed console and KERNEL_PARAMS
+    sed -i -e "/^setenv \(bootargs\|instdef\)/s/  */ /g" $rootfs/boot/boot.scr.raw
+
     perl -p -i -e "s#^( *setenv BRANCH) .*#\$1 $branch# if (\$_ !~ /oBRANCH/) " $rootfs/boot/boot.scr.raw
     perl -p -i -e "s#^( *setenv URL) .*#\$1 $url# if (\$_ !~ /oURL/) " $rootfs/boot/boot.scr.raw
     perl -p -i -e "s#instab=[^ ]* #instab=$ab #" $rootfs/boot/boot.scr.raw
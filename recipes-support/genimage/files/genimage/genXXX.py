@@ -35,8 +35,18 @@ from genimage.constant import DEFAULT_LOCAL_PACKAGE_FEED
 from genimage.constant import DEFAULT_IMAGE_PKGTYPE
 from genimage.constant import SUPPORTED_PKGTYPES
 from genimage.rootfs import Rootfs
+from genimage.rootfs_cache import RootfsCache
+from genimage.rootfs_cache import DEFAULT_ROOTFS_CACHE_SIZE
+from genimage.checksum import write_sha256sums
+from genimage.checksum import snapshot_files
+from genimage.checksum import SHA256SUMS_SUFFIX
+from genimage.checksum import OSTREE_REPO
+from genimage.package_manager.cache import PackageCache
+from genimage.package_manager.cache import DEFAULT_PKG_CACHE_SIZE
+from genimage.package_manager.cache import MetadataCache
 
 import genimage.utils as utils
+import genimage.profiler as profiler
 
 logger = logging.getLogger('appsdk')
 
@@ -99,6 +109,46 @@ def set_parser(parser=None, supported_types=None):
         action='append').completer = complete_env
     parser.add_argument("--no-clean",
         help = "Do not cleanup previously generated rootfs in workdir", action="store_true", default=False)
+    parser.add_argument("--profile",
+        help = "Profile each phase and command, save the json and Chrome trace of the profile to deploy dir", action="store_true", default=False)
+    parser.add_argument("--incremental",
+        help = "Update previously generated rootfs in workdir by installing and removing the changed packages only, it implies --no-clean", action="store_true", default=False)
+    parser.add_argument("--script-jobs",
+        default=None,
+        type=int,
+        help='Specify the number of package maintainer scripts to run in parallel, the ones updating the same shared state run one by one, default is $SCRIPT_JOBS or 1',
+        action='store')
+    parser.add_argument("--intercept-jobs",
+        default=None,
+        type=int,
+        help='Specify the number of postinst intercept hooks to run in parallel, the conflicting ones run one by one, default is $INTERCEPT_JOBS or the number of cpus',
+        action='store')
+    parser.add_argument("--idempotent-post-scripts",
+        help = "The rootfs post scripts of yamls and --rootfs-post-script could run again on their own output, so --incremental could update the rootfs processed by them", action="store_true", default=False)
+    parser.add_argument("--rootfs-cache",
+        default=None,
+        help='Specify dir to cache installed rootfs, the cached rootfs is reused if packages, package feeds, pre scripts, environments and exclude packages are not changed',
+        action='store')
+    parser.add_argument("--rootfs-cache-size",
+        default=DEFAULT_ROOTFS_CACHE_SIZE,
+        type=int,
+        help='Specify max size (GB) of rootfs cache dir, the least recently used ones are removed, default is %(default)s',
+        action='store')
+    parser.add_argument("--pkg-cache",
+        default=None,
+        help='Specify dir to cache downloaded packages, it could be shared by images, workdirs and concurrent runs',
+        action='store')
+    parser.add_argument("--pkg-cache-size",
+        default=DEFAULT_PKG_CACHE_SIZE,
+        type=int,
+        help='Specify max size (GB) of package cache dir, the least recently used packages are removed, default is %(default)s',
+        action='store')
+    parser.add_argument("--metadata-cache",
+        default=None,
+        help='Specify dir to cache metadata of package feeds, the cached metadata is only refreshed when package feeds changed',
+        action='store')
+    parser.add_argument("--offline-metadata",
+        help = "Use metadata in --metadata-cache without accessing package feeds", action="store_true", default=False)
     parser.add_argument("--no-validate",
         help = "Do not validate parameters in Input yaml files", action="store_true", default=False)
 
@@ -158,6 +208,7 @@ class GenXXX(object, metaclass=ABCMeta):
         self.deploydir = os.path.join(self.outdir, "deploy")
         self.output_yaml = os.path.join(self.deploydir, "%s-%s.yaml" % (self.image_name, self.machine))
         utils.mkdirhier(self.deploydir)
+        self.deploy_snapshot = None
         self.workdir = os.path.realpath(os.path.join(self.args.workdir, "workdir"))
 
         self.target_rootfs = None
@@ -181,9 +232,18 @@ class GenXXX(object, metaclass=ABCMeta):
         logger.debug("Deploy Directory: %s" % self.outdir)
         logger.debug("Work Directory: %s" % self.workdir)
 
+        self._enable_profile()
+
         signal.signal(signal.SIGTERM, utils.signal_exit_handler)
         signal.signal(signal.SIGINT, utils.signal_exit_handler)
 
+    def _enable_profile(self):
+        if not self.args.profile:
+            return
+        utils.mkdirhier(self.workdir)
+        profiler.enable(os.path.join(self.workdir, "profile-events-%s.json" % self.image_name),
+                        os.path.join(self.deploydir, "%s-%s" % (self.image_name, self.machine)))
+
     @staticmethod
     def _get_pkg_type(args):
         yaml_files = []
@@ -252,6 +312,16 @@ class GenXXX(object, metaclass=ABCMeta):
         if self.args.env:
             self.data['environments'].extend(self.args.env)
 
+        # The package managers read them from environment
+        if self.args.script_jobs is not None:
+            os.environ['SCRIPT_JOBS'] = str(self.args.script_jobs)
+        if self.args.intercept_jobs is not None:
+            os.environ['INTERCEPT_JOBS'] = str(self.args.intercept_jobs)
+
+        # Keep the previous rootfs to update it, external debian rootfs does not support it
+        if self.args.incremental and self.pkg_type != "external-debian":
+            self.args.no_clean = True
+
     def _parse_amend(self):
         if self.data['machine'] != DEFAULT_MACHINE:
             logger.error("MACHINE %s is invalid, SDK is working for %s only" % (self.data['machine'], DEFAULT_MACHINE))
@@ -271,6 +341,8 @@ class GenXXX(object, metaclass=ABCMeta):
             logger.debug("Save Yaml FIle to : %s" % (self.output_yaml))
 
     def do_prepare(self):
+        # The checksums only cover the artifacts created or changed since now
+        self.deploy_snapshot = snapshot_files(self.deploydir, (OSTREE_REPO,))
         image_workdir = os.path.join(self.workdir, self.image_name)
         utils.mkdirhier(image_workdir)
         utils.fake_root(workdir=image_workdir)
@@ -283,13 +355,21 @@ class GenXXX(object, metaclass=ABCMeta):
     def do_post(self):
         pass
 
+    @show_task_info("Create Checksums")
+    def do_checksum(self):
+        sums_name = "%s-%s%s" % (self.image_name, self.machine, SHA256SUMS_SUFFIX)
+        sums = write_sha256sums(self.deploydir, sums_name, self.deploy_snapshot,
+                                os.path.join(self.workdir, "sha256-cache.json"))
+        logger.debug("Checksums of deploy artifacts: %s", sums)
+
     def _do_rootfs_pre(self, rootfs=None):
         if rootfs is None:
             return
 
         for script_cmd in self.rootfs_post_scripts:
             logger.debug("Add rootfs post script: %s", script_cmd)
-            rootfs.add_rootfs_post_scripts(script_cmd)
+            idempotent = self.args.idempotent_post_scripts or script_cmd == constant.DEFAULT_ROOTFS_POST_SCRIPT
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=idempotent)
 
         for script_cmd in self.rootfs_pre_scripts:
             logger.debug("Add rootfs pre script: %s", script_cmd)
@@ -300,6 +380,7 @@ class GenXXX(object, metaclass=ABCMeta):
             v = v.strip('"\'')
             logger.debug("Environment %s=%s", k, v)
             os.environ[k] = v
+            rootfs.add_environment(env)
 
     def _do_rootfs_post(self, rootfs=None):
         if rootfs is None:
@@ -316,6 +397,21 @@ class GenXXX(object, metaclass=ABCMeta):
 
         self.target_rootfs = rootfs.target_rootfs
 
+    def _get_pkg_cache(self):
+        if not self.args.pkg_cache:
+            return None
+        return PackageCache(self.args.pkg_cache, self.args.pkg_cache_size)
+
+    def _get_metadata_cache(self):
+        if not self.args.metadata_cache:
+            if self.args.offline_metadata:
+                logger.error("--offline-metadata requires --metadata-cache")
+                sys.exit(1)
+            return None
+        metadata_cache = MetadataCache(self.args.metadata_cache, self.args.offline_metadata)
+        os.environ['PSEUDO_IGNORE_PATHS'] += ",%s" % metadata_cache.cache_dir
+        return metadata_cache
+
     @show_task_info("Create Rootfs")
     def do_rootfs(self):
         workdir = os.path.join(self.workdir, self.image_name)
@@ -325,6 +421,11 @@ class GenXXX(object, metaclass=ABCMeta):
             pkg_globs = pkg_globs.replace(',', ' ')
         image_linguas = self.features.get("image_linguas", None)
 
+        rootfs_cache = None
+        if self.args.rootfs_cache:
+            rootfs_cache = RootfsCache(self.args.rootfs_cache, self.args.rootfs_cache_size)
+            os.environ['PSEUDO_IGNORE_PATHS'] += ",%s" % rootfs_cache.cache_dir
+
         rootfs = Rootfs(workdir,
                         self.data_dir,
                         self.machine,
@@ -335,7 +436,11 @@ class GenXXX(object, metaclass=ABCMeta):
                         remote_pkgdatadir=self.remote_pkgdatadir,
                         image_linguas=image_linguas,
                         pkgtype=self.pkg_type,
-                        pkg_globs=pkg_globs)
+                        pkg_globs=pkg_globs,
+                        rootfs_cache=rootfs_cache,
+                        incremental=self.args.incremental,
+                        pkg_cache=self._get_pkg_cache(),
+                        metadata_cache=self._get_metadata_cache())
 
         self._do_rootfs_pre(rootfs)
 
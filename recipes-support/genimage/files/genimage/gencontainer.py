@@ -26,6 +26,7 @@ import atexit
 from genimage.utils import set_logger
 from genimage.utils import show_task_info
 from genimage.constant import DEFAULT_CONTAINER_NAME
+from genimage.constant import DEFAULT_ROOTFS_POST_SCRIPT
 from genimage.constant import DEFAULT_CONTAINER_PACKAGES
 from genimage.constant import DEFAULT_OCI_CONTAINER_DATA
 from genimage.constant import DEFAULT_MACHINE
@@ -72,7 +73,7 @@ class GenContainer(GenXXX):
         self.data['external-packages'] = []
         self.data['include-default-packages'] = "1"
         self.data['rootfs-pre-scripts'] = ['echo "run script before do_rootfs in $IMAGE_ROOTFS"']
-        self.data['rootfs-post-scripts'] = ['echo "run script after do_rootfs in $IMAGE_ROOTFS"']
+        self.data['rootfs-post-scripts'] = [DEFAULT_ROOTFS_POST_SCRIPT]
         self.data['environments'] = ['NO_RECOMMENDATIONS="1"']
         self.data['container_oci'] = DEFAULT_OCI_CONTAINER_DATA
         self.data['container_upload_cmd'] = ""
@@ -196,7 +197,9 @@ class GenExtDebContainer(GenContainer):
                         debootstrap_key=self.debootstrap_key,
                         apt_keys=self.apt_keys,
                         external_packages=self.external_packages,
-                        exclude_packages=self.exclude_packages)
+                        exclude_packages=self.exclude_packages,
+                        pkg_cache=self._get_pkg_cache(),
+                        metadata_cache=self._get_metadata_cache())
 
         self._do_rootfs_pre(rootfs)
 
@@ -224,6 +227,7 @@ def _main_run_internal(args):
     create.do_image_container()
     create.do_upload()
     create.do_post()
+    create.do_checksum()
     create.do_report()
 
 def _main_run(args):
@@ -96,6 +96,8 @@ def set_parser(parser=None, supported_types=None):
         action='store')
     parser.add_argument("--no-clean",
         help = "Do not cleanup previously generated rootfs in workdir", action="store_true", default=False)
+    parser.add_argument("--profile",
+        help = "Profile each phase and command, save the json and Chrome trace of the profile to deploy dir", action="store_true", default=False)
     parser.add_argument("--no-validate",
         help = "Do not validate parameters in Input yaml files", action="store_true", default=False)
 
@@ -163,6 +165,8 @@ class GenFitImage(GenXXX):
         logger.debug("Deploy Directory: %s" % self.outdir)
         logger.debug("Work Directory: %s" % self.workdir)
 
+        self._enable_profile()
+
         signal.signal(signal.SIGTERM, utils.signal_exit_handler)
         signal.signal(signal.SIGINT, utils.signal_exit_handler)
 
@@ -589,7 +593,9 @@ class GenFitImage(GenXXX):
                         deploydir=self.deploydir,
                         gpg_path=self.data['gpg']['gpg_path'],
                         gpgid=self.data['gpg']['ostree']['gpgid'],
-                        gpg_password=self.data['gpg']['ostree']['gpg_password'])
+                        gpg_password=self.data['gpg']['ostree']['gpg_password'],
+                        static_deltas=self.data['ostree']['ostree_static_deltas'],
+                        prune_depth=self.data['ostree']['ostree_prune_depth'])
 
         ostree_repo.set_fit(ostree_kernel='fitimage', use_fit='1')
         ostree_repo.create()
@@ -649,6 +655,7 @@ def _main_run_internal(args):
     create.do_ostree_ota()
     create.do_image_wic()
     create.do_post()
+    create.do_checksum()
     create.do_report()
 
 def _main_run(args):
@@ -40,6 +40,8 @@ from genimage.image import CreateOstreeOTA
 from genimage.image import CreateBootfs
 from genimage.genXXX import GenXXX
 from genimage.genXXX import set_parser
+from genimage.scheduler import TaskScheduler
+from genimage.compress import detect_compressor
 
 import genimage.constant as constant
 from genimage.constant import DEFAULT_PACKAGE_FEED
@@ -99,6 +101,12 @@ def set_parser_genimage(parser=None):
              'such as ip=10.0.2.15::10.0.2.1:255.255.255.0:tgt:eth0:off:10.0.2.3:8.8.8.8',
         action='store').completer = complete_url
 
+    parser.add_argument('-j', '--jobs',
+        default=1,
+        type=int,
+        help='Specify the number of image types to generate in parallel, default is 1',
+        action='store')
+
     parser.add_argument('--install-kickstart-url',
         default=None,
         help='Specify kickstart url, it overrides \'install_kickstart_url\' in Yaml, default is None',
@@ -128,7 +136,7 @@ class GenImage(GenXXX):
         self.data['external-packages'] = []
         self.data['include-default-packages'] = "1"
         self.data['rootfs-pre-scripts'] = ['echo "run script before do_rootfs in $IMAGE_ROOTFS"']
-        self.data['rootfs-post-scripts'] = ['echo "run script after do_rootfs in $IMAGE_ROOTFS"']
+        self.data['rootfs-post-scripts'] = [constant.DEFAULT_ROOTFS_POST_SCRIPT]
         self.data['environments'] = ['NO_RECOMMENDATIONS="0"', 'KERNEL_PARAMS=%s'%constant.DEFAULT_KERNEL_PARAMS]
         self.data['ustart-post-script'] = constant.DEFAULT_USTART_POST_SCRIPT
         self.data['wic-post-script'] = constant.DEFAULT_WIC_POST_SCRIPT
@@ -372,28 +380,14 @@ class GenImage(GenXXX):
     @show_task_info("Create PXE Initramfs and Boot File")
     def do_image_pxe(self):
         # Create a initramfs with ostree_repo for PXE boot
-        pxe_rootfs = os.path.join(self.workdir, "pxe_rootfs")
-        if os.path.exists(pxe_rootfs):
-            utils.remove(os.path.join(pxe_rootfs), recurse=True)
-        utils.mkdirhier(pxe_rootfs)
-
         initrd_image = "{0}/{1}-{2}.cpio.gz".format(self.deploydir, os.environ['DEFAULT_INITRD_NAME'], self.machine)
         if not os.path.exists(initrd_image):
             logger.error("Initramfs image %s does not exist", initrd_image)
-
-        # Extract an existed initramfs
-        cmd = "gzip -dck %s | cpio -idm" % initrd_image
-        res, output = utils.run_cmd(cmd, shell=True, cwd=pxe_rootfs)
-        if res != 0:
-            logger.error(output)
             sys.exit(1)
 
+        ostree_repo = ""
         if not self.data["ostree"].get('ostree_remote_url') or not self.data["ostree"].get('install_net_mode'):
-            cmd = "cp -a %s/ostree_repo %s" % (self.deploydir, pxe_rootfs)
-            res, output = utils.run_cmd(cmd, shell=True)
-            if res != 0:
-                logger.error(output)
-                sys.exit(1)
+            ostree_repo = os.path.join(self.deploydir, "ostree_repo")
 
         entries = list()
         entries.append({'name': self.data['name'],
@@ -421,8 +415,10 @@ class GenImage(GenXXX):
         boot_params = self._get_boot_params(self.image_name, self.data["ostree"], image_type="pxe")
         pxe = CreatePXE(
                   image_name = self.image_name,
+                  workdir = self.workdir,
                   pxe_initrd_name = pxe_initrd_name,
-                  pxe_rootfs = pxe_rootfs,
+                  initrd_image = initrd_image,
+                  ostree_repo = ostree_repo,
                   machine = self.machine,
                   deploydir = self.deploydir,
                   grub_cfg = grub_cfg,
@@ -434,22 +430,15 @@ class GenImage(GenXXX):
 
         pxe.create()
 
-    @show_task_info("Create Vmdk Image")
-    def do_image_vmdk(self):
-        vmdk = CreateVMImage(image_name=self.image_name,
-                             machine=self.machine,
-                             deploydir=self.deploydir,
-                             pkg_type = self.pkg_type,
-                             vm_type="vmdk")
-        vmdk.create()
-
-    @show_task_info("Create Vdi Image")
-    def do_image_vdi(self):
-        vdi = CreateVMImage(image_name=self.image_name,
-                            machine=self.machine,
-                            deploydir=self.deploydir,
-                            vm_type="vdi")
-        vdi.create()
+    @show_task_info("Create Vmdk/Vdi Image")
+    def do_image_vm(self):
+        vm = CreateVMImage(image_name=self.image_name,
+                           machine=self.machine,
+                           deploydir=self.deploydir,
+                           workdir=self.workdir,
+                           pkg_type = self.pkg_type,
+                           vm_types=[t for t in ["vmdk", "vdi"] if t in self.image_type])
+        vm.create()
 
     @show_task_info("Create OSTree Repo")
     def do_ostree_repo(self):
@@ -463,7 +452,9 @@ class GenImage(GenXXX):
                         pkg_type = self.pkg_type,
                         gpg_path=self.data['gpg']['gpg_path'],
                         gpgid=self.data['gpg']['ostree']['gpgid'],
-                        gpg_password=self.data['gpg']['ostree']['gpg_password'])
+                        gpg_password=self.data['gpg']['ostree']['gpg_password'],
+                        static_deltas=self.data['ostree']['ostree_static_deltas'],
+                        prune_depth=self.data['ostree']['ostree_prune_depth'])
 
         ostree_repo.create()
 
@@ -631,12 +622,12 @@ class GenYoctoImage(GenImage):
                                                       self.image_name,
                                                       self.data["ostree"]['ostree_use_ab'],
                                                       self.data["ostree"]['ostree_remote_url'])
-            rootfs.add_rootfs_post_scripts(script_cmd)
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
         elif self.machine == "intel-x86-64" or self.machine == "amd-snowyowl-64":
             os.environ['OSTREE_CONSOLE'] = self.data["ostree"]['OSTREE_CONSOLE']
             script_cmd = os.path.join(self.data_dir, 'post_rootfs', 'update_grub_cfg.sh')
             script_cmd = "{0} {1}".format(script_cmd, rootfs.target_rootfs)
-            rootfs.add_rootfs_post_scripts(script_cmd)
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
 
         if 'systemd' in self.packages or 'systemd' in self.external_packages:
             script_cmd = os.path.join(self.data_dir, 'post_rootfs', 'set_systemd_default_target.sh')
@@ -644,16 +635,17 @@ class GenYoctoImage(GenImage):
                 script_cmd = "{0} {1} graphical.target".format(script_cmd, rootfs.target_rootfs)
             else:
                 script_cmd = "{0} {1} multi-user.target".format(script_cmd, rootfs.target_rootfs)
-            rootfs.add_rootfs_post_scripts(script_cmd)
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
 
             script_cmd = os.path.join(self.data_dir, 'post_rootfs', 'enable_dhcpcd_service.sh')
-            rootfs.add_rootfs_post_scripts(script_cmd)
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
 
         if "system" in self.data:
             script_cmd = os.path.join(self.data_dir, 'post_rootfs', 'add_sysdef_support.sh')
             script_cmd = "{0} {1}".format(script_cmd, rootfs.target_rootfs)
-            rootfs.add_rootfs_post_scripts(script_cmd)
-            self._sysdef_rootfs(rootfs.target_rootfs)
+            rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
+            # Install sysdef files after packages, so they are not in rootfs cache
+            rootfs.add_rootfs_post_funcs(lambda: self._sysdef_rootfs(rootfs.target_rootfs), idempotent=True)
 
     def _do_rootfs_post(self, rootfs=None):
         if rootfs is None:
@@ -713,6 +705,11 @@ class GenYoctoImage(GenImage):
             out += ", mode: %s" % f['mode'] if 'mode' in f else ""
             logger.info(out)
 
+        # Remove the scripts installed by the previous run on the same rootfs,
+        # the run on upgrade ones of other days included
+        for d in ["run_once.d", "run_always.d", "run_on_upgrade.d"]:
+            utils.remove(os.path.join(target_rootfs, "etc/sysdef", d), recurse=True)
+
         dst = os.path.join(target_rootfs, "etc/sysdef/run_once.d")
         sysdef.install_scripts(runonce_scripts, dst)
 
@@ -849,7 +846,9 @@ class GenExtDebImage(GenImage):
                         debootstrap_key=self.debootstrap_key,
                         apt_keys=self.apt_keys,
                         external_packages=self.external_packages,
-                        exclude_packages=self.exclude_packages)
+                        exclude_packages=self.exclude_packages,
+                        pkg_cache=self._get_pkg_cache(),
+                        metadata_cache=self._get_metadata_cache())
 
         self._do_rootfs_pre(rootfs)
 
@@ -968,7 +967,9 @@ class GenExtDebImage(GenImage):
                         deploydir=self.deploydir,
                         gpg_path=self.data['gpg']['gpg_path'],
                         gpgid=self.data['gpg']['ostree']['gpgid'],
-                        gpg_password=self.data['gpg']['ostree']['gpg_password'])
+                        gpg_password=self.data['gpg']['ostree']['gpg_password'],
+                        static_deltas=self.data['ostree']['ostree_static_deltas'],
+                        prune_depth=self.data['ostree']['ostree_prune_depth'])
 
         ostree_repo.create()
 
@@ -1040,7 +1041,9 @@ class GenExtDebImage(GenImage):
         utils.mkdirhier(miniboot_initramfs)
 
         # extract the stardard initramfs and remove the unneeded files
-        cmd = "cd %s && gzip -d --stdout %s | cpio -i -d -H newc" % (miniboot_initramfs, image)
+        compressor = detect_compressor(image)
+        decompress_cmd = ' '.join(compressor.decompress_cmd) if compressor else "cat"
+        cmd = "cd %s && %s %s | cpio -i -d -H newc" % (miniboot_initramfs, decompress_cmd, image)
         utils.run_cmd_oneshot(cmd)
 
         # Removing (not needed for initial boot):
@@ -1096,29 +1099,32 @@ def _main_run_internal(args):
     if pkg_type == "external-debian":
         create.do_ostree_mini_initramfs()
 
+    scheduler = TaskScheduler(jobs=args.jobs)
+
     # WIC image requires ostress repo
     if any(img_type in create.image_type for img_type in ["ostree-repo", "wic", "iso", "ustart", "vmdk", "vdi", "pxe"]):
-        create.do_ostree_repo()
+        scheduler.add_task("ostree_repo", create.do_ostree_repo, inputs=["rootfs", "initramfs"], outputs=["ostree_repo"])
 
     if "wic" in create.image_type or "vmdk" in create.image_type or "vdi" in create.image_type:
-        create.do_ostree_ota()
-        create.do_image_wic()
-        if "vmdk" in create.image_type:
-            create.do_image_vmdk()
-
-        if "vdi" in create.image_type:
-            create.do_image_vdi()
+        scheduler.add_task("ostree_ota", create.do_ostree_ota, inputs=["ostree_repo"], outputs=["ota"])
+        scheduler.add_task("image_wic", create.do_image_wic, inputs=["ota"], outputs=["wic"])
+        # Both vmdk and vdi are converted from the wic image at once
+        if "vmdk" in create.image_type or "vdi" in create.image_type:
+            scheduler.add_task("image_vm", create.do_image_vm, inputs=["wic"], outputs=["vmdk", "vdi"])
 
     if "iso" in create.image_type:
-        create.do_image_iso()
+        scheduler.add_task("image_iso", create.do_image_iso, inputs=["ostree_repo", "initramfs"], outputs=["iso"])
 
     if "pxe" in create.image_type:
-        create.do_image_pxe()
+        scheduler.add_task("image_pxe", create.do_image_pxe, inputs=["ostree_repo", "initramfs"], outputs=["pxe"])
 
     if "ustart" in create.image_type:
-        create.do_ustart_img()
+        scheduler.add_task("ustart_img", create.do_ustart_img, inputs=["ostree_repo", "initramfs"], outputs=["ustart"])
+
+    scheduler.run()
 
     create.do_post()
+    create.do_checksum()
     create.do_report()
 
 def _main_run(args):
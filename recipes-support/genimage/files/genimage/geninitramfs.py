@@ -35,6 +35,7 @@ from genimage.constant import DEFAULT_IMAGE_PKGTYPE
 from genimage.constant import DEFAULT_REMOTE_PKGDATADIR
 from genimage.constant import DEFAULT_IMAGE_FEATURES
 from genimage.image import CreateInitramfs
+from genimage.compress import DEFAULT_COMPRESSION
 from genimage.genXXX import set_parser
 from genimage.genXXX import GenXXX
 from genimage.rootfs import ExtDebRootfs
@@ -72,8 +73,9 @@ class GenInitramfs(GenXXX):
         self.data['external-packages'] = []
         self.data['include-default-packages'] = "1"
         self.data['rootfs-pre-scripts'] = ['echo "run script before do_rootfs in $IMAGE_ROOTFS"']
-        self.data['rootfs-post-scripts'] = ['echo "run script after do_rootfs in $IMAGE_ROOTFS"']
+        self.data['rootfs-post-scripts'] = [constant.DEFAULT_ROOTFS_POST_SCRIPT]
         self.data['environments'] = ['NO_RECOMMENDATIONS="1"']
+        self.data['initramfs_compression'] = DEFAULT_COMPRESSION
 
     def _parse_inputyamls(self):
         pykwalify_dir = os.path.join(os.environ['OECORE_NATIVE_SYSROOT'], 'usr/share/genimage/data/pykwalify')
@@ -95,7 +97,7 @@ class GenInitramfs(GenXXX):
 
         script_cmd = os.path.join(self.data_dir, 'post_rootfs', 'add_gpg_key.sh')
         script_cmd = "{0} {1} {2}".format(script_cmd, rootfs.target_rootfs, self.data['gpg']['gpg_path'])
-        rootfs.add_rootfs_post_scripts(script_cmd)
+        rootfs.add_rootfs_post_scripts(script_cmd, idempotent=True)
 
     def do_prepare(self):
         super(GenInitramfs, self).do_prepare()
@@ -121,7 +123,8 @@ class GenInitramfs(GenXXX):
                         machine = self.machine,
                         target_rootfs = self.target_rootfs,
                         pkg_type = self.pkg_type,
-                        deploydir = self.deploydir)
+                        deploydir = self.deploydir,
+                        compression = self.data['initramfs_compression'])
         initrd.create()
 
     def do_report(self):
@@ -200,7 +203,9 @@ class GenExtDebInitramfs(GenInitramfs):
                         debootstrap_key=self.debootstrap_key,
                         apt_keys=self.apt_keys,
                         external_packages=self.external_packages,
-                        exclude_packages=self.exclude_packages)
+                        exclude_packages=self.exclude_packages,
+                        pkg_cache=self._get_pkg_cache(),
+                        metadata_cache=self._get_metadata_cache())
 
         self._do_rootfs_pre(rootfs)
 
@@ -228,6 +233,7 @@ def _main_run_internal(args):
     create.do_ostree_initramfs()
 
     create.do_post()
+    create.do_checksum()
     create.do_report()
 
 def _main_run(args):
@@ -16,14 +16,25 @@
 #
 from abc import ABCMeta, abstractmethod
 import subprocess
+import sys
 import os
 import os.path
 import logging
 import shutil
-from tempfile import NamedTemporaryFile
+import glob
+import fcntl
+import hashlib
+import base64
+from tempfile import NamedTemporaryFile, mkstemp
 
 from genimage import utils
 from genimage import constant
+from genimage.cpio import create_cpio
+from genimage.compress import get_compressor
+from genimage.bmap import Bmap, get_allocated_size, sparse_copy
+from genimage.profiler import profiled
+from genimage.rootfs_cache import hash_file
+import genimage.ostree_cache as ostree_cache
 import genimage.debian_constant as deb_constant
 
 logger = logging.getLogger('appsdk')
@@ -125,13 +136,18 @@ class Image(object, metaclass=ABCMeta):
 
 
 class CreateInitramfs(Image):
+    def _set_allow_keys(self):
+        self.allowed_keys.update({"compression"})
+
     def _add_keys(self):
         self.date = utils.get_today()
         self.image_fullname = "%s-%s-%s" % (self.image_name, self.machine, self.date)
         self.image_linkname =  "%s-%s" % (self.image_name, self.machine)
+        self.compressor = get_compressor(self.compression)
+        self.image_archive = "%s.rootfs.cpio%s" % (self.image_fullname, self.compressor.ext)
 
     def create(self):
-        self._create_cpio_gz()
+        self._create_cpio()
         if self.machine in constant.SUPPORTED_ARM_MACHINES:
             self._create_uboot()
         self._create_symlinks()
@@ -143,34 +159,39 @@ class CreateInitramfs(Image):
         extra_args = ""
         if self.machine == "marvell-cn96xx":
             extra_args = "-f auto"
-        cmd = "cd %s && mkimage %s -A %s -O linux -T ramdisk -C none -n %s -d %s.rootfs.cpio.gz %s.rootfs.cpio.gz.u-boot" % \
-             (self.deploydir, extra_args, arch, self.image_fullname, self.image_fullname, self.image_fullname)
-        utils.run_cmd_oneshot(cmd)
-
-        cmd = "rm %s/%s.rootfs.cpio.gz" % (self.deploydir, self.image_fullname)
+        cmd = "cd %s && mkimage %s -A %s -O linux -T ramdisk -C none -n %s -d %s %s.u-boot" % \
+             (self.deploydir, extra_args, arch, self.image_fullname, self.image_archive, self.image_archive)
         utils.run_cmd_oneshot(cmd)
 
-    def _create_cpio_gz(self):
-        cmd = "cd %s && find . | sort | cpio --reproducible -o -H newc > %s/%s.rootfs.cpio" % \
-             (self.target_rootfs, self.deploydir, self.image_fullname)
+        cmd = "rm %s/%s" % (self.deploydir, self.image_archive)
         utils.run_cmd_oneshot(cmd)
 
-        cmd = "cd %s && pigz -f -9 -n -c --rsyncable %s.rootfs.cpio > %s.rootfs.cpio.gz && rm %s.rootfs.cpio" % \
-            (self.deploydir, self.image_fullname, self.image_fullname, self.image_fullname)
-        utils.run_cmd_oneshot(cmd)
+    @profiled("Create initramfs cpio")
+    def _create_cpio(self):
+        logger.debug("Compress initramfs with %s", self.compressor.name)
+        create_cpio(self.target_rootfs,
+                    os.path.join(self.deploydir, self.image_archive),
+                    self.compressor.compress_cmd)
 
     def _create_symlinks(self):
-        dst = os.path.join(self.deploydir, self.image_linkname + ".cpio.gz")
-        src = os.path.join(self.deploydir, self.image_fullname + ".rootfs.cpio.gz")
+        src = os.path.join(self.deploydir, self.image_archive)
+        # The .cpio.gz link is what the other images look for, keep it
+        # regardless of the compression, the kernel detects it by magic
+        dsts = [os.path.join(self.deploydir, self.image_linkname + ".cpio.gz")]
+        if self.compressor.ext != ".gz":
+            dsts.append(os.path.join(self.deploydir, self.image_linkname + ".cpio" + self.compressor.ext))
         if self.machine in constant.SUPPORTED_ARM_MACHINES:
-            dst = dst + ".u-boot"
+            dsts = [dst + ".u-boot" for dst in dsts]
             src = src + ".u-boot"
 
-        if os.path.exists(src):
-            logger.debug("Creating symlink: %s -> %s" % (dst, src))
-            utils.resymlink(os.path.basename(src), dst)
-        else:
-            logger.error("Skipping symlink, source does not exist: %s -> %s" % (dst, src))
+        for dst in dsts:
+            if os.path.exists(src):
+                logger.debug("Creating symlink: %s -> %s" % (dst, src))
+                # The old image is removed with the first link, the others
+                # pointed to the same one
+                utils.resymlink(os.path.basename(src), dst, rm_old_src=(dst == dsts[0]))
+            else:
+                logger.error("Skipping symlink, source does not exist: %s -> %s" % (dst, src))
 
 
 class CreateWicImage(Image):
@@ -243,7 +264,9 @@ class CreateWicImage(Image):
         if 'LD_PRELOAD' in wic_env:
             del wic_env['LD_PRELOAD']
         cmd = os.path.join(wic_env['OECORE_NATIVE_SYSROOT'], "usr/share/genimage/scripts/run.do_image_wic")
-        res, output = utils.run_cmd(cmd, env=wic_env)
+        res, output = utils.run_cmd(cmd, env=wic_env,
+                                    log_file=os.path.join(self.workdir, "log.do_image_wic"),
+                                    tail_size=utils.RUN_CMD_TAIL_SIZE)
         if res:
             raise Exception("Executing %s failed\nExit code %d. Output:\n%s"
                                % (cmd, res, output))
@@ -375,7 +398,9 @@ class CreateISOImage(Image):
         if 'LD_PRELOAD' in iso_env:
             del iso_env['LD_PRELOAD']
         cmd = "wic create --debug --image-name {0} {1}".format(self.image_name, self.wks_full_path)
-        res, output = utils.run_cmd(cmd, shell=True, cwd=self.workdir, env=iso_env)
+        res, output = utils.run_cmd(cmd, shell=True, cwd=self.workdir, env=iso_env,
+                                    log_file=os.path.join(self.workdir, "log.do_image_iso"),
+                                    tail_size=utils.RUN_CMD_TAIL_SIZE)
         if res:
             raise Exception("Executing %s failed\nExit code %d. Output:\n%s"
                                % (cmd, res, output))
@@ -403,8 +428,10 @@ class CreatePXE(Image):
                              'deploydir',
                              'machine',
                              'pkg_type',
+                             'workdir',
                              'pxe_initrd_name',
-                             'pxe_rootfs',
+                             'initrd_image',
+                             'ostree_repo',
                              'grub_cfg',
                              'syslinux_cfg',
                              'gpgid',
@@ -419,14 +446,73 @@ class CreatePXE(Image):
         self.tftp_dir = os.path.join(self.deploydir, "pxe_tftp_%s" % self.image_name)
         self.pxe_initrd = "{0}/{1}.cpio.gz".format(self.tftp_dir, self.pxe_initrd_name)
 
+    def _get_ostree_repo_key(self):
+        """
+        Return the key of ostree_repo, which covers all refs, the summary
+        and the static deltas, and whether the repo has refs
+        """
+        h = hashlib.sha256()
+        has_refs = False
+        for subdir in ["refs", "deltas"]:
+            top = os.path.join(self.ostree_repo, subdir)
+            for root, dirs, files in os.walk(top):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    h.update(os.path.relpath(path, self.ostree_repo).encode() + b"\0")
+                    if subdir == "refs":
+                        has_refs = True
+                        hash_file(path, h)
+                    else:
+                        st = os.stat(path)
+                        h.update(b"%d %d\0" % (st.st_size, st.st_mtime_ns))
+        for name in ["config", "summary", "summary.sig"]:
+            path = os.path.join(self.ostree_repo, name)
+            if os.path.exists(path):
+                h.update(name.encode() + b"\0")
+                hash_file(path, h)
+        return h.hexdigest(), has_refs
+
+    @profiled("Create PXE ostree repo cpio")
+    def _open_ostree_repo_cpio_gz(self):
+        """
+        Return the opened archive of ostree_repo, which is cached in workdir
+        by the key of the repo
+        """
+        key, has_refs = self._get_ostree_repo_key()
+        archive = os.path.join(self.workdir, "pxe-ostree_repo-%s.cpio.gz" % key)
+
+        # The archive is created, removed and opened under the lock, once
+        # opened, removing it by another run does not affect the reader
+        with open(os.path.join(self.workdir, "pxe-ostree_repo.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if has_refs and os.path.exists(archive):
+                logger.info("Reuse the archive of ostree_repo %s" % archive)
+                return open(archive, "rb")
+
+            for old in glob.glob(os.path.join(self.workdir, "pxe-ostree_repo-*")):
+                os.unlink(old)
+            fd, tmp_archive = mkstemp(prefix="pxe-ostree_repo-", suffix=".tmp", dir=self.workdir)
+            os.close(fd)
+            try:
+                create_cpio(os.path.dirname(self.ostree_repo), tmp_archive, get_compressor("gzip").compress_cmd,
+                            names=[os.path.basename(self.ostree_repo)])
+                os.rename(tmp_archive, archive)
+            finally:
+                if os.path.exists(tmp_archive):
+                    os.unlink(tmp_archive)
+            return open(archive, "rb")
+
+    @profiled("Create PXE initrd")
     def _create_pxe_cpio_gz(self):
-        cmd = "cd %s && find . | sort | cpio --reproducible -o -H newc > %s/%s.cpio" % \
-             (self.pxe_rootfs, self.tftp_dir, self.pxe_initrd_name)
-        utils.run_cmd_oneshot(cmd)
-
-        cmd = "cd %s && pigz -f -9 -n -c --rsyncable %s.cpio > %s.cpio.gz && rm %s.cpio" % \
-            (self.tftp_dir, self.pxe_initrd_name, self.pxe_initrd_name, self.pxe_initrd_name)
-        utils.run_cmd_oneshot(cmd)
+        # The kernel unpacks the concatenated compressed cpio archives in
+        # order, so the initramfs is reused as is and followed by ostree_repo
+        with open(self.pxe_initrd, "wb") as out:
+            with open(self.initrd_image, "rb") as f:
+                shutil.copyfileobj(f, out, utils.RUN_CMD_READ_SIZE)
+            if self.ostree_repo:
+                with self._open_ostree_repo_cpio_gz() as f:
+                    shutil.copyfileobj(f, out, utils.RUN_CMD_READ_SIZE)
 
     def create(self):
         utils.run_cmd_oneshot("rm %s -rf" % (self.tftp_dir))
@@ -507,28 +593,85 @@ class CreatePXE(Image):
                 logger.error("Skipping symlink, source does not exist: %s -> %s" % (dst, src))
 
 
+# The wic image is copied by its bmap if it has more allocated than this
+# beyond the mapped blocks
+VM_SPARSE_COPY_MIN_SIZE = 64 * 1024 * 1024
+
 class CreateVMImage(Image):
+    """
+    Convert the wic image to vm_types (or vm_type), each by a qemu-img
+    running concurrently
+    """
     def _set_allow_keys(self):
-        self.allowed_keys = {'image_name', 'machine', 'deploydir', 'vm_type', 'pkg_type'}
+        self.allowed_keys = {'image_name', 'machine', 'deploydir', 'workdir', 'vm_type', 'vm_types', 'pkg_type'}
 
     def _add_keys(self):
         self.date = utils.get_today()
         self.image_fullname = "%s-%s-%s" % (self.image_name, self.machine, self.date)
         self.image_linkname =  "%s-%s" % (self.image_name, self.machine)
+        if not self.vm_types:
+            self.vm_types = [self.vm_type]
+
+    @profiled("Copy wic image by bmap")
+    def _get_source(self, img):
+        """
+        qemu-img only reads the allocated extents of img. If img is not
+        sparse (such as it was copied by a tool which fills holes), copy
+        the ranges mapped by its bmap to a sparse file in workdir to
+        convert from, the caller removes it.
+        """
+        bmap_file = img + ".bmap"
+        if not os.path.exists(bmap_file):
+            return img
+
+        bmap = Bmap(bmap_file)
+        allocated_size = get_allocated_size(img)
+        logger.debug("%s has %d bytes allocated, %d bytes mapped", img, allocated_size, bmap.mapped_size)
+        if allocated_size - bmap.mapped_size < VM_SPARSE_COPY_MIN_SIZE:
+            return img
+
+        utils.mkdirhier(self.workdir)
+        sparse_img = os.path.join(self.workdir, os.path.basename(img) + ".sparse")
+        try:
+            sparse_copy(bmap, img, sparse_img)
+        except:
+            if os.path.exists(sparse_img):
+                os.unlink(sparse_img)
+            raise
+        return sparse_img
 
     def create(self):
         vm_env = os.environ.copy()
         if 'LD_PRELOAD' in vm_env:
             del vm_env['LD_PRELOAD']
         img = os.path.join(self.deploydir, "{0}.rootfs.wic".format(self.image_fullname))
-        cmd = "qemu-img convert -O {0} {1} {2}.{3}".format(self.vm_type, img, img, self.vm_type)
-        utils.run_cmd(cmd, shell=True, env=vm_env)
-
-        self._create_symlinks()
-
-    def _create_symlinks(self):
-        dst = os.path.join(self.deploydir, "{0}.wic.{1}".format(self.image_linkname, self.vm_type))
-        src = os.path.join(self.deploydir, "{0}.rootfs.wic.{1}".format(self.image_fullname, self.vm_type))
+        src = self._get_source(img)
+
+        errors = []
+        try:
+            procs = []
+            for vm_type in self.vm_types:
+                cmd = "qemu-img convert -O {0} {1} {2}.{3}".format(vm_type, src, img, vm_type)
+                logger.debug('Running %s' % cmd)
+                procs.append((cmd, subprocess.Popen(cmd, shell=True, env=vm_env, universal_newlines=True,
+                                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)))
+
+            for cmd, proc in procs:
+                output = proc.communicate()[0]
+                if proc.returncode:
+                    errors.append("Executing %s failed\nExit code %d. Output:\n%s" % (cmd, proc.returncode, output))
+        finally:
+            if src != img:
+                os.unlink(src)
+        if errors:
+            raise Exception('\n'.join(errors))
+
+        for vm_type in self.vm_types:
+            self._create_symlinks(vm_type)
+
+    def _create_symlinks(self, vm_type):
+        dst = os.path.join(self.deploydir, "{0}.wic.{1}".format(self.image_linkname, vm_type))
+        src = os.path.join(self.deploydir, "{0}.rootfs.wic.{1}".format(self.image_fullname, vm_type))
         if os.path.exists(src):
             logger.debug("Creating symlink: %s -> %s" % (dst, src))
             utils.resymlink(os.path.basename(src), dst)
@@ -538,7 +681,8 @@ class CreateVMImage(Image):
 
 class CreateOstreeRepo(Image):
     def _set_allow_keys(self):
-        self.allowed_keys.update({"gpgid", "gpg_password", "gpg_path", "image_manifest", "ostree_branchname"})
+        self.allowed_keys.update({"gpgid", "gpg_password", "gpg_path", "image_manifest", "ostree_branchname",
+                                  "static_deltas", "prune_depth"})
 
     def _add_keys(self):
         self.ostree_kernel = constant.OSTREE_KERNEL
@@ -572,11 +716,83 @@ class CreateOstreeRepo(Image):
         if self.image_manifest:
             ostreerepo_env['MANIFEST'] = self.image_manifest
 
+        ostreerepo_env['OSTREE_LINK_CACHE'] = "%s %s" % (sys.executable, os.path.abspath(ostree_cache.__file__))
+
         cmd = os.path.expandvars("$OECORE_NATIVE_SYSROOT/usr/share/genimage/scripts/run.do_image_ostree")
-        res, output = utils.run_cmd(cmd, env=ostreerepo_env)
+        res, output = utils.run_cmd(cmd, env=ostreerepo_env,
+                                    log_file=os.path.join(self.workdir, "log.do_image_ostree"),
+                                    tail_size=utils.RUN_CMD_TAIL_SIZE)
+        if res:
+            raise Exception("Executing %s failed\nExit code %d. Output:\n%s"
+                               % (cmd, res, output))
+
+        self._update_repo()
+
+    def _run_ostree(self, args):
+        repo = os.path.join(self.deploydir, "ostree_repo")
+        cmd = "flock %s.lock ostree --repo=%s %s" % (repo, repo, args)
+        res, output = utils.run_cmd(cmd, shell=True, print_output=False)
         if res:
             raise Exception("Executing %s failed\nExit code %d. Output:\n%s"
                                % (cmd, res, output))
+        return output
+
+    def _get_parents(self, commit, count):
+        repo = os.path.join(self.deploydir, "ostree_repo")
+        parents = []
+        while len(parents) < count:
+            res, output = utils.run_cmd("ostree --repo=%s rev-parse %s^" % (repo, commit),
+                                        shell=True, print_output=False)
+            if res:
+                break
+            commit = output.strip()
+            # The parent commit is pruned or not pulled
+            if not os.path.exists(os.path.join(repo, "objects", commit[:2], commit[2:] + ".commit")):
+                break
+            parents.append(commit)
+        return parents
+
+    def _get_delta_size(self, from_commit, to_commit):
+        # The same path as ostree, in the modified base64 of checksums
+        def b64(checksum):
+            return base64.b64encode(bytes.fromhex(checksum)).decode().rstrip("=").replace("/", "_")
+        from_b64 = b64(from_commit)
+        delta_dir = os.path.join(self.deploydir, "ostree_repo", "deltas",
+                                 from_b64[:2], "%s-%s" % (from_b64[2:], b64(to_commit)))
+        size = 0
+        for root, dirs, files in os.walk(delta_dir):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size
+
+    @profiled("Update ostree repo")
+    def _update_repo(self):
+        """
+        Prune the repo and generate static deltas from the previous commits
+        of the branch, then update the summary which lists the deltas
+        """
+        static_deltas = int(self.static_deltas or 0)
+        prune_depth = int(self.prune_depth) if self.prune_depth not in ("", None) else -1
+        if static_deltas <= 0 and prune_depth < 0:
+            return
+
+        if prune_depth >= 0:
+            logger.info("Pruning ostree repo to depth %d", prune_depth)
+            output = self._run_ostree("prune --refs-only --depth=%d" % prune_depth)
+            logger.debug(output)
+
+        if static_deltas > 0:
+            branch = self.ostree_branchname or self.image_name
+            commit = self._run_ostree("rev-parse %s" % branch).strip()
+            existing = set(self._run_ostree("static-delta list").split())
+            for parent in self._get_parents(commit, static_deltas):
+                delta = "%s-%s" % (parent, commit)
+                if delta not in existing:
+                    self._run_ostree("static-delta generate --from=%s --to=%s" % (parent, commit))
+                logger.info("Static delta %s: %.1fM", delta,
+                            self._get_delta_size(parent, commit) / 1024 / 1024)
+
+        self._run_ostree("summary -u")
 
     def gen_env(self, data):
         env = {
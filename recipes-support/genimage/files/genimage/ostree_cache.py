@@ -0,0 +1,149 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Link cache of the persistent bare-user repo which run.do_image_ostree
+commits to.
+
+After a commit, `save' records the stat and the object checksum of each
+regular file of the committed tree. Before the next commit, `link'
+replaces the files whose stat did not change by hard links to their repo
+objects, so `ostree commit --link-checkout-speedup' finds them in the
+devino cache and does not checksum them again.
+
+The rootfs is created again with new inodes on each run, so the stat is
+the one which survives it, the same quick check as rsync: the files
+installed from packages keep their mtime, size, mode and owner.
+
+It does not import genimage, so it runs as a standalone script under
+pseudo, the same as the ostree commands of run.do_image_ostree:
+
+    python3 ostree_cache.py save <repo> <branch> <rootfs> <index>
+    python3 ostree_cache.py link <repo> <rootfs> <index>
+"""
+import os
+import sys
+import stat
+import json
+import logging
+import subprocess
+
+logger = logging.getLogger('appsdk')
+
+OSTREE_CACHE_INDEX_VERSION = 3
+
+def _stat_key(st):
+    return [st.st_mtime_ns, st.st_size, st.st_mode, st.st_uid, st.st_gid]
+
+def _has_xattrs(path):
+    try:
+        return bool(os.listxattr(path, follow_symlinks=False))
+    except OSError:
+        return True
+
+def _ls_checksums(repo, branch):
+    """
+    Return a dict of path -> checksum of the regular files in branch
+    """
+    output = subprocess.check_output(["ostree", "--repo=%s" % repo, "ls", "-R", "-C", branch])
+    checksums = dict()
+    for line in output.decode(errors="surrogateescape").splitlines():
+        # -00644 0 0     12 <checksum> /usr/bin/foo
+        if not line.startswith("-"):
+            continue
+        fields = line.split(None, 5)
+        if len(fields) == 6:
+            checksums[fields[5]] = fields[4]
+    return checksums
+
+def _object_path(repo, checksum):
+    return os.path.join(repo, "objects", checksum[:2], checksum[2:] + ".file")
+
+def _load(index_file):
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    if index.get("version") != OSTREE_CACHE_INDEX_VERSION:
+        return dict()
+    return index["files"]
+
+def save(repo, branch, rootfs, index_file):
+    old_files = _load(index_file)
+    index = {"version": OSTREE_CACHE_INDEX_VERSION, "files": {}}
+    for path, checksum in _ls_checksums(repo, branch).items():
+        full_path = os.path.join(rootfs, path.lstrip("/"))
+        try:
+            st = os.lstat(full_path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+
+        # A file linked to its object has the stat of the object, keep
+        # the stat it had in the rootfs
+        record = old_files.get(path)
+        if record and record[-1] == checksum and st.st_nlink > 1:
+            try:
+                if os.path.samestat(st, os.lstat(_object_path(repo, checksum))):
+                    index["files"][path] = record
+                    continue
+            except FileNotFoundError:
+                pass
+
+        if not _has_xattrs(full_path):
+            index["files"][path] = _stat_key(st) + [checksum]
+
+    tmp_file = "%s.tmp-%d" % (index_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_file, index_file)
+    logger.debug("Saved %d files to ostree link cache %s", len(index["files"]), index_file)
+
+def link(repo, rootfs, index_file):
+    files = _load(index_file)
+    linked = 0
+    for path, record in files.items():
+        full_path = os.path.join(rootfs, path.lstrip("/"))
+        try:
+            st = os.lstat(full_path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode) or _stat_key(st) != record[:-1] or _has_xattrs(full_path):
+            continue
+
+        obj = _object_path(repo, record[-1])
+        tmp_path = full_path + ".ostree-link"
+        try:
+            os.link(obj, tmp_path)
+        except OSError:
+            # The object is pruned or on another file system
+            continue
+        os.replace(tmp_path, full_path)
+        linked += 1
+
+    logger.debug("Linked %d of %d files from ostree link cache %s", linked, len(files), index_file)
+    return linked
+
+if __name__ == "__main__":
+    if len(sys.argv) == 6 and sys.argv[1] == "save":
+        save(*sys.argv[2:])
+    elif len(sys.argv) == 5 and sys.argv[1] == "link":
+        print("Linked %d files from %s" % (link(*sys.argv[2:]), sys.argv[4]))
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -15,18 +15,23 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 #
 import importlib
+import collections
+import functools
 import re
 import sys
 import os
 import hashlib
 import logging
-import tempfile
-import subprocess
 import textwrap
+import time
+import fnmatch
+import concurrent.futures
 
 from abc import ABCMeta, abstractmethod
 
 import genimage.utils as utils
+from genimage.package_manager.pkgdata import PkgdataIndex
+from genimage.profiler import profiled
 
 logger = logging.getLogger('appsdk')
 
@@ -40,15 +45,164 @@ def failed_postinsts_abort(pkgs, log_path):
     sys.exit(1)
 
 
+def get_script_jobs():
+    """
+    The number of scripts run concurrently, set by env SCRIPT_JOBS,
+    default is 1 which runs them one by one
+    """
+    return max(1, int(os.environ.get('SCRIPT_JOBS', 1)))
+
+def get_intercept_jobs():
+    """
+    The number of intercept hooks run concurrently, set by env
+    INTERCEPT_JOBS, default is the number of cpus. The conflicting hooks
+    never run at the same time, see INTERCEPT_ACCESS
+    """
+    return max(1, int(os.environ.get('INTERCEPT_JOBS', os.cpu_count() or 1)))
+
+def run_ordered(tasks, deps, jobs, conflicts=None):
+    """
+    Run tasks, an ordered dict of name to callable, in a pool of jobs
+    threads. A task starts after all tasks in deps[name] are done, the
+    dependency cycles are broken in the order of tasks. If conflicts is
+    set, conflicts(name1, name2) returns True for the tasks which must not
+    run at the same time. Return a dict of name to elapsed seconds. On the
+    first failure, no more task starts and the exception is raised after
+    the running ones finish.
+    """
+    deps = dict((t, set(deps.get(t, set())) & set(tasks)) for t in tasks)
+    done = set()
+    pending = list(tasks)
+    while pending:
+        ready = [t for t in pending if deps[t] <= done]
+        if not ready:
+            logger.debug("Dependency cycle in %s, run %s first" % (' '.join(pending), pending[0]))
+            deps[pending[0]] &= done
+            ready = [pending[0]]
+        done.update(ready)
+        pending = [t for t in pending if t not in done]
+
+    elapsed = dict()
+    pending = list(tasks)
+    running = dict()
+    done = set()
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        def submit(name):
+            def timed():
+                start = time.monotonic()
+                try:
+                    tasks[name]()
+                finally:
+                    elapsed[name] = time.monotonic() - start
+            running[executor.submit(timed)] = name
+            pending.remove(name)
+
+        while pending or running:
+            if error is None:
+                for name in [t for t in pending if deps[t] <= done]:
+                    if len(running) >= jobs:
+                        break
+                    if conflicts and any(conflicts(name, r) for r in running.values()):
+                        continue
+                    submit(name)
+
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                done.add(name)
+                if future.exception() is not None and error is None:
+                    error = future.exception()
+
+    if error is not None:
+        raise error
+    return elapsed
+
+
+# The paths in rootfs read and written by the postinst intercepts of
+# poky, the hooks not listed here and without ##READS/##WRITES lines
+# conflict with all other hooks
+INTERCEPT_ACCESS = {
+    "update_font_cache": (["usr/share/fonts", "etc/fonts"], ["var/cache/fontconfig"]),
+    "update_gio_module_cache": ([], ["usr/lib*/gio/modules"]),
+    "update_pixbuf_cache": ([], ["usr/lib*/gdk-pixbuf-2.0"]),
+    "update_gtk_icon_cache": (["usr/lib*/gdk-pixbuf-2.0"], ["usr/share/icons"]),
+    "update_gtk_immodules_cache": ([], ["usr/lib*/gtk-2.0", "usr/lib*/gtk-3.0"]),
+    "update_udev_hwdb": (["etc/udev/hwdb.d", "lib/udev/hwdb.d", "usr/lib/udev/hwdb.d"],
+                         ["etc/udev/hwdb.bin", "lib/udev/hwdb.bin", "usr/lib/udev/hwdb.bin"]),
+    "update_mime_database": ([], ["usr/share/mime"]),
+    "update_desktop_database": ([], ["usr/share/applications"]),
+    "update_mandb": (["usr/share/man"], ["var/cache/man"]),
+}
+
+# The paths in rootfs written by the commands which maintainer scripts
+# call to update the state shared between packages, the scripts calling
+# them must not run at the same time
+SCRIPT_COMMAND_ACCESS = {
+    "update-alternatives": ["etc/alternatives", "var/lib/dpkg/alternatives", "var/lib/opkg/alternatives"],
+    "systemctl": ["etc/systemd/system", "etc/systemd/user"],
+    "update-rc.d": ["etc/init.d", "etc/rc*.d"],
+    "useradd": ["etc/passwd", "etc/group", "etc/shadow", "etc/gshadow"],
+    "groupadd": ["etc/passwd", "etc/group", "etc/shadow", "etc/gshadow"],
+    "usermod": ["etc/passwd", "etc/group", "etc/shadow", "etc/gshadow"],
+    "groupmod": ["etc/passwd", "etc/group", "etc/shadow", "etc/gshadow"],
+    "ldconfig": ["etc/ld.so.cache"],
+    "postinst_intercept": ["INTERCEPT_DIR"],
+}
+
+def get_script_access(script_files):
+    """
+    Return (reads, writes) of the maintainer scripts by the commands they
+    call in SCRIPT_COMMAND_ACCESS, the other files they write belong to
+    their own package
+    """
+    writes = []
+    for script_file in script_files:
+        try:
+            with open(script_file, errors="replace") as f:
+                content = f.read()
+        except OSError:
+            return None
+        for command, paths in SCRIPT_COMMAND_ACCESS.items():
+            if re.search(r"(^|[\s/;&|`(])%s($|[\s;&|`)])" % re.escape(command), content, re.MULTILINE):
+                writes.extend(p for p in paths if p not in writes)
+    return ([], writes)
+
+def paths_overlap(path1, path2):
+    """
+    Whether one of the glob paths is the same as or under the other one
+    """
+    parts1 = path1.strip("/").split("/")
+    parts2 = path2.strip("/").split("/")
+    return all(fnmatch.fnmatchcase(p1, p2) or fnmatch.fnmatchcase(p2, p1) for p1, p2 in zip(parts1, parts2))
+
+def access_conflicts(access1, access2):
+    """
+    Whether two (reads, writes) accesses conflict, None means all paths
+    """
+    if access1 is None or access2 is None:
+        return True
+    reads1, writes1 = access1
+    reads2, writes2 = access2
+    return any(paths_overlap(w, p) for w in writes1 for p in reads2 + writes2) or \
+           any(paths_overlap(w, p) for w in writes2 for p in reads1)
+
+
 class PackageManager(object, metaclass=ABCMeta):
     def __init__(self,
                  workdir = os.path.join(os.getcwd(),"workdir"),
                  target_rootfs = os.path.join(os.getcwd(), "workdir/rootfs"),
                  machine = 'intel-x86-64',
-                 remote_pkgdatadir = None):
+                 remote_pkgdatadir = None,
+                 pkg_cache = None,
+                 metadata_cache = None):
 
         self.workdir = workdir
         self.target_rootfs = target_rootfs
+        self.pkg_cache = pkg_cache
+        self.metadata_cache = metadata_cache
 
         self.temp_dir = os.path.join(workdir, "temp")
         utils.mkdirhier(self.target_rootfs)
@@ -65,6 +219,13 @@ class PackageManager(object, metaclass=ABCMeta):
 
         self.remote_pkgdatadir = remote_pkgdatadir
 
+        self.script_jobs = get_script_jobs()
+        self.intercept_jobs = get_intercept_jobs()
+
+        # Snapshot of list_installed() as (with_deps, packages), reset by
+        # package transactions
+        self.installed_cache = None
+
         if utils.is_sdk():
             self.pkgdatadir = os.path.join(os.environ['OECORE_NATIVE_SYSROOT'], "../pkgdata", machine)
         elif utils.is_build():
@@ -73,7 +234,10 @@ class PackageManager(object, metaclass=ABCMeta):
             logger.error("Neither sdk or build")
             sys.exit(1)
 
-        self.oe_pkgdata_util = os.path.join(os.environ['OECORE_NATIVE_SYSROOT'], "usr/share/poky/scripts/oe-pkgdata-util")
+        # An index per pkgdatadir, so they do not invalidate each other
+        pkgdatadir_hash = hashlib.sha256(os.path.realpath(self.pkgdatadir).encode()).hexdigest()[:16]
+        self.pkgdata_index = PkgdataIndex(self.pkgdatadir,
+                                          os.path.join(self.workdir, "pkgdata-index-%s.json" % pkgdatadir_hash))
 
         self._initialize_intercepts()
 
@@ -104,7 +268,11 @@ class PackageManager(object, metaclass=ABCMeta):
         logger.debug("insert_feeds_uris")
 
     @abstractmethod
-    def list_installed(self):
+    def list_installed(self, with_deps=True):
+        """
+        Return a dict of installed package names to their info, the
+        dependencies may be left out if with_deps is not set
+        """
         pass
 
     @abstractmethod
@@ -130,6 +298,24 @@ class PackageManager(object, metaclass=ABCMeta):
         """
         pass
 
+    @abstractmethod
+    def remove_unneeded(self, pkgs):
+        """
+        Remove a list of packages which are not requested any more, the
+        ones still required by other installed packages are kept. The
+        dependencies which nothing else requires are removed too.
+        """
+        pass
+
+    def list_complementary(self, pkgs, globs=""):
+        """
+        Return the installed complementary packages of pkgs for globs
+        """
+        if not globs:
+            return set()
+        installed = set(self.list_installed(with_deps=False))
+        return self.pkgdata_index.glob(sorted(pkgs), globs.split()) & installed
+
     @abstractmethod
     def _handle_intercept_failure(self, registered_pkgs):
         pass
@@ -137,6 +323,13 @@ class PackageManager(object, metaclass=ABCMeta):
     def post_install(self):
         pass
 
+    def metadata_files(self):
+        """
+        Return the metadata files of package feeds fetched by update()
+        """
+        return []
+
+    @profiled("Install complementary packages")
     def install_complementary(self, globs=""):
         """
         Install complementary packages based upon the list of currently installed
@@ -147,30 +340,19 @@ class PackageManager(object, metaclass=ABCMeta):
             return
 
         logger.debug("Installing complementary packages (%s) ..." % globs)
-        # we need to write the list of installed packages to a file because the
-        # oe-pkgdata-util reads it from a file
-        with tempfile.NamedTemporaryFile(mode="w+", prefix="installed-pkgs") as installed_pkgs:
-            pkgs = self.list_installed()
-
-            provided_pkgs = set()
-            for pkg in pkgs.values():
-                provided_pkgs |= set(pkg.get('provs', []))
-
-            output = utils.format_pkg_list(pkgs, "arch")
-            installed_pkgs.write(output)
-            installed_pkgs.flush()
-
-            cmd = '%s -p %s glob %s %s' % (self.oe_pkgdata_util, self.pkgdatadir, installed_pkgs.name, globs)
-            logger.debug(cmd)
-            output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode('utf-8')
-
-            complementary_pkgs = set(output.split())
-            skip_pkgs = sorted(complementary_pkgs & provided_pkgs)
-            install_pkgs = sorted(complementary_pkgs - provided_pkgs)
-            logger.debug("Installing complementary packages ... %s (skipped already provided packages %s)" % (
-                ' '.join(install_pkgs),
-                ' '.join(skip_pkgs)))
-            self.install(install_pkgs, attempt_only=True)
+        pkgs = self.list_installed(with_deps=False)
+
+        provided_pkgs = set()
+        for pkg in pkgs.values():
+            provided_pkgs |= set(pkg.get('provs', []))
+
+        complementary_pkgs = self.pkgdata_index.glob(sorted(pkgs), globs.split())
+        skip_pkgs = sorted(complementary_pkgs & provided_pkgs)
+        install_pkgs = sorted(complementary_pkgs - provided_pkgs)
+        logger.debug("Installing complementary packages ... %s (skipped already provided packages %s)" % (
+            ' '.join(install_pkgs),
+            ' '.join(skip_pkgs)))
+        self.install(install_pkgs, attempt_only=True)
 
     def _postpone_to_first_boot(self, postinst_intercept_hook):
         with open(postinst_intercept_hook) as intercept:
@@ -189,6 +371,28 @@ class PackageManager(object, metaclass=ABCMeta):
                 # call the backend dependent handler
                 self._handle_intercept_failure(registered_pkgs)
 
+    def _get_intercept_access(self, script_full):
+        """
+        Return (reads, writes) of the intercept hook, declared by ##READS:
+        and ##WRITES: lines of the hook, or known by INTERCEPT_ACCESS.
+        None means unknown.
+        """
+        reads = writes = None
+        with open(script_full) as intercept:
+            for line in intercept.read().split("\n"):
+                m = re.match(r"^##(READS|WRITES):(.*)", line)
+                if m is None:
+                    continue
+                if m.group(1) == "READS":
+                    reads = (reads or []) + m.group(2).split()
+                else:
+                    writes = (writes or []) + m.group(2).split()
+
+        if reads is None and writes is None:
+            return INTERCEPT_ACCESS.get(os.path.basename(script_full))
+        return (reads or [], writes or [])
+
+    @profiled("Run intercepts")
     def run_intercepts(self):
         intercepts_dir = self.intercepts_dir
 
@@ -197,7 +401,22 @@ class PackageManager(object, metaclass=ABCMeta):
         os.environ['STAGING_DIR_NATIVE'] = os.environ['OECORE_NATIVE_SYSROOT']
         os.environ['libdir_native'] = "/usr/lib"
 
-        for script in os.listdir(intercepts_dir):
+        tasks = collections.OrderedDict()
+        access = dict()
+        postponed = []
+        def run_intercept(script, script_full):
+            logger.debug("> Executing %s intercept ..." % script)
+            res, output = utils.run_cmd(script_full, print_output=False)
+            logger.debug(output)
+            if res:
+                if "qemuwrapper: qemu usermode is not supported" in output:
+                    logger.debug("The postinstall intercept hook '%s' could not be executed due to missing qemu usermode support"
+                            % (script))
+                    postponed.append(script_full)
+                else:
+                    logger.warning("The postinstall intercept hook '%s' failed, ignore it\n%s" % (script, output))
+
+        for script in sorted(os.listdir(intercepts_dir)):
             script_full = os.path.join(intercepts_dir, script)
 
             if script == "postinst_intercept" or not os.access(script_full, os.X_OK):
@@ -208,15 +427,17 @@ class PackageManager(object, metaclass=ABCMeta):
                 self._postpone_to_first_boot(script_full)
                 continue
 
-            logger.debug("> Executing %s intercept ..." % script)
-            res, output = utils.run_cmd(script_full)
-            if res:
-                if "qemuwrapper: qemu usermode is not supported" in output:
-                    logger.debug("The postinstall intercept hook '%s' could not be executed due to missing qemu usermode support"
-                            % (script))
-                    self._postpone_to_first_boot(script_full)
-                else:
-                    logger.warning("The postinstall intercept hook '%s' failed, ignore it\n%s" % (script, output))
+            tasks[script] = functools.partial(run_intercept, script, script_full)
+            access[script] = self._get_intercept_access(script_full)
+
+        elapsed = run_ordered(tasks, dict(), self.intercept_jobs,
+                              conflicts=lambda s1, s2: access_conflicts(access[s1], access[s2]))
+        for script in sorted(elapsed, key=elapsed.get, reverse=True):
+            logger.debug("Intercept %s took %.2fs" % (script, elapsed[script]))
+
+        # Postpone them after all hooks done, it updates package database
+        for script_full in sorted(postponed):
+            self._postpone_to_first_boot(script_full)
 
 
 def get_pm_class(pkgtype="rpm"):
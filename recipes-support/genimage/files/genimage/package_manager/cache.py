@@ -0,0 +1,228 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import os.path
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+
+import genimage.utils as utils
+from genimage.checksum import file_digest
+
+logger = logging.getLogger('appsdk')
+
+DEFAULT_PKG_CACHE_SIZE = 20
+
+# Checksum type names used by repodata and apt indexes
+CHECKSUM_TYPES = {
+    'sha': 'sha1',
+    'sha1': 'sha1',
+    'sha256': 'sha256',
+    'sha512': 'sha512',
+}
+
+def file_checksum(path, checksum_type):
+    return file_digest(path, checksum_type)
+
+class PackageCache(object):
+    """
+    Host wide package cache shared by images and workdirs.
+
+    Packages are stored by their checksums from the feed metadata, so
+    the same package from different feed urls is stored once. Package
+    managers download into their own dir as usual: cached packages are
+    linked into that dir before install, and the downloaded ones are
+    verified and saved after install.
+
+    Saving and linking hold a shared lock, eviction of the least recently
+    used packages holds the exclusive lock when the total size is larger
+    than max_size (in GB).
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_PKG_CACHE_SIZE):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.max_size = max_size * 1024 * 1024 * 1024
+        utils.mkdirhier(self.cache_dir)
+        self.lock_file = os.path.join(self.cache_dir, "lock")
+
+    def _lock(self, operation=fcntl.LOCK_SH):
+        lock = open(self.lock_file, 'a')
+        fcntl.flock(lock, operation)
+        return lock
+
+    def _path(self, checksum_type, checksum):
+        return os.path.join(self.cache_dir, checksum_type, checksum[:2], checksum)
+
+    def fetch(self, checksums, pkg_dir):
+        """
+        Link the cached packages into pkg_dir, checksums maps file names
+        to (checksum_type, checksum). Return names of the linked files.
+        """
+        fetched = []
+        utils.mkdirhier(pkg_dir)
+        with self._lock():
+            for filename, (checksum_type, checksum) in checksums.items():
+                checksum_type = CHECKSUM_TYPES.get(checksum_type)
+                if checksum_type is None:
+                    continue
+                cached = self._path(checksum_type, checksum)
+                dst = os.path.join(pkg_dir, filename)
+                if not os.path.exists(cached) or os.path.exists(dst):
+                    continue
+                try:
+                    os.link(cached, dst)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copy2(cached, dst)
+                # Mark it as recently used
+                try:
+                    os.utime(cached)
+                except PermissionError:
+                    pass
+                fetched.append(filename)
+
+        logger.debug("Fetched %d packages from cache %s to %s", len(fetched), self.cache_dir, pkg_dir)
+        return fetched
+
+    def save(self, checksums, pkg_dir):
+        """
+        Save the packages downloaded in pkg_dir to the cache after verified
+        """
+        count = 0
+        with self._lock():
+            for filename in os.listdir(pkg_dir):
+                if filename not in checksums:
+                    continue
+                checksum_type, checksum = checksums[filename]
+                checksum_type = CHECKSUM_TYPES.get(checksum_type)
+                if checksum_type is None:
+                    continue
+                cached = self._path(checksum_type, checksum)
+                if os.path.exists(cached):
+                    continue
+
+                src = os.path.join(pkg_dir, filename)
+                if file_checksum(src, checksum_type) != checksum:
+                    logger.warning("Checksum of %s mismatch, do not save it to cache" % src)
+                    continue
+
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                tmp = "%s.tmp-%d" % (cached, os.getpid())
+                try:
+                    os.link(src, tmp)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copy2(src, tmp)
+                os.rename(tmp, cached)
+                count += 1
+
+        logger.debug("Saved %d packages from %s to cache %s", count, pkg_dir, self.cache_dir)
+        if count:
+            self._evict()
+
+    def _evict(self):
+        with self._lock(fcntl.LOCK_EX):
+            entries = []
+            total = 0
+            for root, dirs, files in os.walk(self.cache_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if path == self.lock_file:
+                        continue
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+
+            # Remove the least recently used first
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logger.debug("Evict package cache %s", path)
+                os.unlink(path)
+                total -= size
+
+class MetadataCache(object):
+    """
+    Metadata of package feeds shared by workdirs, keyed by feed urls.
+
+    The package managers revalidate the restored metadata by repomd.xml
+    or InRelease, and only download what changed. In offline mode, the
+    cached metadata is used as is without network.
+    """
+    def __init__(self, cache_dir, offline=False):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.offline = offline
+        utils.mkdirhier(self.cache_dir)
+        self.lock_file = os.path.join(self.cache_dir, "lock")
+
+    def _lock(self, operation=fcntl.LOCK_SH):
+        lock = open(self.lock_file, 'a')
+        fcntl.flock(lock, operation)
+        return lock
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    def restore(self, key, dst_dir):
+        """
+        Copy the cached metadata of key into dst_dir, return False if
+        nothing cached
+        """
+        entry = self._entry(key)
+        with self._lock():
+            if not os.path.exists(entry):
+                logger.debug("No cached metadata for %s", key)
+                return False
+
+            utils.mkdirhier(dst_dir)
+            res, output = utils.run_cmd("cp -a %s/. %s/" % (entry, dst_dir), shell=True, print_output=False)
+            if res:
+                logger.warning("Restore cached metadata for %s failed, ignore it\n%s", key, output)
+                return False
+
+        logger.debug("Restored cached metadata for %s", key)
+        return True
+
+    def save(self, key, src_dir, names):
+        """
+        Save names, the paths relative to src_dir, as metadata of key
+        """
+        names = [n for n in names if os.path.exists(os.path.join(src_dir, n))]
+        if not names:
+            return
+
+        entry = self._entry(key)
+        tmp_entry = "%s.tmp-%d" % (entry, os.getpid())
+        old_entry = "%s.old-%d" % (entry, os.getpid())
+        utils.remove(tmp_entry, recurse=True)
+        utils.mkdirhier(tmp_entry)
+        res, output = utils.run_cmd("cp -a --parents %s %s/" % (' '.join(names), tmp_entry),
+                                    shell=True, print_output=False, cwd=src_dir)
+        if res:
+            utils.remove(tmp_entry, recurse=True)
+            logger.warning("Save metadata for %s to cache failed, ignore it\n%s", key, output)
+            return
+
+        with self._lock(fcntl.LOCK_EX):
+            if os.path.exists(entry):
+                os.rename(entry, old_entry)
+            os.rename(tmp_entry, entry)
+        utils.remove(old_entry, recurse=True)
+        logger.debug("Saved metadata for %s to cache", key)
@@ -24,6 +24,8 @@ import re
 import tempfile
 import signal
 import hashlib
+import time
+import functools
 
 from genimage.utils import set_logger
 from genimage.constant import DEFAULT_LOCAL_DEB_PACKAGE_FEED
@@ -31,6 +33,9 @@ from genimage.constant import DEFAULT_MACHINE
 from genimage.constant import DEB_PACKAGE_FEED_ARCHS
 from genimage.package_manager import PackageManager
 from genimage.package_manager import failed_postinsts_abort
+from genimage.package_manager import run_ordered
+from genimage.package_manager import get_script_access
+from genimage.package_manager import access_conflicts
 import genimage.utils as utils
 import genimage.debian_constant as debian_constant
 
@@ -43,82 +48,199 @@ def debian_arch_map(machine):
         return "arm64"
     return arch
 
-def dpkg_query(cmd_output):
+class MaintainerScriptError(Exception):
+    def __init__(self, pkg_name):
+        super(MaintainerScriptError, self).__init__("Maintainer script of %s failed" % pkg_name)
+        self.pkg_name = pkg_name
+
+class DpkgStatusRecord(object):
+    """
+    The fields of a package stanza in dpkg status file used here
+    """
+    __slots__ = ("package", "status", "arch", "pkgarch", "version", "depends", "predepends", "recommends", "provides")
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, "")
+
+DPKG_STATUS_FIELDS = {
+    "Package": "package",
+    "Status": "status",
+    "Architecture": "arch",
+    "PackageArch": "pkgarch",
+    "Version": "version",
+    "Depends": "depends",
+    "Pre-Depends": "predepends",
+    "Recommends": "recommends",
+    "Provides": "provides",
+}
+
+def iter_dpkg_status(f):
+    """
+    Parse the RFC822 style stanzas of dpkg status file object f, yield a
+    tuple (lines, record) per stanza, lines are the raw lines of stanza
     """
-    This method parse the output from the package managerand return
-    a dictionary with the information of the packages. This is used
-    when the packages are in deb format.
+    lines = []
+    record = DpkgStatusRecord()
+    attr = None
+    for line in f:
+        if not line.strip():
+            if lines:
+                yield lines, record
+            lines = []
+            record = DpkgStatusRecord()
+            attr = None
+            continue
+
+        lines.append(line)
+        # Continuation of a multiline field
+        if line[0] in " \t":
+            if attr:
+                setattr(record, attr, "%s %s" % (getattr(record, attr), line.strip()))
+            continue
+
+        name, _, value = line.partition(":")
+        attr = DPKG_STATUS_FIELDS.get(name)
+        if attr:
+            value = value.strip()
+            setattr(record, attr, sys.intern(value) if attr == "package" else value)
+
+    if lines:
+        yield lines, record
+
+class DpkgStatus(object):
+    """
+    Index of dpkg status file, which maps package names to records in the
+    order of the file. The file is only parsed again after it changed.
     """
     verregex = re.compile(r' \([=<>]* [^ )]*\)')
-    output = dict()
-    pkg = ""
-    arch = ""
-    ver = ""
-    filename = ""
-    dep = []
-    prov = []
-    pkgarch = ""
-    for line in cmd_output.splitlines()+['']:
-        line = line.rstrip()
-        if ':' in line:
-            if line.startswith("Package: "):
-                pkg = line.split(": ")[1]
-            elif line.startswith("Architecture: "):
-                arch = line.split(": ")[1]
-            elif line.startswith("Version: "):
-                ver = line.split(": ")[1]
-            elif line.startswith("File: ") or line.startswith("Filename:"):
-                filename = line.split(": ")[1]
-                if "/" in filename:
-                    filename = os.path.basename(filename)
-            elif line.startswith("Depends: "):
-                depends = verregex.sub('', line.split(": ")[1])
-                for depend in depends.split(", "):
-                    dep.append(depend)
-            elif line.startswith("Recommends: "):
-                recommends = verregex.sub('', line.split(": ")[1])
-                for recommend in recommends.split(", "):
-                    dep.append("%s [REC]" % recommend)
-            elif line.startswith("PackageArch: "):
-                pkgarch = line.split(": ")[1]
-            elif line.startswith("Provides: "):
-                provides = verregex.sub('', line.split(": ")[1])
-                for provide in provides.split(", "):
-                    prov.append(provide)
-
-        # When there is a blank line save the package information
-        elif not line:
-            # IPK doesn't include the filename
-            if not filename:
-                filename = "%s_%s_%s.ipk" % (pkg, ver, arch)
-            if pkg:
-                output[pkg] = {"arch":arch, "ver":ver,
-                        "filename":filename, "deps": dep, "pkgarch":pkgarch, "provs": prov}
-            pkg = ""
-            arch = ""
-            ver = ""
-            filename = ""
-            dep = []
-            prov = []
-            pkgarch = ""
-
-    return output
 
+    def __init__(self, status_file):
+        self.status_file = status_file
+        self.stat_key = None
+        self.records = collections.OrderedDict()
+        self.installed = None
+
+    def get(self):
+        st = os.stat(self.status_file)
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat_key != self.stat_key:
+            self.records = collections.OrderedDict()
+            self.installed = None
+            with open(self.status_file, "r") as f:
+                for lines, record in iter_dpkg_status(f):
+                    if record.package:
+                        self.records[record.package] = record
+            self.stat_key = stat_key
+        return self.records
+
+    def _split(self, field):
+        if not field:
+            return []
+        return self.verregex.sub('', field).split(", ")
+
+    def get_depends(self):
+        """
+        Return a dict which maps installed package names to the installed
+        packages they (pre)depend on, virtual packages are resolved by
+        Provides
+        """
+        records = self.get()
+        providers = collections.defaultdict(set)
+        for pkg, record in records.items():
+            providers[pkg].add(pkg)
+            for prov in self._split(record.provides):
+                providers[prov].add(pkg)
+
+        depends = dict()
+        for pkg, record in records.items():
+            depends[pkg] = set()
+            for dep in self._split(record.predepends) + self._split(record.depends):
+                for alt in dep.split(" | "):
+                    depends[pkg] |= providers.get(alt.strip().split(":")[0], set())
+            depends[pkg].discard(pkg)
+        return depends
+
+    def list_installed(self):
+        """
+        Return the installed packages in the format of package manager
+        list_installed(), like dpkg-query does, the not-installed ones
+        are skipped
+        """
+        self.get()
+        if self.installed is not None:
+            return dict(self.installed)
+
+        output = dict()
+        for pkg in sorted(self.records):
+            record = self.records[pkg]
+            if record.status.endswith(" not-installed"):
+                continue
+            deps = self._split(record.depends)
+            deps += ["%s [REC]" % r for r in self._split(record.recommends)]
+            output[pkg] = {"arch": record.pkgarch,
+                           "ver": record.version,
+                           "filename": "%s_%s_%s.deb" % (pkg, record.version, record.arch),
+                           "deps": deps,
+                           "pkgarch": "",
+                           "provs": self._split(record.provides)}
+        self.installed = output
+        return dict(output)
+
+def packages_checksums(lists_dir):
+    """
+    Parse the Packages indexes in apt lists dir, return a dict which maps
+    file names of downloaded debs to ("sha256", checksum)
+    """
+    checksums = dict()
+    if not os.path.exists(lists_dir):
+        return checksums
+
+    for index in os.listdir(lists_dir):
+        if not index.endswith("_Packages"):
+            continue
+        pkg = ver = arch = sha256 = None
+        with open(os.path.join(lists_dir, index), errors="replace") as f:
+            for line in f:
+                if line.startswith("Package: "):
+                    pkg = line[9:].strip()
+                elif line.startswith("Version: "):
+                    ver = line[9:].strip()
+                elif line.startswith("Architecture: "):
+                    arch = line[14:].strip()
+                elif line.startswith("SHA256: "):
+                    sha256 = line[8:].strip()
+                elif not line.strip():
+                    if pkg and ver and arch and sha256:
+                        # apt names the downloaded deb with escaped epoch
+                        filename = "%s_%s_%s.deb" % (pkg, ver.replace(":", "%3a"), arch)
+                        checksums[filename] = ("sha256", sha256)
+                    pkg = ver = arch = sha256 = None
+        if pkg and ver and arch and sha256:
+            checksums["%s_%s_%s.deb" % (pkg, ver.replace(":", "%3a"), arch)] = ("sha256", sha256)
+
+    return checksums
 
 class AptDeb(PackageManager):
     def __init__(self,
                  workdir = os.path.join(os.getcwd(),"workdir"),
                  target_rootfs = os.path.join(os.getcwd(), "workdir/rootfs"),
                  machine = 'intel-x86-64',
-                 remote_pkgdatadir = None):
+                 remote_pkgdatadir = None,
+                 pkg_cache = None,
+                 metadata_cache = None):
 
         super(AptDeb, self).__init__(workdir=workdir,
                                      target_rootfs=target_rootfs,
                                      machine=machine,
-                                     remote_pkgdatadir=remote_pkgdatadir)
+                                     remote_pkgdatadir=remote_pkgdatadir,
+                                     pkg_cache=pkg_cache,
+                                     metadata_cache=metadata_cache)
 
         self.apt_conf_dir = os.path.join(self.temp_dir, "apt")
         self.apt_conf_file = os.path.join(self.apt_conf_dir, "apt.conf")
+        self.apt_archives_dir = os.path.join(self.apt_conf_dir, "archives")
+        self.dpkg_status = DpkgStatus(os.path.join(self.target_rootfs, "var/lib/dpkg/status"))
         self.apt_get_cmd = shutil.which("apt-get", path=os.getenv('PATH'))
         self.apt_cache_cmd = shutil.which("apt-cache", path=os.getenv('PATH'))
 
@@ -174,6 +296,12 @@ class AptDeb(PackageManager):
                     line = re.sub(r"methods .*", "methods \"%s/usr/lib/apt/methods\";" % os.environ['OECORE_NATIVE_SYSROOT'], line)
                     utils.write(self.apt_conf_file, "w+", line)
 
+        # Download to workdir rather than the shared dir of native sysroot,
+        # the package cache takes care of sharing
+        if self.pkg_cache:
+            utils.mkdirhier(os.path.join(self.apt_archives_dir, "partial"))
+            utils.write(self.apt_conf_file, "w+", "Dir::Cache::Archives \"%s/\";" % self.apt_archives_dir)
+
         target_dpkg_dir = "%s/var/lib/dpkg" % self.target_rootfs
         utils.mkdirhier(os.path.join(target_dpkg_dir, "info"))
 
@@ -186,6 +314,12 @@ class AptDeb(PackageManager):
 
         utils.mkdirhier(os.path.join("%s/etc/apt" % self.target_rootfs))
 
+        # Keep the automatically installed marks in rootfs rather than the
+        # native sysroot, autoremove of the incremental update needs them
+        utils.mkdirhier(os.path.join(self.target_rootfs, "var/lib/apt"))
+        utils.write(self.apt_conf_file, "w+",
+                    "Dir::State::extended_states \"%s/var/lib/apt/extended_states\";" % self.target_rootfs)
+
     def create_configs(self):
         super(AptDeb, self).create_configs()
         self._configure_apt()
@@ -270,23 +404,47 @@ class AptDeb(PackageManager):
               (' '.join(pkgs))
 
         logger.debug("Installing the following packages: %s" % ' '.join(pkgs))
+        if self.pkg_cache:
+            checksums = packages_checksums(os.path.join(self.apt_conf_dir, "lists"))
+            self.pkg_cache.fetch(checksums, self.apt_archives_dir)
+
+        installed = self._get_installed_versions()
         self._invoke_apt("install", subcmd_args, attempt_only)
 
-        # rename *.dpkg-new files/dirs
-        for root, dirs, files in os.walk(self.target_rootfs):
-            for d in dirs:
-                new_dir = re.sub(r"\.dpkg-new", "", d)
-                if d != new_dir:
-                    cmd = "mv %s %s" % (d, new_dir)
-                    utils.run_cmd_oneshot(cmd, cwd=root)
-            for f in files:
-                new_file = re.sub(r"\.dpkg-new", "", f)
-                if f != new_file:
-                    cmd = "mv %s %s" % (f, new_file)
-                    utils.run_cmd_oneshot(cmd, cwd=root)
+        if self.pkg_cache:
+            self.pkg_cache.save(checksums, self.apt_archives_dir)
+
+        # rename *.dpkg-new files/dirs of the packages just installed
+        changed = [pkg for pkg, ver in self._get_installed_versions().items() if installed.get(pkg) != ver]
+        self._rename_dpkg_new(changed)
 
         self._fix_broken_dependencies()
 
+    def _get_installed_versions(self):
+        if not os.path.exists(self.dpkg_status.status_file):
+            return dict()
+        return dict((pkg, (r.version, r.status)) for pkg, r in self.dpkg_status.get().items())
+
+    def _rename_dpkg_new(self, pkgs):
+        """
+        Rename the *.dpkg-new files/dirs listed in dpkg info of pkgs
+        """
+        info_dir = os.path.join(self.target_rootfs, "var/lib/dpkg/info")
+        for pkg in pkgs:
+            list_files = [os.path.join(info_dir, pkg + ".list")]
+            arch = self.dpkg_status.get()[pkg].arch
+            if arch:
+                list_files.append(os.path.join(info_dir, "%s:%s.list" % (pkg, arch)))
+            for list_file in list_files:
+                if not os.path.exists(list_file):
+                    continue
+                with open(list_file, "r") as f:
+                    for path in f:
+                        path = self.target_rootfs + path.rstrip("\n")
+                        if os.path.lexists(path + ".dpkg-new"):
+                            logger.debug("Rename %s.dpkg-new" % path)
+                            os.replace(path + ".dpkg-new", path)
+
     def remove(self, pkgs, with_dependencies = True):
         logger.debug("remove: %s" % (pkgs))
         if not pkgs:
@@ -310,31 +468,59 @@ class AptDeb(PackageManager):
             raise Exception("Unable to remove packages. Command '%s' "
                      "returned %d:\n%s" % (e.cmd, e.returncode, e.output.decode("utf-8")))
 
-    def list_installed(self):
-        cmd = [shutil.which("dpkg-query", path=os.getenv('PATH')),
-               "--admindir=%s/var/lib/dpkg" % self.target_rootfs,
-               "-W"]
+    def list_installed(self, with_deps=True):
+        return self.dpkg_status.list_installed()
 
-        cmd.append("-f=Package: ${Package}\nArchitecture: ${PackageArch}\nVersion: ${Version}\nFile: ${Package}_${Version}_${Architecture}.deb\nDepends: ${Depends}\nRecommends: ${Recommends}\nProvides: ${Provides}\n\n")
+    def remove_unneeded(self, pkgs):
+        logger.debug("remove unneeded: %s" % (pkgs))
+        if not pkgs:
+            return
 
-        try:
-            cmd_output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).strip().decode("utf-8")
-        except subprocess.CalledProcessError as e:
-            Exception("Cannot get the installed packages list. Command '%s' "
-                     "returned %d:\n%s" % (' '.join(cmd), e.returncode, e.output.decode("utf-8")))
+        # Mark them as automatically installed, autoremove purges them
+        # and their dependencies unless a manually installed package
+        # requires them
+        os.environ['APT_CONFIG'] = self.apt_conf_file
+        os.environ['INTERCEPT_DIR'] = self.intercepts_dir
+        cmd = [shutil.which("apt-mark", path=os.getenv('PATH')), "auto"] + pkgs
+        res, output = utils.run_cmd(cmd)
+        if res:
+            raise Exception("Could not invoke apt-mark. Command '%s' "
+                     "returned %d:\n%s" % (' '.join(cmd), res, output))
+        self._invoke_apt("autoremove", "--purge")
 
-        return dpkg_query(cmd_output)
+    def _lists_names(self, lists_dir):
+        return [f for f in os.listdir(lists_dir) if f != "lock" and os.path.isfile(os.path.join(lists_dir, f))]
 
     def update(self):
         os.environ['APT_CONFIG'] = self.apt_conf_file
         cmd = "%s update" % self.apt_get_cmd
 
+        # apt only downloads the indexes whose InRelease/Release changed
+        if self.metadata_cache:
+            lists_dir = os.path.join(self.apt_conf_dir, "lists")
+            sources = ""
+            if os.path.exists(os.path.join(self.apt_conf_dir, "sources.list")):
+                with open(os.path.join(self.apt_conf_dir, "sources.list")) as f:
+                    sources = f.read()
+            if not self.metadata_cache.restore(sources, lists_dir) and self.metadata_cache.offline:
+                raise Exception("No cached metadata of package feeds for offline mode:\n%s" % sources)
+            if self.metadata_cache.offline:
+                logger.info("Use cached metadata of package feeds offline")
+                return
+
         try:
             subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             raise Exception("Unable to update the package index files. Command '%s' "
                      "returned %d:\n%s" % (e.cmd, e.returncode, e.output.decode("utf-8")))
 
+        if self.metadata_cache:
+            self.metadata_cache.save(sources, lists_dir, self._lists_names(lists_dir))
+
+    def metadata_files(self):
+        lists_dir = os.path.join(self.apt_conf_dir, "lists")
+        return [os.path.join(lists_dir, f) for f in self._lists_names(lists_dir)]
+
     def post_install(self):
         self._mark_packages("installed")
         self._run_pre_post_installs()
@@ -355,6 +541,10 @@ class AptDeb(PackageManager):
         """
         Run the pre/post installs for package "package_name". If package_name is
         None, then run all pre/post install scriptlets.
+
+        The scriptlets of a package run after the ones of packages it depends
+        on, independent packages run concurrently if SCRIPT_JOBS is more than
+        1, except the ones updating the same shared state.
         """
         logger.debug("run_pre_post_installs")
         info_dir = self.target_rootfs + "/var/lib/dpkg/info"
@@ -362,17 +552,12 @@ class AptDeb(PackageManager):
         control_scripts = [
                 ControlScript(".preinst", "Preinstall", "install"),
                 ControlScript(".postinst", "Postinstall", "configure")]
-        status_file = self.target_rootfs + "/var/lib/dpkg/status"
-        installed_pkgs = []
-
-        with open(status_file, "r") as status:
-            for line in status.read().split('\n'):
-                m = re.match(r"^Package: (.*)", line)
-                if m is not None:
-                    installed_pkgs.append(m.group(1))
+        installed_pkgs = list(self.dpkg_status.get())
 
-        if package_name is not None and not package_name in installed_pkgs:
-            return
+        if package_name is not None:
+            if not package_name in installed_pkgs:
+                return
+            installed_pkgs = [package_name]
 
         os.environ['D'] = self.target_rootfs
         os.environ['OFFLINE_ROOT'] = self.target_rootfs
@@ -381,13 +566,15 @@ class AptDeb(PackageManager):
         os.environ['INTERCEPT_DIR'] = self.intercepts_dir
         os.environ['NATIVE_ROOT'] = os.environ['OECORE_NATIVE_SYSROOT']
 
-        for pkg_name in installed_pkgs:
+        timing = []
+        def run_scripts(pkg_name):
             for control_script in control_scripts:
                 p_full = os.path.join(info_dir, pkg_name + control_script.suffix)
                 if os.path.exists(p_full):
+                    logger.debug("Executing %s for package: %s ..." %
+                             (control_script.name.lower(), pkg_name))
+                    start = time.monotonic()
                     try:
-                        logger.debug("Executing %s for package: %s ..." %
-                                 (control_script.name.lower(), pkg_name))
                         output = subprocess.check_output([p_full, control_script.argument],
                                 stderr=subprocess.STDOUT).decode("utf-8")
                         logger.debug(output)
@@ -395,7 +582,25 @@ class AptDeb(PackageManager):
                         logger.warning("%s for package %s failed with %d:\n%s" %
                                 (control_script.name, pkg_name, e.returncode,
                                     e.output.decode("utf-8")))
-                        failed_postinsts_abort([pkg_name], self.temp_dir)
+                        raise MaintainerScriptError(pkg_name)
+                    finally:
+                        timing.append((time.monotonic() - start, control_script.name.lower(), pkg_name))
+
+        tasks = collections.OrderedDict((pkg, functools.partial(run_scripts, pkg)) for pkg in installed_pkgs)
+        # The scripts updating the shared state, such as alternatives and
+        # systemd units, run one by one
+        access = dict()
+        for pkg in installed_pkgs:
+            scripts = [os.path.join(info_dir, pkg + c.suffix) for c in control_scripts]
+            access[pkg] = get_script_access([s for s in scripts if os.path.exists(s)])
+        try:
+            run_ordered(tasks, self.dpkg_status.get_depends(), self.script_jobs,
+                        conflicts=lambda p1, p2: access_conflicts(access[p1], access[p2]))
+        except MaintainerScriptError as e:
+            failed_postinsts_abort([e.pkg_name], self.temp_dir)
+        finally:
+            for elapsed, name, pkg_name in sorted(timing, reverse=True):
+                logger.debug("%s of %s took %.2fs" % (name, pkg_name, elapsed))
 
     def _mark_packages(self, status_tag, packages=None):
         """
@@ -405,27 +610,26 @@ class AptDeb(PackageManager):
         """
         logger.debug("mark_packages")
 
+        if packages is not None and not isinstance(packages, list):
+            raise TypeError("'packages' should be a list object")
+        packages = None if packages is None else set(packages)
+
         status_file = self.target_rootfs + "/var/lib/dpkg/status"
 
+        # Rewrite the status line of unpacked or installed packages in one pass
         with open(status_file, "r") as sf:
-            with open(status_file + ".tmp", "w+") as tmp_sf:
-                if packages is None:
-                    tmp_sf.write(re.sub(r"Package: (.*?)\n((?:[^\n]+\n)*?)Status: (.*)(?:unpacked|installed)",
-                                        r"Package: \1\n\2Status: \3%s" % status_tag,
-                                        sf.read()))
-                else:
-                    if type(packages).__name__ != "list":
-                        raise TypeError("'packages' should be a list object")
-
-                    status = sf.read()
-                    for pkg in packages:
-                        status = re.sub(r"Package: %s\n((?:[^\n]+\n)*?)Status: (.*)(?:unpacked|installed)" % pkg,
-                                        r"Package: %s\n\1Status: \2%s" % (pkg, status_tag),
-                                        status)
-
-                    tmp_sf.write(status)
-
-            utils.run_cmd_oneshot("mv %s.tmp %s" % (status_file, status_file))
+            with open(status_file + ".tmp", "w") as tmp_sf:
+                for lines, record in iter_dpkg_status(sf):
+                    status = record.status.split()
+                    if (packages is None or record.package in packages) and \
+                            len(status) == 3 and status[2] in ["unpacked", "installed"]:
+                        status[2] = status_tag
+                        lines = ["Status: %s\n" % ' '.join(status) if line.startswith("Status:") else line
+                                     for line in lines]
+                    tmp_sf.writelines(lines)
+                    tmp_sf.write("\n")
+
+        os.replace(status_file + ".tmp", status_file)
 
     def _handle_intercept_failure(self, registered_pkgs):
         logger.debug("_handle_intercept_failure")
@@ -443,10 +647,14 @@ class ExternalDebian(object):
                  apt_keys = [],
                  workdir = os.path.join(os.getcwd(),"workdir"),
                  target_rootfs = os.path.join(os.getcwd(), "workdir/rootfs"),
-                 machine = 'intel-x86-64'):
+                 machine = 'intel-x86-64',
+                 pkg_cache = None,
+                 metadata_cache = None):
 
         self.workdir = workdir
         self.target_rootfs = target_rootfs
+        self.pkg_cache = pkg_cache
+        self.metadata_cache = metadata_cache
         self.apt_sources = apt_sources
         self.apt_preference = apt_preference
         self.bootstrap_mirror = bootstrap_mirror
@@ -475,6 +683,8 @@ class ExternalDebian(object):
 
         self.chroot_path = debian_constant.CHROOT_PATH
 
+        self.dpkg_status = DpkgStatus(os.path.join(self.target_rootfs, "var/lib/dpkg/status"))
+
     def _add_apt_keys(self):
         for key in self.apt_keys:
             pgp_key = os.path.join(self.target_rootfs, "etc/apt/trusted.gpg.d/%s.gpg" % os.path.basename(key))
@@ -595,20 +805,19 @@ class ExternalDebian(object):
         del os.environ['APT_CONFIG']
         utils.remove(os.path.join(self.target_rootfs, "var/cache/apt/archives/*.deb"))
 
-    def list_installed(self):
-        cmd = [shutil.which("dpkg-query", path=os.getenv('PATH')),
-               "--admindir=%s/var/lib/dpkg" % self.target_rootfs,
-               "-W"]
-
-        cmd.append("-f=Package: ${Package}\nArchitecture: ${PackageArch}\nVersion: ${Version}\nFile: ${Package}_${Version}_${Architecture}.deb\nDepends: ${Depends}\nRecommends: ${Recommends}\nProvides: ${Provides}\n\n")
-        try:
-            cmd_output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).strip().decode("utf-8")
-        except subprocess.CalledProcessError as e:
-            Exception("Cannot get the installed packages list. Command '%s' "
-                     "returned %d:\n%s" % (' '.join(cmd), e.returncode, e.output.decode("utf-8")))
-        return dpkg_query(cmd_output)
+    def list_installed(self, with_deps=True):
+        return self.dpkg_status.list_installed()
 
     def update(self):
+        lists_dir = os.path.join(self.target_rootfs, "var/lib/apt/lists")
+        # apt only downloads the indexes whose InRelease/Release changed
+        if self.metadata_cache:
+            if not self.metadata_cache.restore(self.apt_sources, lists_dir) and self.metadata_cache.offline:
+                raise Exception("No cached metadata of package feeds for offline mode:\n%s" % self.apt_sources)
+            if self.metadata_cache.offline:
+                logger.info("Use cached metadata of package feeds offline")
+                return
+
         cmd = "PATH=%s " % self.chroot_path
         cmd += "chroot %s apt update" % self.target_rootfs
         try:
@@ -617,6 +826,10 @@ class ExternalDebian(object):
             raise Exception("Unable to update the package index files. Command '%s' "
                      "returned %d:\n%s" % (e.cmd, e.returncode, e.output.decode("utf-8")))
 
+        if self.metadata_cache:
+            names = [f for f in os.listdir(lists_dir) if f != "lock" and os.path.isfile(os.path.join(lists_dir, f))]
+            self.metadata_cache.save(self.apt_sources, lists_dir, names)
+
     def install(self, pkgs, attempt_only=False):
         logger.debug("apt install: %s, attemplt %s" % (pkgs, attempt_only))
         if len(pkgs) == 0:
@@ -628,6 +841,11 @@ class ExternalDebian(object):
         subcmd_args = "--no-install-recommends " if os.environ.get('NO_RECOMMENDATIONS', '0') == '1' else ""
         subcmd_args += "-y --allow-downgrades --allow-remove-essential --allow-change-held-packages --allow-unauthenticated %s" % \
               (' '.join(pkgs))
+        archives_dir = os.path.join(self.target_rootfs, "var/cache/apt/archives")
+        if self.pkg_cache:
+            checksums = packages_checksums(os.path.join(self.target_rootfs, "var/lib/apt/lists"))
+            fetched = self.pkg_cache.fetch(checksums, archives_dir)
+
         cmd = "PATH=%s " % self.chroot_path
         cmd += "chroot %s apt install %s" % (self.target_rootfs, subcmd_args)
         logger.debug('Running %s' % cmd)
@@ -641,6 +859,12 @@ class ExternalDebian(object):
                 raise Exception("Could not invoke apt. Command '%s' "
                          "returned %d:\n%s" % (e.cmd, e.returncode, e.output.decode("utf-8")))
 
+        if self.pkg_cache:
+            self.pkg_cache.save(checksums, archives_dir)
+            # Do not leave the debs which are not downloaded by apt in rootfs
+            for filename in fetched:
+                utils.remove(os.path.join(archives_dir, filename))
+
         utils.umount(self.target_rootfs)
 
         return
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import os.path
+import re
+import json
+import hashlib
+import fnmatch
+import logging
+
+logger = logging.getLogger('appsdk')
+
+PKGDATA_INDEX_VERSION = 2
+
+# Packages for which there is no point applying globs, the same as oe-pkgdata-util
+GLOB_SKIP_REGEX = "-locale-|^locale-base-|-dev$|-doc$|-dbg$|-staticdev$|^kernel-module-"
+
+class PkgdataIndex(object):
+    """
+    Index of the runtime and runtime-reverse dirs of pkgdata, which has
+    what `oe-pkgdata-util glob' reads from pkgdata:
+    - reverse: runtime package name -> recipe package name
+    - runtime: recipe package name -> [PN, renamed package name]
+    - packaged: recipe package names which have been packaged
+
+    It is built once and saved to index_file, and built again when any
+    file of the pkgdata dirs is added, removed or modified.
+    """
+    def __init__(self, pkgdatadir, index_file):
+        self.pkgdatadir = pkgdatadir
+        self.index_file = index_file
+        self.index = None
+
+    def stamp(self):
+        """
+        The digest of the names, sizes and mtimes of the files in pkgdata
+        dirs, rewriting a file in place does not change the dir mtime
+        """
+        stamp = hashlib.sha256()
+        for subdir in ["runtime", "runtime-reverse"]:
+            path = os.path.join(self.pkgdatadir, subdir)
+            if not os.path.exists(path):
+                continue
+            stamp.update(b"%s\0" % subdir.encode())
+            entries = []
+            for entry in os.scandir(path):
+                st = entry.stat(follow_symlinks=False)
+                entries.append("%s %d %d" % (entry.name, st.st_size, st.st_mtime_ns))
+            stamp.update("\0".join(sorted(entries)).encode(errors="surrogateescape"))
+        return stamp.hexdigest()
+
+    def _read_runtime(self, pkg):
+        pn = renamed = ""
+        with open(os.path.join(self.pkgdatadir, "runtime", pkg), 'r') as f:
+            for line in f:
+                if line.startswith("PN:"):
+                    pn = line.split(': ')[1].rstrip()
+                elif line.startswith("PKG:%s:" % pkg) or line.startswith("PKG_%s:" % pkg):
+                    renamed = line.split(': ')[1].rstrip()
+        return [pn, renamed]
+
+    def _build(self):
+        logger.debug("Build pkgdata index of %s" % self.pkgdatadir)
+        index = {"version": PKGDATA_INDEX_VERSION,
+                 "pkgdatadir": self.pkgdatadir,
+                 "stamp": self.stamp(),
+                 "reverse": {},
+                 "runtime": {},
+                 "packaged": []}
+
+        runtime_dir = os.path.join(self.pkgdatadir, "runtime")
+        if os.path.exists(runtime_dir):
+            for entry in os.scandir(runtime_dir):
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".packaged"):
+                    index["packaged"].append(entry.name[:-len(".packaged")])
+                else:
+                    index["runtime"][entry.name] = self._read_runtime(entry.name)
+
+        reverse_dir = os.path.join(self.pkgdatadir, "runtime-reverse")
+        if os.path.exists(reverse_dir):
+            for entry in os.scandir(reverse_dir):
+                if entry.is_symlink():
+                    index["reverse"][entry.name] = os.path.basename(os.readlink(entry.path))
+
+        tmp_file = "%s.tmp-%d" % (self.index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_file, self.index_file)
+        return index
+
+    def load(self):
+        if self.index is not None:
+            return self.index
+
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as f:
+                    index = json.load(f)
+                if index.get("version") == PKGDATA_INDEX_VERSION and \
+                        index.get("pkgdatadir") == self.pkgdatadir and \
+                        index.get("stamp") == self.stamp():
+                    self.index = index
+            except ValueError:
+                logger.debug("Invalid pkgdata index %s, build it again" % self.index_file)
+
+        if self.index is None:
+            self.index = self._build()
+        self.index["packaged"] = set(self.index["packaged"])
+        return self.index
+
+    def glob(self, pkgs, globs, exclude=None):
+        """
+        Expand globs (such as *-dev) for the installed package names pkgs,
+        the same as `oe-pkgdata-util glob'
+        """
+        index = self.load()
+        reverse = index["reverse"]
+        runtime = index["runtime"]
+        packaged = index["packaged"]
+
+        def renamed(pkg):
+            return runtime[pkg][1] if pkg in runtime else pkg
+
+        skipval = GLOB_SKIP_REGEX
+        if exclude:
+            skipval += "|" + exclude
+        skipregex = re.compile(skipval)
+
+        skippedpkgs = set()
+        mappedpkgs = set()
+        for pkg in pkgs:
+            # Skip packages that already match the globs
+            if skipregex.search(pkg) or any(fnmatch.fnmatchcase(pkg, g) for g in globs):
+                skippedpkgs.add(pkg)
+                continue
+
+            for g in globs:
+                mappedpkg = ""
+                # First just try substitution (i.e. packagename -> packagename-dev)
+                newpkg = g.replace("*", pkg)
+                if newpkg in reverse:
+                    fwdpkg = reverse[newpkg]
+                    mappedpkg = renamed(fwdpkg)
+                elif pkg in reverse:
+                    # Check if we can map after undoing the package renaming
+                    origpkg = reverse[pkg]
+                    fwdpkg = g.replace("*", origpkg)
+                    if fwdpkg not in runtime:
+                        # That didn't work, so now get the PN, substitute that
+                        pn = runtime[origpkg][0] if origpkg in runtime else ""
+                        fwdpkg = g.replace("*", pn)
+                    if fwdpkg in runtime:
+                        mappedpkg = renamed(fwdpkg)
+                else:
+                    logger.debug("%s is not a valid package!" % (pkg))
+                    break
+
+                if fwdpkg not in packaged:
+                    mappedpkg = ""
+                if mappedpkg:
+                    mappedpkgs.add(mappedpkg)
+
+        return mappedpkgs - skippedpkgs
@@ -18,12 +18,18 @@ import logging
 import os
 import sys
 import shutil
-import subprocess
 import collections
 import hashlib
 import re
-import tempfile
+import glob
 import configparser
+import gzip
+import lzma
+import bz2
+import uuid
+import ssl
+from urllib.request import urlopen
+from xml.etree import ElementTree
 
 from genimage.utils import set_logger
 from genimage.constant import DEFAULT_LOCAL_RPM_PACKAGE_FEED
@@ -32,6 +38,119 @@ from genimage.package_manager import failed_postinsts_abort
 import genimage.utils as utils
 logger = logging.getLogger('appsdk')
 
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+
+def _open_compressed(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    elif path.endswith(".xz"):
+        return lzma.open(path, 'rb')
+    elif path.endswith(".bz2"):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+def repodata_checksums(repo_dir):
+    """
+    Parse the primary metadata in repo_dir/repodata, return a dict which
+    maps rpm file names to (checksum_type, checksum)
+    """
+    checksums = dict()
+    repomd = os.path.join(repo_dir, "repodata", "repomd.xml")
+    if not os.path.exists(repomd):
+        return checksums
+
+    primary = None
+    for data in ElementTree.parse(repomd).getroot().iter(REPO_NS + "data"):
+        if data.get("type") == "primary":
+            primary = os.path.join(repo_dir, data.find(REPO_NS + "location").get("href"))
+            break
+    if primary is None or not os.path.exists(primary):
+        return checksums
+
+    with _open_compressed(primary) as f:
+        for event, elem in ElementTree.iterparse(f):
+            if elem.tag != COMMON_NS + "package":
+                continue
+            checksum = elem.find(COMMON_NS + "checksum")
+            location = elem.find(COMMON_NS + "location")
+            if checksum is not None and location is not None:
+                checksums[os.path.basename(location.get("href"))] = (checksum.get("type"), checksum.text)
+            elem.clear()
+
+    return checksums
+
+class InstalledPackage(object):
+    """
+    Compact record of an installed package in list_installed(), it reads
+    like the dict {"arch", "ver", "filename", "deps"} which the other
+    package managers return. deps is None if not queried.
+    """
+    __slots__ = ("arch", "ver", "filename", "deps")
+
+    def __init__(self, arch, ver, filename, deps=None):
+        self.arch = arch
+        self.ver = ver
+        self.filename = filename
+        self.deps = deps
+
+    def keys(self):
+        return [k for k in self.__slots__ if getattr(self, k) is not None]
+
+    def __getitem__(self, key):
+        value = getattr(self, key) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+REPOQUERY_PACKAGE_FORMAT = "Package: %{name} %{arch} %{version} %{name}-%{version}-%{release}.%{arch}.rpm\n"
+REPOQUERY_DEPS_FORMAT = REPOQUERY_PACKAGE_FORMAT + \
+    "Dependencies:\n%{requires}\nRecommendations:\n%{recommends}\nDependenciesEndHere:\n"
+
+def parse_repoquery(lines):
+    """
+    Parse the lines of `dnf repoquery' output in REPOQUERY_PACKAGE_FORMAT or
+    REPOQUERY_DEPS_FORMAT, yield (name, InstalledPackage) per package. The
+    strings repeated across packages are interned.
+    """
+    intern = sys.intern
+    name = record = deps = None
+    state = "initial"
+    for line in lines:
+        if line.startswith("Package:"):
+            if record is not None:
+                yield name, record
+            fields = line.split(" ")
+            name = intern(fields[1])
+            record = InstalledPackage(intern(fields[2]), intern(fields[3]), fields[4])
+            state = "initial"
+        elif record is None:
+            continue
+        elif line.startswith("Dependencies:"):
+            deps = []
+            state = "dependencies"
+        elif line.startswith("Recommendations"):
+            state = "recommendations"
+        elif line.startswith("DependenciesEndHere:"):
+            state = "initial"
+            record.deps = deps
+        elif line:
+            if state == "dependencies":
+                deps.append(intern(line))
+            elif state == "recommendations":
+                deps.append(intern("%s [REC]" % line))
+    if record is not None:
+        yield name, record
+
 class DnfRpm(PackageManager):
     def _configure_dnf(self):
         # libsolv handles 'noarch' internally, we don't need to specify it explicitly
@@ -82,6 +201,8 @@ class DnfRpm(PackageManager):
         os.environ['INTERCEPT_DIR'] = self.intercepts_dir
         os.environ['NATIVE_ROOT'] = os.environ['OECORE_NATIVE_SYSROOT']
         os.environ['RPM_NO_CHROOT_FOR_SCRIPTS'] = "1"
+        # The installed packages are going to change
+        self.installed_cache = None
 
     def get_gpgkey(self):
         return None
@@ -131,7 +252,7 @@ class DnfRpm(PackageManager):
                 open(os.path.join(self.temp_dir, "yum.repos.d", repo_base + ".repo"), 'w').write(
                         "[%s]\nname=%s\nbaseurl=%s\n%s" % (repo_base, repo_name, repo_uri, gpg_opts))
 
-    def _invoke_dnf(self, dnf_args, fatal = True, print_output = True ):
+    def _dnf_cmd(self, dnf_args):
         os.environ['RPM_ETCCONFIGDIR'] = self.target_rootfs
         path = os.getenv('PATH')
         python3native = os.path.join(os.environ['OECORE_NATIVE_SYSROOT'], 'usr/bin/python3-native')
@@ -146,6 +267,9 @@ class DnfRpm(PackageManager):
                              "--installroot=%s" % (self.target_rootfs),
                              "--setopt=logdir=%s" % (self.temp_dir)
                             ]
+        # Metadata freshness is taken care of by update()
+        if self.metadata_cache:
+            standard_dnf_args.append("--setopt=metadata_expire=never")
         if hasattr(self, "rpm_repo_dir"):
             standard_dnf_args.append("--repofrompath=oe-repo,%s" % (self.rpm_repo_dir))
         cmd = [dnf_cmd] + standard_dnf_args + dnf_args
@@ -153,6 +277,10 @@ class DnfRpm(PackageManager):
 
         env = os.environ.copy()
         env['PATH'] = path
+        return cmd, env
+
+    def _invoke_dnf(self, dnf_args, fatal = True, print_output = True ):
+        cmd, env = self._dnf_cmd(dnf_args)
         res, output = utils.run_cmd(cmd, print_output=print_output, env=env)
         if res:
             logger.error("Could not invoke dnf. Command "
@@ -161,6 +289,17 @@ class DnfRpm(PackageManager):
             sys.exit(1)
         return output
 
+    def _iter_dnf(self, dnf_args):
+        """
+        Invoke dnf and yield the lines of its output as they are read
+        """
+        cmd, env = self._dnf_cmd(dnf_args)
+        try:
+            yield from utils.run_cmd_lines(cmd, env=env)
+        except Exception as e:
+            logger.error("Could not invoke dnf. %s" % e)
+            sys.exit(1)
+
     def set_exclude(self, package_exclude = None):
         if not package_exclude:
             return
@@ -171,7 +310,7 @@ class DnfRpm(PackageManager):
 
     def post_install(self):
         logger.debug("post_install")
-        if 'dnf' in self.list_installed():
+        if 'dnf' in self.list_installed(with_deps=False):
             self._set_target_dnf_conf()
 
     def _set_target_dnf_conf(self):
@@ -205,6 +344,9 @@ class DnfRpm(PackageManager):
         exclude_pkgs = (self.bad_recommendations.split() if self.bad_recommendations else [])
         exclude_pkgs += (self.package_exclude if self.package_exclude else [])
 
+        if self.pkg_cache:
+            self._fetch_cached_packages()
+
         output = self._invoke_dnf((["--skip-broken"] if attempt_only else []) +
                          (["-x", ",".join(exclude_pkgs)] if len(exclude_pkgs) > 0 else []) +
                          (["--setopt=install_weak_deps=False"] if os.environ.get('NO_RECOMMENDATIONS', '0') == '1' else []) +
@@ -212,6 +354,9 @@ class DnfRpm(PackageManager):
                          ["install"] +
                          pkgs)
 
+        if self.pkg_cache:
+            self._save_cached_packages()
+
         failed_scriptlets_pkgnames = collections.OrderedDict()
         for line in output.splitlines():
             if line.startswith("Error in POSTIN scriptlet in rpm package"):
@@ -240,6 +385,16 @@ class DnfRpm(PackageManager):
                      "'%s' returned %d:\n%s" % (' '.join([cmd] + args + pkgs), res, output))
 
 
+    def remove_unneeded(self, pkgs):
+        logger.debug("dnf remove unneeded: %s" % (pkgs))
+        if not pkgs:
+            return
+
+        # Mark them as dependencies, autoremove drops the ones nothing requires
+        self._prepare_pkg_transaction()
+        self._invoke_dnf(["mark", "remove"] + pkgs)
+        self._invoke_dnf(["autoremove"])
+
     def upgrade(self):
         self._prepare_pkg_transaction()
         self._invoke_dnf(["upgrade"])
@@ -248,39 +403,113 @@ class DnfRpm(PackageManager):
         self._prepare_pkg_transaction()
         self._invoke_dnf(["autoremove"])
 
-    def list_installed(self):
-        output = self._invoke_dnf(["repoquery", "--installed", "--queryformat", "Package: %{name} %{arch} %{version} %{name}-%{version}-%{release}.%{arch}.rpm\nDependencies:\n%{requires}\nRecommendations:\n%{recommends}\nDependenciesEndHere:\n"],
-                                  print_output = False)
-        packages = {}
-        current_package = None
-        current_deps = None
-        current_state = "initial"
-        for line in output.splitlines():
-            if line.startswith("Package:"):
-                package_info = line.split(" ")[1:]
-                current_package = package_info[0]
-                package_arch = package_info[1]
-                package_version = package_info[2]
-                package_rpm = package_info[3]
-                packages[current_package] = {"arch":package_arch, "ver":package_version, "filename":package_rpm}
-                current_deps = []
-            elif line.startswith("Dependencies:"):
-                current_state = "dependencies"
-            elif line.startswith("Recommendations"):
-                current_state = "recommendations"
-            elif line.startswith("DependenciesEndHere:"):
-                current_state = "initial"
-                packages[current_package]["deps"] = current_deps
-            elif len(line) > 0:
-                if current_state == "dependencies":
-                    current_deps.append(line)
-                elif current_state == "recommendations":
-                    current_deps.append("%s [REC]" % line)
-
-        return packages
+    def list_installed(self, with_deps=True):
+        """
+        Return a dict of name -> InstalledPackage, the requires and
+        recommends are only queried if with_deps is set
+        """
+        if self.installed_cache is None or (with_deps and not self.installed_cache[0]):
+            self.installed_cache = (with_deps, self._query_installed(with_deps))
+        return dict(self.installed_cache[1])
+
+    def _query_installed(self, with_deps=True):
+        queryformat = REPOQUERY_DEPS_FORMAT if with_deps else REPOQUERY_PACKAGE_FORMAT
+        return dict(parse_repoquery(self._iter_dnf(["repoquery", "--installed", "--queryformat", queryformat])))
+
+    def _get_repos(self):
+        repos = collections.OrderedDict()
+        for repo in sorted(glob.glob(os.path.join(self.temp_dir, "yum.repos.d", "*.repo"))):
+            config = configparser.ConfigParser(interpolation=None)
+            config.read(repo)
+            for repo_id in config.sections():
+                repos[repo_id] = config.get(repo_id, "baseurl", fallback="")
+        return repos
+
+    def _repo_metadata_names(self, repo_id):
+        """
+        Return paths relative to dnfcache of the metadata and solv files
+        of repo_id
+        """
+        dnfcache = os.path.join(self.workdir, "dnfcache")
+        names = [os.path.relpath(d, dnfcache) for d in glob.glob(os.path.join(dnfcache, repo_id + "-*", "repodata"))]
+        names += [repo_id + ".solv", repo_id + "-filenames.solvx"]
+        return names
+
+    def _repomd_in_sync(self, repo_id, baseurl):
+        cached = glob.glob(os.path.join(self.workdir, "dnfcache", repo_id + "-*", "repodata", "repomd.xml"))
+        if not cached:
+            return False
+
+        url = baseurl.rstrip("/") + "/repodata/repomd.xml"
+        if url.startswith("/"):
+            url = "file://" + url
+        context = None
+        if utils.is_sdk() and url.startswith("https://"):
+            context = ssl.create_default_context(cafile=os.path.join(os.environ["OECORE_NATIVE_SYSROOT"], "etc/ssl/certs/ca-certificates.crt"))
+        try:
+            with urlopen(url, timeout=60, context=context) as f:
+                remote = f.read()
+        except Exception as e:
+            logger.debug("Fetch %s failed: %s", url, e)
+            return False
+
+        with open(cached[0], 'rb') as f:
+            return f.read() == remote
 
     def update(self):
+        if not self.metadata_cache:
+            self._invoke_dnf(["makecache", "--refresh"])
+            return
+
+        dnfcache = os.path.join(self.workdir, "dnfcache")
+        repos = self._get_repos()
+        in_sync = True
+        for repo_id, baseurl in repos.items():
+            if not self.metadata_cache.restore(baseurl, dnfcache):
+                if self.metadata_cache.offline:
+                    raise Exception("No cached metadata of package feed %s for offline mode" % baseurl)
+                in_sync = False
+            elif not self.metadata_cache.offline and in_sync:
+                in_sync = self._repomd_in_sync(repo_id, baseurl)
+
+        if self.metadata_cache.offline:
+            logger.info("Use cached metadata of package feeds offline")
+            return
+        if in_sync:
+            logger.info("Metadata of package feeds not changed, skip refreshing")
+            return
+
+        # dnf only downloads the metadata of the repos whose repomd.xml changed
         self._invoke_dnf(["makecache", "--refresh"])
+        for repo_id, baseurl in repos.items():
+            self.metadata_cache.save(baseurl, dnfcache, self._repo_metadata_names(repo_id))
+
+    def _repo_cache_dirs(self):
+        repo_dirs = []
+        for repo in glob.glob(os.path.join(self.temp_dir, "yum.repos.d", "*.repo")):
+            repo_id = os.path.basename(repo)[:-len(".repo")]
+            repo_dirs.extend(glob.glob(os.path.join(self.workdir, "dnfcache", repo_id + "-*", "")))
+        return repo_dirs
+
+    def metadata_files(self):
+        files = []
+        for repo_dir in self._repo_cache_dirs():
+            repomd = os.path.join(repo_dir, "repodata", "repomd.xml")
+            if os.path.exists(repomd):
+                files.append(repomd)
+        return files
+
+    def _fetch_cached_packages(self):
+        self.repo_checksums = dict()
+        for repo_dir in self._repo_cache_dirs():
+            self.repo_checksums[repo_dir] = repodata_checksums(repo_dir)
+            self.pkg_cache.fetch(self.repo_checksums[repo_dir], os.path.join(repo_dir, "packages"))
+
+    def _save_cached_packages(self):
+        for repo_dir, checksums in self.repo_checksums.items():
+            pkg_dir = os.path.join(repo_dir, "packages")
+            if os.path.exists(pkg_dir):
+                self.pkg_cache.save(checksums, pkg_dir)
 
     def _script_num_prefix(self, path):
         files = os.listdir(path)
@@ -290,66 +519,50 @@ class DnfRpm(PackageManager):
             numbers.add(int(f.split("-")[0]))
         return max(numbers) + 1
 
-    def save_rpmpostinst(self, pkg):
-        logger.debug("Saving postinstall script of %s" % (pkg))
+    def save_rpmpostinsts(self, pkgs):
+        """
+        Save the postinstall scripts of pkgs to /etc/rpm-postinsts in
+        order, they are queried by one rpm command
+        """
+        if not pkgs:
+            return
+        logger.debug("Saving postinstall scripts of %s" % ' '.join(pkgs))
+
+        # A marker which is not in any script splits the output into
+        # name, script, name, script...
+        marker = "##POSTIN-%s##" % uuid.uuid4().hex
         cmd = shutil.which("rpm", path=os.getenv('PATH'))
-        args = ["-q", "--root=%s" % self.target_rootfs, "--queryformat", "%{postin}", pkg]
-        res, output = utils.run_cmd([cmd] + args)
+        args = ["-q", "--root=%s" % self.target_rootfs, "--queryformat",
+                "%%{name}%s%%{postin}%s" % (marker, marker)] + pkgs
+        res, output = utils.run_cmd([cmd] + args, print_output=False)
         if res:
             raise Exception("Could not invoke rpm. Command "
                      "'%s' returned %d:\n%s" % (' '.join([cmd] + args), res, output))
 
+        fields = output.split(marker)[:-1]
+        scripts = dict(zip(fields[0::2], fields[1::2]))
+        missing = [pkg for pkg in pkgs if pkg not in scripts]
+        if missing:
+            raise Exception("Could not query postinstall scripts of %s:\n%s" % (' '.join(missing), output))
+
         # may need to prepend #!/bin/sh to output
 
         target_path = os.path.join(self.target_rootfs, 'etc/rpm-postinsts/')
         utils.mkdirhier(target_path)
         num = self._script_num_prefix(target_path)
-        saved_script_name = os.path.join(target_path, "%d-%s" % (num, pkg))
-        open(saved_script_name, 'w').write(output)
-        os.chmod(saved_script_name, 0o755)
+        for pkg in pkgs:
+            saved_script_name = os.path.join(target_path, "%d-%s" % (num, pkg))
+            with open(saved_script_name, 'w') as f:
+                f.write(scripts[pkg])
+            os.chmod(saved_script_name, 0o755)
+            num += 1
 
     def _handle_intercept_failure(self, registered_pkgs):
         rpm_postinsts_dir = self.target_rootfs + '/etc/rpm-postinsts/'
         utils.mkdirhier(rpm_postinsts_dir)
 
         # Save the package postinstalls in /etc/rpm-postinsts
-        for pkg in registered_pkgs.split():
-            self.save_rpmpostinst(pkg)
-
-    def install_complementary(self, globs=""):
-        """
-        Install complementary packages based upon the list of currently installed
-        packages e.g. *-src, *-dev, *-dbg, etc. This will only attempt to install
-        these packages, if they don't exist then no error will occur.
-        """
-        if not globs:
-            return
-
-        logger.debug("Installing complementary packages (%s) ..." % globs)
-        # we need to write the list of installed packages to a file because the
-        # oe-pkgdata-util reads it from a file
-        with tempfile.NamedTemporaryFile(mode="w+", prefix="installed-pkgs") as installed_pkgs:
-            pkgs = self.list_installed()
-
-            provided_pkgs = set()
-            for pkg in pkgs.values():
-                provided_pkgs |= set(pkg.get('provs', []))
-
-            output = utils.format_pkg_list(pkgs, "arch")
-            installed_pkgs.write(output)
-            installed_pkgs.flush()
-
-            cmd = '%s -p %s glob %s %s' % (self.oe_pkgdata_util, self.pkgdatadir, installed_pkgs.name, globs)
-            logger.debug(cmd)
-            output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode('utf-8')
-
-            complementary_pkgs = set(output.split())
-            skip_pkgs = sorted(complementary_pkgs & provided_pkgs)
-            install_pkgs = sorted(complementary_pkgs - provided_pkgs)
-            logger.debug("Installing complementary packages ... %s (skipped already provided packages %s)" % (
-                ' '.join(install_pkgs),
-                ' '.join(skip_pkgs)))
-            self.install(install_pkgs, attempt_only=True)
+        self.save_rpmpostinsts(registered_pkgs.split())
 
 def test():
     from genimage.constant import DEFAULT_RPM_PACKAGE_FEED
@@ -0,0 +1,209 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Profiler of gen* commands enabled by --profile.
+
+Phases (the steps decorated by show_task_info and the ones wrapped by
+phase()) and the commands run by run_cmd are recorded with wall time,
+CPU user/sys time, peak RSS and I/O bytes from /proc/<pid>/io. Events are
+appended to a file as json lines, so the ones of the tasks running in
+forked processes are kept. At exit they are written to the deploy dir:
+- <name>-profile.json: the events and the totals of each phase name
+- <name>-trace.json: Chrome trace events, load it in chrome://tracing
+  or https://ui.perfetto.dev
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('appsdk')
+
+PROFILE_VERSION = 1
+
+_profiler = None
+
+def read_proc_io(pid="self"):
+    """
+    Return the counters of /proc/<pid>/io, an empty dict if unavailable
+    """
+    counters = dict()
+    try:
+        with open("/proc/%s/io" % pid, 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+def _io_fields(counters):
+    return dict((k, counters.get(k, 0)) for k in ["rchar", "wchar", "read_bytes", "write_bytes"])
+
+class Profiler(object):
+    def __init__(self, events_file, output_prefix):
+        self.events_file = events_file
+        self.output_prefix = output_prefix
+        self.pid = os.getpid()
+        self.start = time.time()
+        # Truncate the events of previous runs
+        open(self.events_file, 'w').close()
+
+    def add_event(self, event):
+        event.setdefault("pid", os.getpid())
+        event.setdefault("tid", threading.get_ident())
+        data = (json.dumps(event, separators=(',', ':')) + "\n").encode()
+        # A single write of O_APPEND, so the lines of processes do not mix
+        fd = os.open(self.events_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _load_events(self):
+        events = []
+        with open(self.events_file, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logger.debug("Skip invalid profile event: %s", line)
+        return sorted(events, key=lambda e: e["start"])
+
+    def write(self):
+        # Forked task processes do not write
+        if os.getpid() != self.pid:
+            return
+
+        events = self._load_events()
+        end = time.time()
+        totals = dict()
+        for e in events:
+            if e["type"] != "phase":
+                continue
+            total = totals.setdefault(e["name"], {"count": 0, "wall": 0.0, "utime": 0.0, "stime": 0.0})
+            total["count"] += 1
+            for k in ["wall", "utime", "stime"]:
+                total[k] += e[k]
+
+        profile = {"version": PROFILE_VERSION,
+                   "command": sys.argv,
+                   "start": self.start,
+                   "wall": end - self.start,
+                   "phases": sorted(([k, v] for k, v in totals.items()), key=lambda t: -t[1]["wall"]),
+                   "events": events}
+        profile_file = self.output_prefix + "-profile.json"
+        with open(profile_file, 'w') as f:
+            json.dump(profile, f, indent=1)
+
+        trace = []
+        for e in events:
+            args = dict((k, v) for k, v in e.items() if k not in ["name", "start", "end", "pid", "tid"])
+            trace.append({"name": e["name"],
+                          "cat": e["type"],
+                          "ph": "X",
+                          "ts": int((e["start"] - self.start) * 1000000),
+                          "dur": int((e["end"] - e["start"]) * 1000000),
+                          "pid": e["pid"],
+                          "tid": e["tid"],
+                          "args": args})
+        trace_file = self.output_prefix + "-trace.json"
+        with open(trace_file, 'w') as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+        logger.info("Profile: %s\nChrome trace: %s", profile_file, trace_file)
+        for name, total in profile["phases"]:
+            logger.info("  %-40s %8.1fs wall %8.1fs user %8.1fs sys", name, total["wall"], total["utime"], total["stime"])
+
+def enable(events_file, output_prefix):
+    global _profiler
+    _profiler = Profiler(events_file, output_prefix)
+    atexit.register(_profiler.write)
+    logger.debug("Profiling to %s", events_file)
+
+def is_enabled():
+    return _profiler is not None
+
+@contextmanager
+def phase(name):
+    """
+    Record the block as a phase, the CPU time includes the children
+    waited for in this process. There is no peak memory of a phase,
+    ru_maxrss is the high-water mark of the whole process lifetime, the
+    commands record their own.
+    """
+    if _profiler is None:
+        yield
+        return
+
+    start = time.time()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_start = _io_fields(read_proc_io())
+    try:
+        yield
+    finally:
+        end = time.time()
+        usage_self_end = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_end = _io_fields(read_proc_io())
+        event = {"type": "phase",
+                 "name": name,
+                 "start": start,
+                 "end": end,
+                 "wall": end - start,
+                 "utime": usage_self_end.ru_utime - usage_self.ru_utime + usage_children_end.ru_utime - usage_children.ru_utime,
+                 "stime": usage_self_end.ru_stime - usage_self.ru_stime + usage_children_end.ru_stime - usage_children.ru_stime}
+        event.update((k, io_end[k] - io_start[k]) for k in io_end)
+        _profiler.add_event(event)
+
+def profiled(name):
+    """
+    Decorator which records each call of the function as a phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_cmd(cmd, start, end, rusage, io_counters):
+    """
+    Record a command run by run_cmd, rusage is from os.wait4() and
+    io_counters from /proc/<pid>/io of the exited process
+    """
+    if _profiler is None:
+        return
+    event = {"type": "cmd",
+             "name": (cmd if isinstance(cmd, str) else ' '.join(cmd)).split()[0] if cmd else "",
+             "cmd": cmd if isinstance(cmd, str) else ' '.join(cmd),
+             "start": start,
+             "end": end,
+             "wall": end - start,
+             "utime": rusage.ru_utime,
+             "stime": rusage.ru_stime,
+             "maxrss_kb": rusage.ru_maxrss}
+    event.update(_io_fields(io_counters))
+    _profiler.add_event(event)
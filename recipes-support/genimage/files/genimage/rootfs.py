@@ -24,6 +24,8 @@ from tempfile import NamedTemporaryFile
 from genimage.package_manager import get_pm_class
 from genimage.constant import DEFAULT_IMAGE_PKGTYPE
 import genimage.utils as utils
+from genimage.profiler import profiled
+import genimage.profiler as profiler
 from genimage.utils import yaml
 
 logger = logging.getLogger('appsdk')
@@ -41,7 +43,11 @@ class Rootfs(object):
                  target_rootfs=None,
                  image_linguas=None,
                  pkgtype=DEFAULT_IMAGE_PKGTYPE,
-                 pkg_globs=None):
+                 pkg_globs=None,
+                 rootfs_cache=None,
+                 incremental=False,
+                 pkg_cache=None,
+                 metadata_cache=None):
 
         self.workdir = workdir
         self.data_dir = data_dir
@@ -61,6 +67,7 @@ class Rootfs(object):
         else:
             self.target_rootfs = os.path.join(self.workdir, "rootfs")
         self.packages_yaml = os.path.join(self.workdir, "packages.yaml")
+        self.inputs_yaml = os.path.join(self.workdir, "rootfs_inputs.yaml")
 
         self.rootfs_pre_scripts = [os.path.join(self.data_dir, 'pre_rootfs', 'create_merged_usr_symlinks.sh')]
         if remote_pkgdatadir and utils.is_sdk():
@@ -73,9 +80,11 @@ class Rootfs(object):
 
         PackageManager = get_pm_class(pkgtype=pkgtype)
         if remote_pkgdatadir:
-            self.pm = PackageManager(self.workdir, self.target_rootfs, self.machine, remote_pkgdatadir)
+            self.pm = PackageManager(self.workdir, self.target_rootfs, self.machine, remote_pkgdatadir,
+                                     pkg_cache=pkg_cache, metadata_cache=metadata_cache)
         else:
-            self.pm = PackageManager(self.workdir, self.target_rootfs, self.machine)
+            self.pm = PackageManager(self.workdir, self.target_rootfs, self.machine,
+                                     pkg_cache=pkg_cache, metadata_cache=metadata_cache)
 
         self.pm.create_configs()
 
@@ -84,6 +93,13 @@ class Rootfs(object):
         utils.fake_root_set_passwd(self.target_rootfs)
 
         self.rootfs_post_scripts = []
+        self.rootfs_post_funcs = []
+        # The post scripts and funcs which could run again on a post
+        # processed rootfs, the others prevent the incremental update
+        self.idempotent_post = set()
+        self.environments = []
+        self.rootfs_cache = rootfs_cache
+        self.incremental = incremental
 
     def _image_linguas_globs(self, image_linguas=""):
         logger.debug("image_linguas %s", image_linguas)
@@ -105,7 +121,11 @@ class Rootfs(object):
         logger.debug("globs %s", globs)
         return globs
 
-    def add_rootfs_post_scripts(self, script_cmd=None):
+    def add_rootfs_post_scripts(self, script_cmd=None, idempotent=False):
+        """
+        Set idempotent if running the script again on its own output
+        makes no difference, such as the scripts which set a value
+        """
         if script_cmd is None:
             return
 
@@ -114,16 +134,38 @@ class Rootfs(object):
                                             "/etc/sysdef/run_on_upgrade.d/%s/" % utils.get_today())
 
         self.rootfs_post_scripts.append(script_cmd)
+        if idempotent:
+            self.idempotent_post.add(script_cmd)
 
     def add_rootfs_pre_scripts(self, script_cmd=None):
         if script_cmd is None:
             return
         self.rootfs_pre_scripts.append(script_cmd)
 
-    def _pre_rootfs(self):
+    def add_rootfs_post_funcs(self, func=None, idempotent=False):
+        """
+        The func is called with no argument after packages installed and
+        before rootfs post scripts, the rootfs cache does not cover it
+        """
+        if func is None:
+            return
+        self.rootfs_post_funcs.append(func)
+        if idempotent:
+            self.idempotent_post.add(func)
+
+    def add_environment(self, env=None):
+        if env is None:
+            return
+        self.environments.append(env)
+
+    @profiled("Rootfs pre scripts")
+    def _pre_rootfs(self, run_scripts=True):
         os.environ['IMAGE_ROOTFS'] = self.pm.target_rootfs
         os.environ['libexecdir'] = '/usr/libexec'
 
+        if not run_scripts:
+            return
+
         for script in self.rootfs_pre_scripts:
             logger.debug("Executing '%s' preprocess rootfs..." % script)
             scriptFile = NamedTemporaryFile(delete=True, dir=".")
@@ -137,7 +179,11 @@ class Rootfs(object):
                 raise Exception("Executing %s postprocess rootfs failed\nExit code %d. Output:\n%s"
                                    % (script, res, output))
 
+    @profiled("Rootfs post scripts")
     def _post_rootfs(self):
+        for func in self.rootfs_post_funcs:
+            func()
+
         for script in self.rootfs_post_scripts:
             logger.debug("Executing '%s' postprocess rootfs..." % script)
             scriptFile = NamedTemporaryFile(delete=True, dir=".")
@@ -153,19 +199,79 @@ class Rootfs(object):
 
     def _save_installed(self):
         for k, v in self.pm.list_installed().items():
-            self.installed_pkgs[k] = v
+            self.installed_pkgs[k] = dict(v)
 
         with open(self.packages_yaml, "w") as f:
             yaml.dump(self.installed_pkgs, f)
             logger.debug("Save Installed Packages Yaml File to : %s" % (self.packages_yaml))
 
-    def create(self):
-        self._pre_rootfs()
+    def _get_inputs(self):
+        return {
+            'machine': self.machine,
+            'pkgtype': self.pm.__class__.__name__,
+            'pkg_feeds': self.pkg_feeds,
+            'packages': self.packages,
+            'external_packages': self.external_packages,
+            'exclude_packages': self.exclude_packages,
+            'pkg_globs': self.pkg_globs,
+            'rootfs_pre_scripts': self.rootfs_pre_scripts,
+            'environments': self.environments,
+        }
+
+    def _save_inputs(self):
+        # The post scripts are not in the rootfs cache key, but the
+        # previous rootfs has been processed by them
+        with open(self.inputs_yaml, "w") as f:
+            yaml.dump(dict(self._get_inputs(), rootfs_post_scripts=self.rootfs_post_scripts), f)
+
+    def _get_prev_inputs(self):
+        """
+        Return inputs of the previous rootfs if it could be updated
+        incrementally, otherwise None
+        """
+        if not os.path.exists(self.inputs_yaml) or not os.path.exists(self.packages_yaml):
+            logger.info("No previous rootfs found, could not update rootfs incrementally")
+            return None
+
+        # The previous rootfs is already post processed
+        non_idempotent = [p for p in self.rootfs_post_funcs + self.rootfs_post_scripts if p not in self.idempotent_post]
+        if non_idempotent:
+            logger.warning("Rootfs post scripts are not known to be idempotent, could not update rootfs incrementally:\n\t%s"
+                               % '\n\t'.join(str(p) for p in non_idempotent))
+            return None
+
+        with open(self.inputs_yaml) as f:
+            prev_inputs = yaml.load(f) or dict()
+
+        for k, v in dict(self._get_inputs(), rootfs_post_scripts=self.rootfs_post_scripts).items():
+            # Packages are the delta to apply
+            if k in ['packages', 'external_packages', 'pkg_globs']:
+                continue
+            if prev_inputs.get(k) != v:
+                logger.info("The %s changed, could not update rootfs incrementally" % k)
+                return None
+
+        return prev_inputs
+
+    def _get_cache_key(self):
+        metadata_files = self.pm.metadata_files()
+        if not metadata_files:
+            logger.debug("No metadata of package feeds found, do not use rootfs cache")
+            return None
+
+        # Include the content of pre scripts which are script files
+        script_files = []
+        for script in self.rootfs_pre_scripts:
+            script_file = script.split()[0] if script.split() else ""
+            if os.path.isfile(script_file):
+                script_files.append(script_file)
 
-        self.pm.create_configs()
-        self.pm.insert_feeds_uris(self.pkg_feeds, True if 'dnf' in self.packages or 'apt' in self.packages else False)
-        self.pm.set_exclude(self.exclude_packages)
-        self.pm.update()
+        # The pkgdata resolves the complementary packages of pkg_globs
+        inputs = dict(self._get_inputs(), pkgdata=self.pm.pkgdata_index.stamp())
+        return self.rootfs_cache.get_key(inputs, metadata_files + script_files)
+
+    @profiled("Install packages")
+    def _install_packages(self):
         self.pm.install(self.packages)
         self.pm.install_complementary(self.pkg_globs)
 
@@ -173,7 +279,7 @@ class Rootfs(object):
         # We install external packages after packages been installed,
         # because we don't want complementary package logic apply to it.
         #
-        duplicate_pkgs = set(self.pm.list_installed().keys()) & set(self.external_packages)
+        duplicate_pkgs = set(self.pm.list_installed(with_deps=False).keys()) & set(self.external_packages)
         explicit_duplicate_pkgs = set(self.packages) & set(self.external_packages)
         implicit_duplicate_pkgs = duplicate_pkgs - explicit_duplicate_pkgs
         if explicit_duplicate_pkgs:
@@ -187,9 +293,95 @@ class Rootfs(object):
 
         self.pm.run_intercepts()
 
+    @profiled("Update packages")
+    def _update_packages(self, prev_inputs):
+        """
+        Apply the package delta against the previous rootfs, return names
+        of the packages which are installed, removed or changed
+        """
+        with open(self.packages_yaml) as f:
+            prev_installed = dict(yaml.load(f) or {})
+
+        prev_requested = set(prev_inputs['packages']) | set(prev_inputs['external_packages'])
+        remove_pkgs = sorted(p for p in prev_requested - set(self.packages) - set(self.external_packages)
+                                 if p in prev_installed)
+        install_pkgs = sorted(set(self.packages) - set(prev_inputs['packages']))
+        install_external_pkgs = sorted(set(self.external_packages) - set(prev_inputs['external_packages']))
+        logger.info("Update rootfs incrementally, remove packages: %s, install packages: %s"
+                        % (' '.join(remove_pkgs), ' '.join(install_pkgs + install_external_pkgs)))
+
+        if remove_pkgs:
+            # The complementary packages were installed as requested ones
+            # and keep what they complement, remove all of them and
+            # install the ones still needed again
+            prev_globs = prev_inputs['pkg_globs']
+            complementary_pkgs = self.pm.list_complementary(sorted(prev_installed), prev_globs) \
+                                     - set(self.packages) - set(self.external_packages)
+            logger.debug("Remove complementary packages: %s" % ' '.join(sorted(complementary_pkgs)))
+            self.pm.remove_unneeded(sorted(set(remove_pkgs) | complementary_pkgs))
+
+            kept_pkgs = set(remove_pkgs) & set(self.pm.list_installed(with_deps=False))
+            if kept_pkgs:
+                logger.warning("The following packages are not requested any more, but are kept because other packages require them: \n\t%s"
+                                   % '\n\t'.join(sorted(kept_pkgs)))
+
+        self.pm.install(install_pkgs)
+        if remove_pkgs or install_pkgs or self.pkg_globs != prev_inputs['pkg_globs']:
+            self.pm.install_complementary(self.pkg_globs)
+        self.pm.install(install_external_pkgs)
+        self._save_installed()
+
+        changed_pkgs = set()
+        for pkg in set(prev_installed) | set(self.installed_pkgs):
+            if prev_installed.get(pkg, {}).get('ver') != self.installed_pkgs.get(pkg, {}).get('ver'):
+                changed_pkgs.add(pkg)
+        logger.debug("Changed packages: %s" % ' '.join(sorted(changed_pkgs)))
+
+        # Nothing to configure if no package changed
+        if changed_pkgs:
+            self.pm.post_install()
+            self.pm.run_intercepts()
+
+        return changed_pkgs
+
+    def create(self):
+        prev_inputs = None
+        if self.incremental:
+            prev_inputs = self._get_prev_inputs()
+            if prev_inputs is None:
+                # Start over from an empty rootfs
+                utils.remove(self.target_rootfs, recurse=True)
+                utils.mkdirhier(self.target_rootfs)
+
+        # The previous rootfs has already been processed by pre scripts
+        self._pre_rootfs(run_scripts=prev_inputs is None)
+
+        with profiler.phase("Update package feeds"):
+            self.pm.create_configs()
+            self.pm.insert_feeds_uris(self.pkg_feeds, True if 'dnf' in self.packages or 'apt' in self.packages else False)
+            self.pm.set_exclude(self.exclude_packages)
+            self.pm.update()
+
+        if prev_inputs is not None:
+            changed_pkgs = self._update_packages(prev_inputs)
+        else:
+            cache_key = self._get_cache_key() if self.rootfs_cache else None
+            if cache_key and self.rootfs_cache.restore(cache_key, self.target_rootfs, self.packages_yaml):
+                with open(self.packages_yaml) as f:
+                    self.installed_pkgs = dict(yaml.load(f) or {})
+            else:
+                self._install_packages()
+                if cache_key:
+                    self.rootfs_cache.save(cache_key, self.target_rootfs, self.packages_yaml)
+            changed_pkgs = None
+
+        self._save_inputs()
+
         self._post_rootfs()
 
-        self._generate_kernel_module_deps()
+        # Only kernel and kernel module packages affect module dependencies
+        if changed_pkgs is None or any(p.startswith("kernel") for p in changed_pkgs):
+            self._generate_kernel_module_deps()
 
     def image_list_installed_packages(self):
         return self.installed_pkgs
@@ -202,6 +394,7 @@ class Rootfs(object):
                     return found_ko
         return False
 
+    @profiled("Generate kernel module deps")
     def _generate_kernel_module_deps(self):
         modules_dir = os.path.join(self.target_rootfs, 'lib', 'modules')
         # if we don't have any modules don't bother to do the depmod
@@ -230,7 +423,9 @@ class ExtDebRootfs(Rootfs):
                  apt_keys=[],
                  external_packages=[],
                  exclude_packages=[],
-                 target_rootfs=None):
+                 target_rootfs=None,
+                 pkg_cache=None,
+                 metadata_cache=None):
 
         self.workdir = workdir
         self.data_dir = data_dir
@@ -258,11 +453,16 @@ class ExtDebRootfs(Rootfs):
                                  apt_keys,
                                  self.workdir,
                                  self.target_rootfs,
-                                 self.machine)
+                                 self.machine,
+                                 pkg_cache=pkg_cache,
+                                 metadata_cache=metadata_cache)
 
         self.installed_pkgs = dict()
 
         self.rootfs_post_scripts = []
+        self.rootfs_post_funcs = []
+        self.idempotent_post = set()
+        self.environments = []
 
     def create(self):
         self.pm.create_configs()
@@ -276,7 +476,7 @@ class ExtDebRootfs(Rootfs):
         # We install external packages after packages been installed,
         # because we don't want complementary package logic apply to it.
         #
-        duplicate_pkgs = set(self.pm.list_installed().keys()) & set(self.external_packages)
+        duplicate_pkgs = set(self.pm.list_installed(with_deps=False).keys()) & set(self.external_packages)
         explicit_duplicate_pkgs = set(self.packages) & set(self.external_packages)
         implicit_duplicate_pkgs = duplicate_pkgs - explicit_duplicate_pkgs
         if explicit_duplicate_pkgs:
@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import os
+import os.path
+import json
+import fcntl
+import hashlib
+import logging
+
+import genimage.utils as utils
+
+logger = logging.getLogger('appsdk')
+
+DEFAULT_ROOTFS_CACHE_SIZE = 20
+
+def hash_file(path, h):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(utils.RUN_CMD_READ_SIZE), b''):
+            h.update(chunk)
+
+def get_tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            size += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return size
+
+class RootfsCache(object):
+    """
+    Content addressed cache of installed rootfs trees.
+
+    Each entry is a directory named by the key, it holds the rootfs and the
+    packages.yaml of the installed packages. Running as root, the rootfs is
+    kept as a tree and cloned by `cp --reflink=auto'; under pseudo the file
+    ownership only lives in the pseudo database, so the rootfs is kept as a
+    tarball created and extracted under pseudo.
+
+    The least recently used entries are evicted when the total size is
+    larger than max_size (in GB).
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_ROOTFS_CACHE_SIZE):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.max_size = max_size * 1024 * 1024 * 1024
+        utils.mkdirhier(self.cache_dir)
+        self.lock_file = os.path.join(self.cache_dir, "lock")
+
+    @staticmethod
+    def get_key(inputs, files=[]):
+        """
+        Compute the key from a json serializable object and the content
+        of files
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps(inputs, sort_keys=True).encode())
+        for f in sorted(files):
+            h.update(f.encode())
+            hash_file(f, h)
+        return h.hexdigest()
+
+    def _lock(self, operation=fcntl.LOCK_EX):
+        lock = open(self.lock_file, 'a')
+        fcntl.flock(lock, operation)
+        return lock
+
+    def restore(self, key, target_rootfs, packages_yaml):
+        entry = os.path.join(self.cache_dir, key)
+        # Hold a shared lock to prevent the entry from being evicted
+        with self._lock(fcntl.LOCK_SH):
+            if not os.path.exists(os.path.join(entry, "packages.yaml")):
+                logger.debug("Rootfs cache miss %s", key)
+                return False
+
+            logger.info("Rootfs cache hit %s, restore rootfs from it", key)
+            # Mark it as recently used
+            os.utime(entry)
+            utils.mkdirhier(target_rootfs)
+            if os.path.exists(os.path.join(entry, "rootfs.tar")):
+                cmd = "tar --numeric-owner --xattrs -xpf %s -C %s" % (os.path.join(entry, "rootfs.tar"), target_rootfs)
+            else:
+                cmd = "cp -a --reflink=auto %s/. %s/" % (os.path.join(entry, "rootfs"), target_rootfs)
+            res, output = utils.run_cmd(cmd, shell=True, print_output=False)
+            if res:
+                raise Exception("Restore rootfs from cache %s failed\nExit code %d. Output:\n%s"
+                                   % (entry, res, output))
+            utils.copyfile(os.path.join(entry, "packages.yaml"), packages_yaml)
+        return True
+
+    def save(self, key, target_rootfs, packages_yaml):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry):
+            return
+
+        logger.info("Save rootfs to cache %s", key)
+        tmp_entry = "%s.tmp-%d" % (entry, os.getpid())
+        utils.remove(tmp_entry, recurse=True)
+        utils.mkdirhier(tmp_entry)
+        if os.getuid() == 0:
+            utils.mkdirhier(os.path.join(tmp_entry, "rootfs"))
+            cmd = "cp -a --reflink=auto %s/. %s/" % (target_rootfs, os.path.join(tmp_entry, "rootfs"))
+        else:
+            cmd = "tar --numeric-owner --xattrs -cpf %s -C %s ." % (os.path.join(tmp_entry, "rootfs.tar"), target_rootfs)
+        res, output = utils.run_cmd(cmd, shell=True, print_output=False)
+        if res:
+            utils.remove(tmp_entry, recurse=True)
+            logger.warning("Save rootfs to cache %s failed, ignore it\n%s", entry, output)
+            return
+        utils.copyfile(packages_yaml, os.path.join(tmp_entry, "packages.yaml"))
+        with open(os.path.join(tmp_entry, "size"), "w") as f:
+            f.write("%d" % get_tree_size(tmp_entry))
+
+        with self._lock():
+            if os.path.exists(entry):
+                utils.remove(tmp_entry, recurse=True)
+            else:
+                os.rename(tmp_entry, entry)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            # Skip the entries which are being saved
+            if ".tmp-" in name:
+                continue
+            size_file = os.path.join(entry, "size")
+            if not os.path.exists(size_file):
+                continue
+            with open(size_file) as f:
+                size = int(f.read() or 0)
+            entries.append((os.stat(entry).st_mtime, size, entry))
+            total += size
+
+        # Remove the least recently used first
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug("Evict rootfs cache %s", entry)
+            utils.remove(entry, recurse=True)
+            total -= size
@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2021 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import OrderedDict
+
+logger = logging.getLogger('appsdk')
+
+class Task(object):
+    def __init__(self, name, func, inputs, outputs):
+        self.name = name
+        self.func = func
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+
+class TaskScheduler(object):
+    """
+    Run tasks in dependency order. Each task declares the inputs it reads
+    and the outputs it produces, a task is ready when every input produced
+    by another task of the graph is done. Inputs which no task produces
+    (such as the rootfs) are regarded as available.
+
+    With jobs > 1, ready tasks run concurrently in forked child processes,
+    otherwise they run one by one in the current process, in the order they
+    were added.
+    """
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.tasks = OrderedDict()
+
+    def add_task(self, name, func, inputs=(), outputs=()):
+        if name in self.tasks:
+            raise Exception("Task %s is added twice" % name)
+        self.tasks[name] = Task(name, func, inputs, outputs)
+
+    def _producers(self):
+        producers = dict()
+        for task in self.tasks.values():
+            for output in task.outputs:
+                if output in producers:
+                    raise Exception("Output %s is produced by both %s and %s" % (output, producers[output], task.name))
+                producers[output] = task.name
+        return producers
+
+    def _get_deps(self):
+        producers = self._producers()
+        deps = dict()
+        for task in self.tasks.values():
+            deps[task.name] = set(producers[i] for i in task.inputs if i in producers and producers[i] != task.name)
+        return deps
+
+    def _check_cycle(self, deps):
+        done = set()
+        pending = list(self.tasks)
+        while pending:
+            ready = [t for t in pending if deps[t] <= done]
+            if not ready:
+                raise Exception("Dependency cycle between tasks: %s" % ' '.join(pending))
+            done.update(ready)
+            pending = [t for t in pending if t not in done]
+
+    def run(self):
+        deps = self._get_deps()
+        self._check_cycle(deps)
+        logger.debug("Task dependencies: %s", dict((t, sorted(d)) for t, d in deps.items()))
+
+        if self.jobs == 1:
+            self._run_serial(deps)
+        else:
+            self._run_parallel(deps)
+
+    def _run_serial(self, deps):
+        done = set()
+        pending = list(self.tasks)
+        while pending:
+            name = [t for t in pending if deps[t] <= done][0]
+            self.tasks[name].func()
+            done.add(name)
+            pending.remove(name)
+
+    def _run_parallel(self, deps):
+        ctx = multiprocessing.get_context('fork')
+        done = set()
+        pending = list(self.tasks)
+        running = dict()
+        try:
+            while pending or running:
+                for name in [t for t in pending if deps[t] <= done]:
+                    if len(running) >= self.jobs:
+                        break
+                    logger.debug("Start task %s", name)
+                    proc = ctx.Process(target=self.tasks[name].func, name=name)
+                    proc.start()
+                    running[proc.sentinel] = proc
+                    pending.remove(name)
+
+                for sentinel in wait(list(running)):
+                    proc = running.pop(sentinel)
+                    proc.join()
+                    if proc.exitcode != 0:
+                        raise Exception("Task %s failed with exit code %s" % (proc.name, proc.exitcode))
+                    logger.debug("Task %s done", proc.name)
+                    done.add(proc.name)
+        finally:
+            for proc in running.values():
+                if proc.is_alive():
+                    logger.info("Terminate task %s", proc.name)
+                    proc.terminate()
+                proc.join()
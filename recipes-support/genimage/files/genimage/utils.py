@@ -24,22 +24,40 @@ import glob
 import stat
 import shutil
 import re
-from ruamel.yaml.representer import RoundTripRepresenter
-from ruamel.yaml import YAML
+import io
+import codecs
+import locale
+import selectors
+import signal
+import collections
 import configparser
-from pykwalify.core import Core
 
 from genimage.constant import DEFAULT_MACHINE
 import genimage.debian_constant as deb_constant
 import genimage.constant as constant
+import genimage.profiler as profiler
 
-def repr_str(dumper: RoundTripRepresenter, data: str):
+def repr_str(dumper, data: str):
     if '\n' in data:
         return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
     return dumper.represent_scalar('tag:yaml.org,2002:str', data)
 
-yaml = YAML()
-yaml.representer.add_representer(str, repr_str)
+class LazyYAML(object):
+    """
+    The ruamel YAML instance, created on first use, so the subcommands
+    which do not read or write yaml start without importing ruamel
+    """
+    def __init__(self):
+        self._yaml = None
+
+    def __getattr__(self, name):
+        if self._yaml is None:
+            from ruamel.yaml import YAML
+            self._yaml = YAML()
+            self._yaml.representer.add_representer(str, repr_str)
+        return getattr(self._yaml, name)
+
+yaml = LazyYAML()
 
 logger = logging.getLogger('appsdk')
 
@@ -123,40 +141,173 @@ def signal_exit_handler(signal, frame):
 
     sys.exit(1)
 
-def run_cmd(cmd, shell=False, print_output=True, env=None, cwd=None):
-    logger.debug('Running %s' % cmd)
-    if env is None:
-        env = os.environ
+RUN_CMD_READ_SIZE = 64 * 1024
+# Characters of output kept in memory by run_cmd in bounded-memory mode
+RUN_CMD_TAIL_SIZE = 1024 * 1024
 
-    outputs = ""
+class OutputCollector(object):
+    """
+    Collect the output of a child process in chunks. The output is joined
+    once at the end rather than concatenated per line. If tail_size is set,
+    only the last tail_size characters are kept in memory, and log_file (if
+    any) receives the full output.
+    """
+    def __init__(self, print_output=True, log_file=None, tail_size=None):
+        self.print_output = print_output
+        self.tail_size = tail_size
+        self.chunks = collections.deque()
+        self.size = 0
+        self.partial = ""
+        self.log_f = None
+        if log_file:
+            mkdirhier(os.path.dirname(os.path.abspath(log_file)))
+            self.log_f = open(log_file, "w")
+
+    def feed(self, data):
+        if not data:
+            return
+
+        if self.log_f:
+            self.log_f.write(data)
+
+        if self.print_output:
+            lines = (self.partial + data).split("\n")
+            self.partial = lines.pop()
+            if lines:
+                logger.debug("\n".join(lines))
+
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.tail_size is not None:
+            while len(self.chunks) > 1 and self.size - len(self.chunks[0]) >= self.tail_size:
+                self.size -= len(self.chunks.popleft())
+
+    def close(self):
+        if self.print_output and self.partial:
+            logger.debug(self.partial)
+            self.partial = ""
+
+        if self.log_f:
+            self.log_f.close()
+            self.log_f = None
+
+    def getvalue(self):
+        output = "".join(self.chunks)
+        if self.tail_size is not None and len(output) > self.tail_size:
+            output = output[-self.tail_size:]
+        return output
+
+def _popen(cmd, shell, env, cwd):
     process = subprocess.Popen(cmd,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.STDOUT,
                                shell=shell,
                                cwd=cwd,
                                restore_signals=False,
-                               preexec_fn=os.setsid,
-                               universal_newlines=True, env=env)
+                               start_new_session=True,
+                               env=os.environ if env is None else env)
     current_subprocs.add(process)
-    while True:
-        output = process.stdout.readline()
-        if output:
-            if print_output:
-                logger.debug(output.rstrip("\n"))
-            outputs += output
-        if process.poll() is not None:
-            current_subprocs.remove(process)
-            break
-
-    # Read the remaining logs from stdout after process terminates
-    output = process.stdout.read()
-    if output:
-        logger.debug(output.rstrip("\n"))
-        outputs += output
-
-    rc = process.poll()
+    return process
+
+def _read_output(process):
+    """
+    Yield the decoded output of process in large chunks as it becomes
+    available
+    """
+    decoder = io.IncrementalNewlineDecoder(
+                  codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace'),
+                  translate=True)
+    fd = process.stdout.fileno()
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            selector.select()
+            data = os.read(fd, RUN_CMD_READ_SIZE)
+            if not data:
+                break
+            yield decoder.decode(data)
+    yield decoder.decode(b"", final=True)
+    process.stdout.close()
+
+def _wait(process, cmd, start_time):
+    if profiler.is_enabled():
+        return _wait_profiled(process, cmd, start_time)
+    return process.wait()
+
+def run_cmd(cmd, shell=False, print_output=True, env=None, cwd=None, log_file=None, tail_size=None):
+    """
+    Run cmd and return (rc, output), stderr is merged into stdout.
+
+    The output is read in large chunks as it becomes available rather than
+    line by line. If tail_size is set, only the last tail_size characters
+    of output are kept in memory and returned, use log_file to save the
+    full output.
+    """
+    logger.debug('Running %s' % cmd)
+    start_time = time.time()
+    collector = OutputCollector(print_output, log_file, tail_size)
+    process = _popen(cmd, shell, env, cwd)
+    try:
+        for data in _read_output(process):
+            collector.feed(data)
+        rc = _wait(process, cmd, start_time)
+    finally:
+        current_subprocs.discard(process)
+        collector.close()
+
     logger.debug("rc %d" % rc)
-    return rc, outputs
+    return rc, collector.getvalue()
+
+def run_cmd_lines(cmd, shell=False, env=None, cwd=None, tail_size=RUN_CMD_TAIL_SIZE):
+    """
+    Run cmd and yield the lines of output without newlines as they are
+    read, stderr is merged into stdout. The output is not kept in memory
+    except its last tail_size characters, which are in the exception
+    raised if cmd fails. If the caller stops early, cmd is killed.
+    """
+    logger.debug('Running %s' % cmd)
+    start_time = time.time()
+    collector = OutputCollector(False, None, tail_size)
+    process = _popen(cmd, shell, env, cwd)
+    try:
+        partial = ""
+        for data in _read_output(process):
+            collector.feed(data)
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            yield from lines
+        if partial:
+            yield partial
+        rc = _wait(process, cmd, start_time)
+    finally:
+        if process.returncode is None:
+            process.stdout.close()
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            process.wait()
+        current_subprocs.discard(process)
+
+    logger.debug("rc %d" % rc)
+    if rc:
+        raise Exception("Executing %s failed\nExit code %d. Output:\n%s"
+                           % (cmd, rc, collector.getvalue()))
+
+def _wait_profiled(process, cmd, start_time):
+    """
+    Wait for process and record its resource usage, /proc/<pid>/io is
+    read before the exited process is reaped
+    """
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io_counters = profiler.read_proc_io(process.pid)
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    profiler.record_cmd(cmd, start_time, time.time(), rusage, io_counters)
+    return process.returncode
 
 def run_cmd_oneshot(cmd, shell=True, print_output=False, cwd=None):
     res, output = run_cmd(cmd, shell, print_output, cwd=cwd)
@@ -457,7 +608,8 @@ def show_task_info(msg):
         def func_wrapper(self):
             logger.info("%s: Started", msg)
             start_time = time.time()
-            func(self)
+            with profiler.phase(msg):
+                func(self)
             logger.info("%s: Succeeded(took %d seconds) ", msg, time.time()-start_time)
 
         return func_wrapper
@@ -574,6 +726,7 @@ def validate_inputyamls(yaml_file, no_validate=False, pykwalify_schemas=None):
     try:
         pykwalify_dir = os.path.join(os.environ['OECORE_NATIVE_SYSROOT'], 'usr/share/genimage/data/pykwalify')
         extensions = [os.path.join(pykwalify_dir, 'ext.py')]
+        from pykwalify.core import Core
         c = Core(source_file=yaml_file, schema_files=pykwalify_schemas, extensions=extensions)
         c.validate(raise_exception=True)
     except Exception as e:
@@ -758,7 +911,7 @@ LABEL %NAME%
 '''
 
 def create_syslinux_cfg(entries, output_dir, syslinux_cfg_entry=None, image_type='pxe'):
-    syslinux_cfg = os.path.join(output_dir, "syslinux.cfg")
+    syslinux_cfg = os.path.join(output_dir, "syslinux-%s.cfg" % image_type)
     content = SYSLINUX_CFG_HEAD
 
     for entry in entries:
@@ -36,7 +36,8 @@ setuptools.setup(
             'exampleyamls=genimage:main_exampleyamls',
             'geninitramfs=genimage:main_geninitramfs',
             'genfitimage=genimage:main_genfitimage',
-            'gencontainer=genimage:main_gencontainer'
+            'gencontainer=genimage:main_gencontainer',
+            'benchinitramfs=genimage:main_benchinitramfs'
         ],
     },
     license="GNU General Public License v2.0",